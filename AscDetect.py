@@ -42,33 +42,18 @@ def detect_sokoban_level(rect, ansi):
     For detection purposes any ascii '-' or '|' is a wall.
     The match must be bidirectional.
     """
-    # Define wall ascii symbols for the purpose of sokoban level detection.
-    sokoban_wall_characters = ('-', '|')
     # Get the set of wall locations on the observed ansi map.
     raw_wall_locations = set()
     for loc in rect.gen_locations():
         row, col = loc
         ansi_square = ansi.lines[row][col]
-        if ansi_square.char in sokoban_wall_characters:
+        if ansi_square.char in AscSokoban.SOKOBAN_WALL_CHARACTERS:
             raw_wall_locations.add(loc)
     # If no walls were observed then the level was not detected.
     if not raw_wall_locations:
         return None
-    # Get the bounding wall rectangle of the observed ansi map on the screen.
-    row_min, col_min, row_max, col_max = get_bounding_coordinates(raw_wall_locations)
-    # Spacially translate wall locations to the upper left.
-    translated_wall_locations = set()
-    for loc in raw_wall_locations:
-        row, col = loc
-        translated_location = (row - row_min, col - col_min)
-        translated_wall_locations.add(translated_location)
     # See if the wall pattern matches that of a hard coded Sokoban level.
-    matching_level_names = []
-    for level_string, level_name in AscSokoban.all_level_strings_and_names:
-        level = AscSokoban.sokoban_string_to_map(level_string)
-        sokoban_wall_locations = set(loc for loc, c in level.items() if c in sokoban_wall_characters)
-        if sokoban_wall_locations == translated_wall_locations:
-            matching_level_names.append(level_name)
+    matching_level_names = AscSokoban.get_catalogue().get_matching_level_names(raw_wall_locations)
     # If we got no matches or more than one match then fail.
     if not matching_level_names:
         return None
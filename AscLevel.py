@@ -1,12 +1,17 @@
 import random
+import heapq
+from array import array
+from collections import OrderedDict
 
 from AscLevelConstants import *
 
-from AscAnsi import Ansi, AnsiSquare
+from AscTerminal import Square
 from AscMonster import MonsterHistory
 from AscWallSearch import WallSearch
-from AscUtil import distL1, distLinf, get_bounding_coordinates, vi_delta_pairs, Rect
+from AscUtil import distL1, distLinf, get_bounding_coordinates, vi_delta_pairs, Rect, shift_mask, gen_mask_indices
+from AscLog import get_channel
 import AscSokoban
+import AscSokobanSolver
 import AscDetect
 
 class ItemHistory:
@@ -30,16 +35,13 @@ class ItemHistory:
         Returns a list of regions that are connected to the player region.
         Danger is disregarded for now.
         """
+        region_graph = self.level.dungeon.region_graph
         shell = [self]
         connected_regions = [self]
         while shell:
             new_shell = []
             for region in shell:
-                if force_safe:
-                    neighbors_and_distances = list(region.gen_safe_neighbors_and_distances())
-                else:
-                    neighbors_and_distances = list(region.gen_neighbors_and_distances())
-                for neighbor, distance in neighbors_and_distances:
+                for neighbor, distance in region_graph.get_neighbors_and_distances(region, force_safe):
                     if neighbor not in connected_regions:
                         connected_regions.append(neighbor)
                         new_shell.append(neighbor)
@@ -54,28 +56,25 @@ class ItemHistory:
         If the current region is best return None.
         This function does not allow traversal of suicidally dangerous links.
         """
-        verbose = True
-        if verbose:
-            self.remark('get_best_neighbor_region')
+        # these remarks are made every turn, so they are debug records that are formatted only if written
+        debug = self.level.debug
+        debug('get_best_neighbor_region')
         # First get the list of target levels without regard to distance.
         connected_regions = self.get_safe_connected_regions()
-        if verbose:
-            self.remark('%d safely connected regions:' % len(connected_regions))
-            for region in connected_regions:
-                self.remark(str(region))
+        debug('%d safely connected regions:', len(connected_regions))
+        for region in connected_regions:
+            debug('safely connected region: %s', region)
         unexplored_regions = [r for r in connected_regions if r.exploration_level == EXP_UNEXPLORED and r.exploration_danger_level == DANGER_SAFE]
-        if verbose:
-            self.remark('%d safely unexplored safely connected regions:' % len(unexplored_regions))
-            for region in unexplored_regions:
-                self.remark(str(region))
+        debug('%d safely unexplored safely connected regions:', len(unexplored_regions))
+        for region in unexplored_regions:
+            debug('unexplored region: %s', region)
         if not unexplored_regions:
             return None
         shallowest_dlvl = min(r.level.level_dlvl for r in unexplored_regions)
         target_regions = [r for r in unexplored_regions if r.level.level_dlvl == shallowest_dlvl]
-        if verbose:
-            self.remark('%d target regions:' % len(target_regions))
-            for region in target_regions:
-                self.remark(str(region))
+        debug('%d target regions:', len(target_regions))
+        for region in target_regions:
+            debug('target region: %s', region)
         if self in target_regions:
             return None
         return self.get_best_neighbor_region_helper(connected_regions, target_regions)
@@ -87,15 +86,16 @@ class ItemHistory:
         If the current region is best return None.
         This function does not allow traversal of suicidally dangerous links.
         """
-        self.remark('get_best_neighbor_region_desperate')
+        debug = self.level.debug
+        debug('get_best_neighbor_region_desperate')
         # Get the list of regions that are connected to this region.
         connected_regions = self.get_safe_connected_regions()
         if not connected_regions:
             self.remark('no safely connected regions')
             return None
-        self.remark('%d safely connected regions:' % len(connected_regions))
+        debug('%d safely connected regions:', len(connected_regions))
         for region in connected_regions:
-            self.remark(str(region))
+            debug('safely connected region: %s', region)
         # Of the connected regions, get the list of regions that are in the doom branch or an unknown branch or minetown.
         filtered_connected_regions = []
         for region in connected_regions:
@@ -104,9 +104,9 @@ class ItemHistory:
         if not filtered_connected_regions:
             self.remark('none of these regions are in the appropriate branch or special level')
             return None
-        self.remark('of these regions %d were in an appropriate branch or special level:' % len(filtered_connected_regions))
+        debug('of these regions %d were in an appropriate branch or special level:', len(filtered_connected_regions))
         for region in filtered_connected_regions:
-            self.remark(str(region))
+            debug('region in an appropriate branch: %s', region)
         # Of the remaining interesting regions get the ones that are not adjacent to a region with down stairs.
         target_regions = []
         for region in filtered_connected_regions:
@@ -119,9 +119,9 @@ class ItemHistory:
         if not target_regions:
             self.remark('all of these regions are safely connected to a down stair region on the same level')
             return None
-        self.remark('of these regions %d are not safely connected to a down stair region on the same level:' % len(target_regions))
+        debug('of these regions %d are not safely connected to a down stair region on the same level:', len(target_regions))
         for region in target_regions:
-            self.remark(str(region))
+            debug('target region: %s', region)
         # if our own region is a target region then return None
         if self in target_regions:
             return None
@@ -134,64 +134,587 @@ class ItemHistory:
         {get_best_neighbor_region, get_best_neighbor_region_desperate}
         Given a list of target regions it finds the adjacent region closest to the nearest target region.
         """
-        # Now find the closest of these regions.
-        # Use a cheesy best first search with an inefficient priority queue.
-        region_id_to_distance = dict((id(r), 0) for r in target_regions)
-        regions_and_distances = [(r, 0) for r in target_regions]
-        while len(regions_and_distances) < len(connected_regions):
-            # get the shell of all neighbors and their distances
-            distances_and_neighbors = []
-            for region, distance in regions_and_distances:
-                for neighbor, ddist in region.gen_neighbors_and_distances():
-                    if id(neighbor) not in region_id_to_distance:
-                        distances_and_neighbors.append((distance + ddist, neighbor))
-            # add the closest neighbor of the entire shell
-            best_distance, best_neighbor = min(distances_and_neighbors)
-            region_id_to_distance[id(best_neighbor)] = best_distance
-            regions_and_distances.append((best_neighbor, best_distance))
+        # Find the distance from each connected region to the closest target region.
+        region_graph = self.level.dungeon.region_graph
+        region_to_distance = region_graph.get_distances(target_regions, connected_regions)
         # Determine which neighboring region to approach.
         # This is like traceback.
-        distance_and_neighbor = [(region_id_to_distance[id(r)], r) for r, d in self.gen_neighbors_and_distances()]
+        distance_and_neighbor = []
+        for region, distance in region_graph.get_neighbors_and_distances(self):
+            if region in region_to_distance:
+                distance_and_neighbor.append((region_to_distance[region], region))
         best_distance, best_neighbor = min(distance_and_neighbor)
         return best_neighbor
 
 
-class LevelSquare:
+class RegionGraph:
+    """
+    This is the graph of regions on all levels of the dungeon.
+    The neighbors and distances of each region are remembered between turns,
+    and they are forgotten when the links of a level or the stair links of a region change.
+    """
     def __init__(self):
-        # where is the square?
-        self.loc = None
-        # what is the type of the square?
-        self.hard = HM_UNKNOWN
-        # is graffiti known to be on the square?
-        self.graffiti = False
-        # has the square been stepped on by the player?
-        self.trod = False
-        # is the square in a store?
-        self.store = GM_NONE
-        # how many searches have been done from this square?
-        self.search_count_from = 0
-        # how many searches have been done to this square?
-        self.search_count_to = 0
-        # what trap is on the square?
-        self.trap = TRAP_UNKNOWN
-        # what is the monster history of this square?
-        self.monster = None
-        # what is the item history of this square?
-        self.item = None
-        # cache the passable neighbor locations for speed
-        self.passable_neighbor_locations = []
-        # what are the names of the large containers dropped here?
-        self.large_container_names = []
-        # is there a boulder on the square?
-        self.boulder = False
+        # map (region, safe) to a list of (neighbor, distance) pairs
+        self.region_to_neighbors = {}
+        # map a level to a summary of its region links
+        self.level_to_link_signature = {}
+
+    def get_neighbors_and_distances(self, region, safe=False):
+        """
+        @param safe: True if suicidally dangerous links should not be followed
+        @return: a list of (neighbor, distance) pairs
+        """
+        key = (region, safe)
+        neighbors_and_distances = self.region_to_neighbors.get(key, None)
+        if neighbors_and_distances is None:
+            if safe:
+                neighbors_and_distances = list(region.gen_safe_neighbors_and_distances())
+            else:
+                neighbors_and_distances = list(region.gen_neighbors_and_distances())
+            self.region_to_neighbors[key] = neighbors_and_distances
+        return neighbors_and_distances
+
+    def notify_region_links(self, level):
+        """
+        This is called when the region links of a level may have changed.
+        The neighbors of the regions on the level are forgotten only if the links really changed.
+        @return: True if the links changed
+        """
+        signature = (frozenset((id(region), region.location) for region in level.regions), level.region_links.get_signature())
+        if self.level_to_link_signature.get(level, None) == signature:
+            return False
+        self.level_to_link_signature[level] = signature
+        self.forget_level(level)
+        return True
+
+    def notify_stair_link(self, region):
+        """
+        This is called when a region is linked to or unlinked from a region on another level.
+        """
+        self.forget_region(region)
+        if region.target_region:
+            self.forget_region(region.target_region)
+
+    def forget_level(self, level):
+        for key in [key for key in self.region_to_neighbors if key[0].level is level]:
+            del self.region_to_neighbors[key]
+
+    def forget_region(self, region):
+        for safe in (False, True):
+            self.region_to_neighbors.pop((region, safe), None)
+
+    def get_distances(self, source_regions, allowed_regions=None, safe=False):
+        """
+        This is Dijkstra's algorithm with a heap.
+        @param source_regions: the regions at distance zero
+        @param allowed_regions: the regions that may be visited, or None to allow all regions
+        @return: a dict mapping each reachable region to its distance from the closest source region
+        """
+        if allowed_regions is not None:
+            allowed_regions = set(allowed_regions)
+        region_to_distance = {}
+        # The counter breaks ties so that regions are never compared.
+        heap = [(0, i, region) for i, region in enumerate(source_regions)]
+        heapq.heapify(heap)
+        counter = len(heap)
+        while heap:
+            distance, ignored, region = heapq.heappop(heap)
+            if region in region_to_distance:
+                continue
+            region_to_distance[region] = distance
+            for neighbor, ddist in self.get_neighbors_and_distances(region, safe):
+                if neighbor in region_to_distance:
+                    continue
+                if allowed_regions is not None and neighbor not in allowed_regions:
+                    continue
+                heapq.heappush(heap, (distance + ddist, counter, neighbor))
+                counter += 1
+        return region_to_distance
+
+    def get_next_hops(self, region, target_regions, allowed_regions=None, safe=False):
+        """
+        Find the first step from a region towards each of many target regions with a single search.
+        @param region: the starting region
+        @param target_regions: the regions to find paths to
+        @param allowed_regions: the regions that may be visited, or None to allow all regions
+        @return: a dict mapping each reachable target region to a (distance, neighbor of the starting region) pair
+        """
+        if allowed_regions is not None:
+            allowed_regions = set(allowed_regions)
+        region_to_hop = {}
+        heap = [(0, 0, region, None)]
+        counter = 1
+        while heap:
+            distance, ignored, current, first_hop = heapq.heappop(heap)
+            if current in region_to_hop:
+                continue
+            region_to_hop[current] = (distance, first_hop)
+            for neighbor, ddist in self.get_neighbors_and_distances(current, safe):
+                if neighbor in region_to_hop:
+                    continue
+                if allowed_regions is not None and neighbor not in allowed_regions:
+                    continue
+                if current is region:
+                    neighbor_first_hop = neighbor
+                else:
+                    neighbor_first_hop = first_hop
+                heapq.heappush(heap, (distance + ddist, counter, neighbor, neighbor_first_hop))
+                counter += 1
+        return dict((target, region_to_hop[target]) for target in target_regions if target in region_to_hop)
+
+
+class RegionLinks:
+    """
+    These are the links between the regions of a level.
+    Each region is linked to every other region in its connected component,
+    but a link object is made only when it is asked for.
+    So the links take space and log lines in proportion to the number of regions rather than its square.
+    """
+    def __init__(self, components=(), player_region=None, safe_regions=()):
+        """
+        @param components: lists of mutually connected regions
+        @param player_region: the player region, or None
+        @param safe_regions: the regions that the player region can reach without suicidal danger
+        """
+        self.components = [list(component) for component in components if len(component) > 1]
+        self.region_to_component = {}
+        for component in self.components:
+            for region in component:
+                self.region_to_component[region] = component
+        self.player_region = player_region
+        self.safe_regions = set(safe_regions)
+        self.pair_to_link = {}
+
+    def get_link(self, r1, r2):
+        """
+        @return: the link from r1 to r2, assuming that they are in the same component
+        """
+        pair = (r1, r2)
+        link = self.pair_to_link.get(pair, None)
+        if link is None:
+            link = RegionLink()
+            link.distance = 10
+            link.region_pair = pair
+            if self.player_region is r1:
+                other = r2
+            elif self.player_region is r2:
+                other = r1
+            else:
+                other = None
+            if other is None:
+                link.danger_level = DANGER_UNKNOWN
+            elif other in self.safe_regions:
+                link.danger_level = DANGER_SAFE
+            else:
+                link.danger_level = DANGER_SUICIDAL
+            self.pair_to_link[pair] = link
+        return link
+
+    def gen_region_links(self, region):
+        """
+        Yield the links from the region to each other region in its component.
+        """
+        for other in self.region_to_component.get(region, ()):
+            if other is not region:
+                yield self.get_link(region, other)
+
+    def is_linked(self, r1, r2):
+        return r1 is not r2 and self.region_to_component.get(r1, None) is self.region_to_component.get(r2, 0)
+
+    def remove_region(self, region):
+        """
+        Remove a region and its links.
+        """
+        component = self.region_to_component.pop(region, None)
+        if component is not None:
+            component.remove(region)
+            if len(component) == 1:
+                del self.region_to_component[component[0]]
+                self.components.remove(component)
+        self.safe_regions.discard(region)
+        if self.player_region is region:
+            self.player_region = None
+        for pair in [pair for pair in self.pair_to_link if region in pair]:
+            del self.pair_to_link[pair]
+
+    def get_signature(self):
+        """
+        @return: something that is equal for equal sets of links
+        """
+        components = frozenset(frozenset(id(region) for region in component) for component in self.components)
+        return (components, id(self.player_region), frozenset(id(region) for region in self.safe_regions))
+
+    def __iter__(self):
+        for component in self.components:
+            for region in component:
+                for other in component:
+                    if other is not region:
+                        yield self.get_link(region, other)
+
+    def __len__(self):
+        return sum(len(component) * (len(component) - 1) for component in self.components)
+
+    def __nonzero__(self):
+        return bool(self.components)
+
+    def __str__(self):
+        lines = []
+        for component in self.components:
+            lines.append('linked regions: ' + ' '.join(str(id(region)) for region in component))
+        if self.player_region is not None:
+            lines.append('safely linked to the player region %d: ' % id(self.player_region) + ' '.join(str(id(region)) for region in self.safe_regions))
+        return '\n'.join(lines)
+
+
+def grid_property(plane_name, doc):
+    """
+    Make a LevelSquare attribute that reads and writes one element of a LevelGrid array.
+    """
+    def fget(square):
+        return getattr(square.grid, plane_name)[square.index]
+    def fset(square, value):
+        getattr(square.grid, plane_name)[square.index] = value
+        square.grid.dirty_locations.add(square.loc)
+    return property(fget, fset, doc=doc)
+
+def grid_flag_property(plane_name, doc):
+    """
+    Make a boolean LevelSquare attribute that reads and writes one element of a LevelGrid array.
+    """
+    def fget(square):
+        return bool(getattr(square.grid, plane_name)[square.index])
+    def fset(square, value):
+        getattr(square.grid, plane_name)[square.index] = bool(value)
+        square.grid.dirty_locations.add(square.loc)
+    return property(fget, fset, doc=doc)
+
+def grid_dict_property(dict_name, doc):
+    """
+    Make a LevelSquare attribute that is usually None and is stored in a LevelGrid dict.
+    """
+    def fget(square):
+        return getattr(square.grid, dict_name).get(square.index, None)
+    def fset(square, value):
+        d = getattr(square.grid, dict_name)
+        if value is None:
+            d.pop(square.index, None)
+        else:
+            d[square.index] = value
+        square.grid.dirty_locations.add(square.loc)
+    return property(fget, fset, doc=doc)
+
+
+class LevelSquare(object):
+    """
+    This is a view of one square of a LevelGrid.
+    It is created on demand and holds no state of its own.
+    """
+    __slots__ = ('grid', 'loc', 'index')
+
+    def __init__(self, grid, loc, index):
+        self.grid = grid
+        self.loc = loc
+        self.index = index
+
+    hard = grid_property('hard', 'what is the type of the square?')
+    graffiti = grid_flag_property('graffiti', 'is graffiti known to be on the square?')
+    trod = grid_flag_property('trod', 'has the square been stepped on by the player?')
+    store = grid_property('store', 'is the square in a store?')
+    search_count_from = grid_property('search_count_from', 'how many searches have been done from this square?')
+    search_count_to = grid_property('search_count_to', 'how many searches have been done to this square?')
+    trap = grid_property('trap', 'what trap is on the square?')
+    monster = grid_dict_property('monster', 'what is the monster history of this square?')
+    item = grid_dict_property('item', 'what is the item history of this square?')
+    boulder = grid_flag_property('boulder', 'is there a boulder on the square?')
+
+    def get_passable_neighbor_locations(self):
+        return self.grid.passable_neighbor_locations[self.index]
+    passable_neighbor_locations = property(get_passable_neighbor_locations,
+            doc='cache the passable neighbor locations for speed')
+
+    def get_large_container_names(self):
+        return self.grid.large_container_names.setdefault(self.index, [])
+    large_container_names = property(get_large_container_names,
+            doc='what are the names of the large containers dropped here?')
+
+
+class LevelGrid:
+    """
+    This is the state of every square of a level.
+    Each attribute is stored in a flat array indexed by (row - row_min) * width + (col - col_min).
+    Attributes that are usually None are stored in dicts keyed by the same index.
+    Looking up a (row, col) location gives a LevelSquare view,
+    so the grid can be used like the dict of squares that it replaces.
+    Writes through a view add the location to the set of dirty locations;
+    code that writes the arrays directly is responsible for doing the same.
+    The passability graph is also kept as one bit mask per direction,
+    where bit i of a mask is set if the square with index i can step to its neighbor in that direction.
+    The passable neighbor locations are derived from the masks.
+    """
+    def __init__(self, rect):
+        self.row_min = rect.row_min
+        self.col_min = rect.col_min
+        self.row_max = rect.row_max
+        self.col_max = rect.col_max
+        self.width = rect.col_max - rect.col_min + 1
+        self.locations = get_shared_locations(rect)
+        n = len(self.locations)
+        self.hard = bytearray([HM_UNKNOWN]) * n
+        self.trap = bytearray([TRAP_UNKNOWN]) * n
+        self.store = bytearray([GM_NONE]) * n
+        self.boulder = bytearray(n)
+        self.trod = bytearray(n)
+        self.graffiti = bytearray(n)
+        self.search_count_from = array('i', [0]) * n
+        self.search_count_to = array('i', [0]) * n
+        self.passable_neighbor_locations = [()] * n
+        self.passable_masks = [0] * len(passable_directions)
+        # this counts changes to the passable neighbor locations,
+        # and the log has the location of each change since the log start generation
+        self.passable_generation = 0
+        self.passable_change_log = []
+        self.passable_change_log_start = 0
+        self.monster = {}
+        self.item = {}
+        self.large_container_names = {}
+        self.dirty_locations = set()
+
+    def get_index(self, loc):
+        row, col = loc
+        return (row - self.row_min) * self.width + (col - self.col_min)
+
+    def note_passable_change(self, loc):
+        self.passable_change_log.append(loc)
+        self.passable_generation += 1
+
+    def get_passable_changes(self, generation):
+        """
+        @param generation: a passable generation no older than the log start generation
+        @return: the set of locations whose passable neighbor locations changed since the generation
+        """
+        return set(self.passable_change_log[generation - self.passable_change_log_start:])
+
+    def forget_passable_changes(self, generation):
+        """
+        Drop the log of changes made before the generation.
+        """
+        del self.passable_change_log[:generation - self.passable_change_log_start]
+        self.passable_change_log_start = generation
+
+    def get_mask(self, locations):
+        """
+        @return: a bit mask with the bit of each location in the grid set
+        """
+        bits = bytearray('0') * len(self.locations)
+        for loc in locations:
+            if loc in self:
+                bits[self.get_index(loc)] = '1'
+        return int(str(bits[::-1]), 2)
+
+    def __getitem__(self, loc):
+        if loc not in self:
+            raise KeyError(loc)
+        return LevelSquare(self, loc, self.get_index(loc))
+
+    def __contains__(self, loc):
+        row, col = loc
+        return self.row_min <= row <= self.row_max and self.col_min <= col <= self.col_max
+
+    def __iter__(self):
+        return iter(self.locations)
+
+    def __len__(self):
+        return len(self.locations)
+
+    def keys(self):
+        return list(self.locations)
+
+    def values(self):
+        return [LevelSquare(self, loc, index) for index, loc in enumerate(self.locations)]
+
+    def items(self):
+        return [(loc, LevelSquare(self, loc, index)) for index, loc in enumerate(self.locations)]
+
+
+# Levels with the same rectangle share these read-only tables.
+shared_locations = {}
+shared_neighbor_locations = {}
+shared_neighbor_locations_ortho = {}
+
+def get_rect_key(rect):
+    return (rect.row_min, rect.col_min, rect.row_max, rect.col_max)
+
+def get_shared_locations(rect):
+    """
+    @return: the row-major tuple of locations in the rectangle
+    """
+    key = get_rect_key(rect)
+    if key not in shared_locations:
+        shared_locations[key] = tuple(rect.gen_locations())
+    return shared_locations[key]
+
+def get_shared_neighbor_locations(rect):
+    """
+    @return: a (neighbor dict, ortho neighbor dict) pair for the rectangle
+    """
+    key = get_rect_key(rect)
+    if key not in shared_neighbor_locations:
+        neighbors = {}
+        ortho_neighbors = {}
+        for loc in rect.gen_locations():
+            neighbors[loc] = tuple(rect.gen_neighbors(loc))
+            ortho_neighbors[loc] = tuple(rect.gen_manhattan_neighbors(loc))
+        shared_neighbor_locations[key] = neighbors
+        shared_neighbor_locations_ortho[key] = ortho_neighbors
+    return shared_neighbor_locations[key], shared_neighbor_locations_ortho[key]
+
+# The passability masks are in the order of Rect.gen_neighbors.
+passable_directions = ((-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1))
+shared_direction_bounds = {}
+
+def get_shared_direction_bounds(rect):
+    """
+    @return: a list with a mask for each direction that has the bits of the squares whose neighbor in that direction is in the rectangle
+    """
+    key = get_rect_key(rect)
+    if key not in shared_direction_bounds:
+        bounds = []
+        for drow, dcol in passable_directions:
+            bits = bytearray('0') * len(get_shared_locations(rect))
+            for index, (row, col) in enumerate(get_shared_locations(rect)):
+                if rect.is_inbounds((row + drow, col + dcol)):
+                    bits[index] = '1'
+            bounds.append(int(str(bits[::-1]), 2))
+        shared_direction_bounds[key] = bounds
+    return shared_direction_bounds[key]
+
+def make_mask_table(values):
+    """
+    @return: a translation table mapping the values to '1' and all other bytes to '0'
+    """
+    table = bytearray('0') * 256
+    for value in values:
+        table[value] = '1'
+    return str(table)
+
+empty_state_mask_table = make_mask_table((HM_OPEN, HM_FLOOR, HM_OCCUPIABLE, HM_ALTAR, HM_UP_CONFIRMED, HM_DOWN_CONFIRMED, HM_UP_UNCONFIRMED, HM_DOWN_UNCONFIRMED))
+open_mask_table = make_mask_table((HM_OPEN,))
+wall_mask_table = make_mask_table((HM_WALL,))
+flag_mask_table = make_mask_table(range(1, 256))
+
+def plane_to_mask(plane, table):
+    """
+    @param plane: a bytearray with a byte for each square
+    @param table: a table from make_mask_table
+    @return: a bit mask with the bit of each square set if its byte is in the table
+    """
+    return int(str(plane.translate(table)[::-1]), 2)
+
+def find_component(parents, index):
+    """
+    Find the root of a union-find tree, halving the path on the way.
+    """
+    while parents[index] != index:
+        parents[index] = parents[parents[index]]
+        index = parents[index]
+    return index
+
+def union_components(parents, index_a, index_b):
+    root_a = find_component(parents, index_a)
+    root_b = find_component(parents, index_b)
+    if root_a != root_b:
+        parents[max(root_a, root_b)] = min(root_a, root_b)
+
+# Each (char, foreground) pair seen on the screen gets a hardmap transition table.
+hardmap_transitions = {}
+
+def make_hardmap_transition(char, foreground):
+    """
+    Classify a screen square for the hardmap.
+    @return: a 256 byte table mapping the old hardmap value of a square to its new value
+    """
+    # By default the old value is kept.
+    transition = bytearray(range(256))
+    value = None
+    protected_values = ()
+    if char == ' ':
+        pass
+    elif char == '.':
+        if foreground:
+            value = HM_OPEN
+        else:
+            value = HM_FLOOR
+    elif char == '{':
+        value = HM_FLOOR
+    elif char == '#':
+        if foreground in (0, 37):
+            value = HM_FLOOR
+        else:
+            value = HM_MISC_OBSTACLE
+    elif char in 'IX':
+        # These monsters might be in walls.
+        pass
+    elif char == '_':
+        value = HM_ALTAR
+    elif char == '<':
+        # This might be a mimic
+        value = HM_UP_UNCONFIRMED
+        protected_values = (HM_UP_CONFIRMED,)
+    elif char == '>':
+        # This might be a mimic
+        value = HM_DOWN_UNCONFIRMED
+        protected_values = (HM_DOWN_CONFIRMED,)
+    elif char in '|-':
+        value = HM_WALL
+    elif char == ']' and foreground == 33:
+        # This might be a mimic
+        # If the door is known to be unlocked or locked then don't change the state
+        value = HM_CLOSED
+        protected_values = (HM_LOCKED, HM_UNLOCKED)
+    elif char == '}':
+        if foreground == 31:
+            value = HM_LAVA
+        elif foreground == 34:
+            value = HM_WATER
+    else:
+        # Assume that any other item means an unknown square is occupiable.
+        # This includes monsters and items.
+        transition[HM_UNKNOWN] = HM_OCCUPIABLE
+    if value is not None:
+        for old_value in range(256):
+            if old_value not in protected_values:
+                transition[old_value] = value
+    return transition
+
+def get_hardmap_transition(char, foreground):
+    """
+    @return: the cached hardmap transition table for a screen square
+    """
+    key = (char, foreground)
+    transition = hardmap_transitions.get(key, None)
+    if transition is None:
+        transition = make_hardmap_transition(char, foreground)
+        hardmap_transitions[key] = transition
+    return transition
 
 
 class Dungeon:
-    def __init__(self):
+    def __init__(self, incremental=False, incremental_self_check=False, distance_cache_size=16):
+        """
+        @param incremental: True if levels should update only the squares that changed each turn
+        @param incremental_self_check: True if each incremental update should be compared to a full rescan
+        @param distance_cache_size: the number of distance fields each level keeps, or 0 to disable the cache
+        """
         self.levels = []
-        self.log = open('dungeon.log', 'w')
-    def remark(self, s):
-        print >> self.log, s
+        self.log = get_channel('dungeon')
+        self.incremental = incremental
+        self.incremental_self_check = incremental_self_check
+        self.distance_cache_size = distance_cache_size
+        self.region_graph = RegionGraph()
+    def remark(self, msg, *args):
+        self.log.remark(msg, *args)
+    def debug(self, msg, *args):
+        self.log.debug(msg, *args)
     def get_doom_fork_level(self):
         doom_fork_levels = []
         for level in self.levels:
@@ -219,31 +742,43 @@ class LevelMap(Rect):
         self.sokoban_queue = None
         self.wall_type = WALL_TYPE_PLAIN
         self.regions = []
-        self.region_links = []
-        self.level = {}
+        self.region_links = RegionLinks()
+        self.level = LevelGrid(self)
         self.cached_interesting_locations = set()
-        self.cached_neighbor_locations = {}
-        self.cached_neighbor_locations_ortho = {}
-        # init level squares
-        for loc in self.gen_locations():
-            square = LevelSquare()
-            square.loc = loc
-            self.level[loc] = square
-        # init cached neighbor locations
-        for loc in self.gen_locations():
-            self.cached_neighbor_locations[loc] = tuple(self.gen_neighbors(loc))
-            self.cached_neighbor_locations_ortho[loc] = tuple(self.gen_manhattan_neighbors(loc))
-
-
-    def remark(self, s):
-        self.dungeon.remark(s)
+        self.cached_neighbor_locations, self.cached_neighbor_locations_ortho = get_shared_neighbor_locations(self)
+        # this is for updating only the squares that changed since the last turn
+        self.incremental = dungeon.incremental
+        self.incremental_self_check = dungeon.incremental_self_check
+        self.incremental_signature = None
+        self.incremental_cursor_location = None
+        self.dirty_locations = self.level.dirty_locations
+        self.screen_keys = None
+        self.monster_char_locations = None
+        self.special_locations = None
+        self.interesting_base = None
+        # this is for reusing distance fields until the passable neighbor locations change
+        self.distance_cache = OrderedDict()
+        self.distance_cache_size = dungeon.distance_cache_size
+        self.distance_cache_hits = 0
+        self.distance_cache_repairs = 0
+        self.distance_cache_misses = 0
+        # this is a union-find forest of the connected components of the passability graph
+        self.component_parents = None
+        self.component_masks = None
+
+
+    def remark(self, msg, *args):
+        self.dungeon.remark(msg, *args)
+
+    def debug(self, msg, *args):
+        self.dungeon.debug(msg, *args)
 
     def init_sokoban(self, ansi, level_name):
         """
         This level has been identified as a sokoban level.
         Initialize the sokoban level name.
         Initialize the queue of boulder pushes that should be executed.
-        @param ansi: the ansi map of the level used to calibrate the sokoban push queue
+        @param ansi: the ansi map of the level used to calibrate the sokoban push queue and to read the boulders and traps
         @param level_name: the name of the sokoban level, e.g. 'level_2b'
         """
         # Make sure that this level is not already initialized as a sokoban level.
@@ -251,46 +786,69 @@ class LevelMap(Rect):
         assert not self.sokoban_queue
         # Initialize the name.
         self.sokoban_name = level_name
-        # Define wall ascii symbols for the purpose of sokoban level detection.
-        sokoban_wall_characters = ('-', '|')
         # Get the set of wall locations on the observed ansi map.
         raw_wall_locations = set()
         for loc in self.level:
             row, col = loc
             ansi_square = ansi.lines[row][col]
-            if ansi_square.char in sokoban_wall_characters:
+            if ansi_square.char in AscSokoban.SOKOBAN_WALL_CHARACTERS:
                 raw_wall_locations.add(loc)
         # If this function was called there had better be some walls to identify.
         assert raw_wall_locations
         # Get the offset of the left and top walls.
         rmin, cmin, rmax, cmax = get_bounding_coordinates(raw_wall_locations)
-        # Get the raw queue of moves for this level.
-        raw_push_queue = AscSokoban.load_push_sequence(level_name)
+        # Get the catalogued level so we can place the traps and boulders.
+        info = AscSokoban.get_catalogue().get_info(level_name)
+        assert info
+        # Read the boulders and traps from the screen, because after a reconnect the level may be partly solved.
+        boulder_locations = set()
+        trap_locations = set()
+        row_min, col_min, row_max, col_max = info.bounding_coordinates
+        for row in range(row_min, row_max + 1):
+            for col in range(col_min, col_max + 1):
+                c = ansi.lines[row + rmin][col + cmin].char
+                if c == '0':
+                    boulder_locations.add((row, col))
+                elif c == '^':
+                    trap_locations.add((row, col))
+        # Each filled trap takes one boulder with it, and no new traps appear.
+        # If something on the screen hides a boulder or a trap then assume that the level is untouched.
+        nextra_boulders = len(info.boulder_locations) - len(info.trap_locations)
+        consistent = trap_locations.issubset(info.trap_locations)
+        consistent = consistent and len(boulder_locations) - len(trap_locations) == nextra_boulders
+        if not consistent:
+            self.remark('WARNING: the boulders and traps of sokoban level %s could not be read from the screen' % level_name)
+            boulder_locations = set(info.boulder_locations)
+            trap_locations = set(info.trap_locations)
+        # Get the raw queue of moves for this configuration of the level.
+        store = AscSokoban.SokoSolutionStore()
+        player_location = (ansi.row - rmin, ansi.col - cmin)
+        raw_push_queue = store.load(level_name, boulder_locations, trap_locations, player_location)
+        # If no moves were recorded for this configuration then search for them and record them for next time.
+        # The search blocks the bot, so it is short; the hard levels are solved offline by AscSokobanSolver -w.
+        if raw_push_queue is None and trap_locations:
+            self.remark('solving sokoban level %s' % level_name)
+            raw_push_queue = AscSokobanSolver.solve_configuration(level_name, boulder_locations, trap_locations, player_location,
+                    max_seconds=AscSokobanSolver.LIVE_MAX_SECONDS)
+            if raw_push_queue is not None:
+                store.save(level_name, boulder_locations, trap_locations, raw_push_queue)
+        if raw_push_queue is None:
+            if trap_locations:
+                self.remark('ERROR: no solution was found for sokoban level %s' % level_name)
+            raw_push_queue = []
         # Convert the queue of moves to account for the position of sokoban within the screen.
         self.sokoban_queue = []
         for player_row, player_col, boulder_row, boulder_col in raw_push_queue:
             args = (player_row + rmin, player_col + cmin, boulder_row + rmin, boulder_col + cmin)
             self.sokoban_queue.append(args)
-        # Get the map representing the level so we can place the traps and boulders.
-        sokomaps = []
-        for sokoban_level_string, sokoban_level_name in AscSokoban.all_level_strings_and_names:
-            if level_name == sokoban_level_name:
-                sokomap = AscSokoban.sokoban_string_to_map(sokoban_level_string)
-                sokomaps.append(sokomap)
-        assert len(sokomaps) == 1
-        sokomap = sokomaps[0]
         # Place the traps on the level.
-        for loc, c in sokomap.items():
-            if c == '^':
-                row, col = loc
-                trap_location = (row + rmin, col + cmin)
-                self.level[trap_location].trap = TRAP_OTHER
+        for row, col in trap_locations:
+            trap_location = (row + rmin, col + cmin)
+            self.level[trap_location].trap = TRAP_OTHER
         # Place the boulders on the level.
-        for loc, c in sokomap.items():
-            if c == '0':
-                row, col = loc
-                boulder_location = (row + rmin, col + cmin)
-                self.level[boulder_location].boulder = True
+        for row, col in boulder_locations:
+            boulder_location = (row + rmin, col + cmin)
+            self.level[boulder_location].boulder = True
 
     def get_sokoban_push_delta(self, current_player_location):
         """
@@ -347,7 +905,7 @@ class LevelMap(Rect):
         Change the item history of the location in this case.
         Arrows and darts are cyan and are represented by the ')' character.
         """
-        ansi_square = AnsiSquare()
+        ansi_square = Square()
         ansi_square.foreground = 36
         ansi_square.char = ')'
         self.level[location].item = ItemHistory(ansi_square)
@@ -358,7 +916,7 @@ class LevelMap(Rect):
         Change the item history of the location in this case.
         Rocks are the default foreground color and are represented by the '*' character.
         """
-        ansi_square = AnsiSquare()
+        ansi_square = Square()
         ansi_square.char = '*'
         self.level[location].item = ItemHistory(ansi_square)
 
@@ -425,8 +983,9 @@ class LevelMap(Rect):
         target_set = set(target_locations)
         command = None
         # Try two levels of safety for the pathing.
-        for safety, taboo_set in (('safely', self.cached_scary_locations), ('unsafely', self.cached_untouchable_locations)):
-            loc_to_dist = self.get_location_evaluations(target_set, taboo_set)
+        taboo_sets = (self.cached_scary_locations, self.cached_untouchable_locations)
+        loc_to_dists = self.get_nested_location_evaluations(target_set, taboo_sets)
+        for safety, loc_to_dist in zip(('safely', 'unsafely'), loc_to_dists):
             command = self.distances_to_command(player_region.location, loc_to_dist)
             if command:
                 self.remark('moving %s across the level towards a staircase to explore' % safety)
@@ -462,8 +1021,9 @@ class LevelMap(Rect):
         if player_region.level is best_neighbor_region.level:
             target_set = set([best_neighbor_region.location])
             # Try two levels of safety for the pathing.
-            for safety, taboo_set in (('safely', self.cached_scary_locations), ('unsafely', self.cached_untouchable_locations)):
-                loc_to_dist = self.get_location_evaluations(target_set, taboo_set)
+            taboo_sets = (self.cached_scary_locations, self.cached_untouchable_locations)
+            loc_to_dists = self.get_nested_location_evaluations(target_set, taboo_sets)
+            for safety, loc_to_dist in zip(('safely', 'unsafely'), loc_to_dists):
                 command = self.distances_to_command(player_region.location, loc_to_dist)
                 if command:
                     self.remark('traveling %s across the map to a better region' % safety)
@@ -481,8 +1041,9 @@ class LevelMap(Rect):
         player_region = self.get_player_region()
         target_set = self.cached_interesting_locations
         # Try two levels of safety for the pathing.
-        for safety, taboo_set in (('safely', self.cached_scary_locations), ('unsafely', self.cached_untouchable_locations)):
-            loc_to_dist = self.get_location_evaluations(target_set, taboo_set)
+        taboo_sets = (self.cached_scary_locations, self.cached_untouchable_locations)
+        loc_to_dists = self.get_nested_location_evaluations(target_set, taboo_sets)
+        for safety, loc_to_dist in zip(('safely', 'unsafely'), loc_to_dists):
             command = self.distances_to_command(player_region.location, loc_to_dist)
             if command:
                 self.remark('traveling %s across the map to an unexplored square' % safety)
@@ -514,8 +1075,9 @@ class LevelMap(Rect):
         if player_region.level is best_neighbor_region.level:
             target_set = set([best_neighbor_region.location])
             # Try two levels of safety for the pathing.
-            for safety, taboo_set in (('safely', self.cached_scary_locations), ('unsafely', self.cached_untouchable_locations)):
-                loc_to_dist = self.get_location_evaluations(target_set, taboo_set)
+            taboo_sets = (self.cached_scary_locations, self.cached_untouchable_locations)
+            loc_to_dists = self.get_nested_location_evaluations(target_set, taboo_sets)
+            for safety, loc_to_dist in zip(('safely', 'unsafely'), loc_to_dists):
                 command = self.distances_to_command(player_region.location, loc_to_dist)
                 if command:
                     self.remark('traveling and %s across the map to a better region' % safety)
@@ -558,8 +1120,9 @@ class LevelMap(Rect):
             self.remark('we are at a good square to search desperately for a secret door')
             return None
         # Try two levels of safety for the pathing.
-        for safety, taboo_set in (('safely', self.cached_scary_locations), ('unsafely', self.cached_untouchable_locations)):
-            loc_to_dist = self.get_location_evaluations(target_set, taboo_set)
+        taboo_sets = (self.cached_scary_locations, self.cached_untouchable_locations)
+        loc_to_dists = self.get_nested_location_evaluations(target_set, taboo_sets)
+        for safety, loc_to_dist in zip(('safely', 'unsafely'), loc_to_dists):
             command = self.distances_to_command(player_region.location, loc_to_dist)
             if command:
                 self.remark('traveling %s across the map to a square to search desperately' % safety)
@@ -617,21 +1180,51 @@ class LevelMap(Rect):
         self.cached_untouchable_locations = self.get_untouchable_locations() - set([player_region.location])
 
     def cache_passable_neighbor_locations(self):
-        empty_states = (HM_OPEN, HM_FLOOR, HM_OCCUPIABLE, HM_ALTAR, HM_UP_CONFIRMED, HM_DOWN_CONFIRMED, HM_UP_UNCONFIRMED, HM_DOWN_UNCONFIRMED)
-        for location, square in self.level.items():
-            # clear the current cache value at this square
-            square.passable_neighbor_locations = []
-            # see if the location itself is even accessible
-            if square.hard not in empty_states:
-                continue
-            for neighbor in self.cached_neighbor_locations[location]:
-                # see if the neighbor is accessible
-                neighbor_square = self.level[neighbor]
-                if neighbor_square.hard not in empty_states:
-                    continue
-                # see if the path between the neighbors is allowed
-                if self.is_passable(location, neighbor):
-                    square.passable_neighbor_locations.append(neighbor)
+        """
+        Rebuild the passability masks from the hardmap and boulders of the whole level,
+        using the same rules as is_passable.
+        The passable neighbor locations are rebuilt only for the squares whose masks changed.
+        """
+        grid = self.level
+        width = grid.width
+        walls = plane_to_mask(grid.hard, wall_mask_table)
+        boulders = plane_to_mask(grid.boulder, flag_mask_table)
+        # these squares can be entered and left
+        free = plane_to_mask(grid.hard, empty_state_mask_table) & ~boulders
+        # open doorways cannot be crossed diagonally
+        diagonal_free = free & ~plane_to_mask(grid.hard, open_mask_table)
+        # these counter-diagonal squares leave a way to squeeze through
+        if self.level_branch == LEVEL_BRANCH_SOKOBAN:
+            # in sokoban levels we cannot squeeze between diagonal boulders
+            squeezable = ~walls & ~boulders
+        else:
+            # in non-sokoban levels we can squeeze between diagonal boulders
+            squeezable = ~walls
+        bounds = get_shared_direction_bounds(self)
+        old_masks = grid.passable_masks
+        new_masks = []
+        changed = 0
+        for direction_index, (drow, dcol) in enumerate(passable_directions):
+            delta = drow * width + dcol
+            if drow and dcol:
+                mask = diagonal_free & shift_mask(diagonal_free, -delta)
+                mask &= shift_mask(squeezable, -dcol) | shift_mask(squeezable, -drow * width)
+            else:
+                mask = free & shift_mask(free, -delta)
+            mask &= bounds[direction_index]
+            new_masks.append(mask)
+            changed |= mask ^ old_masks[direction_index]
+        grid.passable_masks = new_masks
+        if not changed:
+            return
+        n = len(grid)
+        deltas = [drow * width + dcol for drow, dcol in passable_directions]
+        direction_bits = [format(new_mask, 'b').zfill(n)[::-1] for new_mask in new_masks]
+        locations = grid.locations
+        passable_neighbor_locations = grid.passable_neighbor_locations
+        for index in gen_mask_indices(changed):
+            passable_neighbor_locations[index] = tuple(locations[index + delta] for delta, bits in zip(deltas, direction_bits) if bits[index] == '1')
+            grid.note_passable_change(locations[index])
 
     def process_incoming(self, ansi, player_status):
         """
@@ -639,18 +1232,11 @@ class LevelMap(Rect):
         The cursor should be on the player tile.
         """
         cursor_location = (ansi.row, ansi.col)
-        # look at the features of the map if we are not blind
-        if not player_status.blind:
-            self.update_hardmap(ansi)
-        # cache the passable neighbor locations of each square
-        self.cache_passable_neighbor_locations()
-        # look for traps
-        self.update_traps(ansi)
-        # update the monster and item status on the map
-        # it is still useful if blind or hallu
-        self.update_softmap(ansi, player_status)
-        # mark our presence on a square
-        self.level[cursor_location].trod = True
+        # update the squares of the level
+        if self.incremental and self.incremental_signature == self.get_incremental_signature(player_status):
+            self.update_squares_incremental(ansi, player_status)
+        else:
+            self.update_squares(ansi, player_status)
         # update the regions in the level
         self.update_regions(cursor_location)
         # cache squares that we would rather not visit
@@ -665,6 +1251,210 @@ class LevelMap(Rect):
         # update our knowledge of the level type
         self.update_level_type(ansi)
 
+    def update_squares(self, ansi, player_status):
+        """
+        Update every square of the level from the screen.
+        """
+        cursor_location = (ansi.row, ansi.col)
+        # look at the features of the map if we are not blind
+        if not player_status.blind:
+            self.update_hardmap(ansi)
+        # cache the passable neighbor locations of each square
+        self.cache_passable_neighbor_locations()
+        # look for traps
+        self.update_traps(ansi)
+        # update the monster and item status on the map
+        # it is still useful if blind or hallu
+        self.update_softmap(ansi, player_status)
+        # mark our presence on a square
+        self.level[cursor_location].trod = True
+        # prepare for the next incremental update or stop tracking changes
+        if self.incremental:
+            self.reset_incremental_state(ansi, player_status)
+        else:
+            self.special_locations = None
+            self.interesting_base = None
+            self.dirty_locations.clear()
+
+    def update_squares_incremental(self, ansi, player_status):
+        """
+        Update only the squares that changed on the screen or that were changed from outside of the level map,
+        and the squares whose cached state depends on them.
+        The resulting state is the same as that of update_squares.
+        """
+        cursor_location = (ansi.row, ansi.col)
+        # find the squares that look different and the squares whose state was changed since the last turn
+        changed_locations = self.get_changed_screen_locations(ansi)
+        written_locations = set(self.dirty_locations)
+        # the squares around the player are always revisited
+        cursor_locations = set([cursor_location, self.incremental_cursor_location])
+        cursor_locations.update(self.cached_neighbor_locations[cursor_location])
+        cursor_locations.update(self.cached_neighbor_locations[self.incremental_cursor_location])
+        seed_locations = changed_locations | written_locations | cursor_locations
+        # look at the features of the map if we are not blind
+        if not player_status.blind:
+            self.update_hardmap(ansi, changed_locations | written_locations)
+        # the passability masks are cheap enough to rebuild for the whole level
+        self.cache_passable_neighbor_locations()
+        # look for traps
+        self.update_traps(ansi, seed_locations)
+        # update the monster and item status on the map
+        self.update_softmap(ansi, player_status, self.monster_char_locations, seed_locations | self.dirty_locations)
+        # mark our presence on a square
+        cursor_was_trod = self.level[cursor_location].trod
+        self.level[cursor_location].trod = True
+        # update the cached sets that depend on the squares that were changed
+        touched_locations = written_locations | self.dirty_locations
+        self.update_special_locations(touched_locations)
+        self.update_interesting_base(self.get_expanded_locations(touched_locations | seed_locations, 2))
+        self.dirty_locations.clear()
+        self.incremental_cursor_location = cursor_location
+        # optionally compare the result to a full rescan
+        if self.incremental_self_check:
+            self.check_incremental_state(ansi, player_status, cursor_was_trod)
+
+    def get_incremental_signature(self, player_status):
+        """
+        An incremental update is possible only if none of these values changed since the last update.
+        """
+        return (self.level_branch, self.level_special, self.wall_type, player_status.blind, player_status.hallu)
+
+    def get_screen_keys(self, ansi, row):
+        """
+        @return: the list of attributes that matter to the level map for each square in a row of the screen
+        """
+        return [(s.char, s.foreground, s.rev) for s in ansi.lines[row][self.col_min:self.col_max+1]]
+
+    def get_changed_screen_locations(self, ansi):
+        """
+        Compare the map to the copy of the map that was saved during the last update.
+        @return: the set of locations that look different
+        """
+        special_monster_symbols = ":;&@'"
+        changed_locations = set()
+        for row in self.gen_rows():
+            keys = self.get_screen_keys(ansi, row)
+            old_keys = self.screen_keys[row]
+            if keys == old_keys:
+                continue
+            for col, (key, old_key) in enumerate(zip(keys, old_keys)):
+                if key != old_key:
+                    loc = (row, col + self.col_min)
+                    changed_locations.add(loc)
+                    c = key[0]
+                    if c.isalpha() or c in special_monster_symbols:
+                        self.monster_char_locations.add(loc)
+                    else:
+                        self.monster_char_locations.discard(loc)
+            self.screen_keys[row] = keys
+        return changed_locations
+
+    def get_expanded_locations(self, locations, radius):
+        """
+        @return: the set of locations within the given number of steps of a location
+        """
+        expanded_locations = set(locations)
+        shell = expanded_locations
+        for i in range(radius):
+            next_shell = set()
+            for loc in shell:
+                for nloc in self.cached_neighbor_locations[loc]:
+                    if nloc not in expanded_locations:
+                        next_shell.add(nloc)
+            expanded_locations.update(next_shell)
+            shell = next_shell
+        return expanded_locations
+
+    def update_special_locations(self, locations):
+        """
+        Special locations are the only ones that may be scary or untouchable.
+        These are squares with a monster history, store squares, and squares with a known trap.
+        """
+        for loc in locations:
+            square = self.level[loc]
+            if square.monster or square.store in (GM_ENTRANCE, GM_STORE) or square.trap not in (TRAP_NONE, TRAP_UNKNOWN):
+                self.special_locations.add(loc)
+            else:
+                self.special_locations.discard(loc)
+
+    def update_interesting_base(self, locations):
+        """
+        The base set of interesting locations does not include the sokoban target.
+        """
+        secret_doors = self.has_secret_doors()
+        for loc in locations:
+            if self.is_interesting_location(loc, secret_doors):
+                self.interesting_base.add(loc)
+            else:
+                self.interesting_base.discard(loc)
+
+    def reset_incremental_state(self, ansi, player_status):
+        """
+        Save what is needed for the next incremental update after a full update.
+        """
+        special_monster_symbols = ":;&@'"
+        self.screen_keys = {}
+        self.monster_char_locations = set()
+        for row in self.gen_rows():
+            keys = self.get_screen_keys(ansi, row)
+            self.screen_keys[row] = keys
+            for col, key in enumerate(keys):
+                c = key[0]
+                if c.isalpha() or c in special_monster_symbols:
+                    self.monster_char_locations.add((row, col + self.col_min))
+        self.special_locations = set()
+        self.update_special_locations(self.level)
+        self.interesting_base = set()
+        self.update_interesting_base(self.level)
+        self.incremental_signature = self.get_incremental_signature(player_status)
+        self.incremental_cursor_location = (ansi.row, ansi.col)
+        self.dirty_locations.clear()
+
+    def check_incremental_state(self, ansi, player_status, cursor_was_trod):
+        """
+        Compare the incrementally updated level to a full rescan.
+        Differences are remarked as errors.
+        The incremental state is restored afterwards so that the check does not hide its own errors on later turns.
+        @param cursor_was_trod: True if the square of the player had been stepped on before this update
+        """
+        def get_square_state(square):
+            return (square.hard, square.boulder, square.trap, square.monster, square.item, list(square.passable_neighbor_locations))
+        grid = self.level
+        saved_arrays = dict((name, getattr(grid, name)[:]) for name in ('hard', 'trap', 'boulder', 'trod', 'passable_neighbor_locations', 'passable_masks'))
+        saved_dicts = dict((name, dict(getattr(grid, name))) for name in ('monster', 'item'))
+        saved_sets = dict((name, set(getattr(self, name))) for name in ('special_locations', 'interesting_base', 'monster_char_locations'))
+        saved_screen_keys = dict(self.screen_keys)
+        before = dict((loc, get_square_state(square)) for loc, square in grid.items())
+        # The full update would have looked at the square of the player before marking it as trodden,
+        # so it is unmarked for the rescan to see the traps that the incremental update saw.
+        grid.trod[grid.get_index(self.incremental_cursor_location)] = cursor_was_trod
+        self.update_squares(ansi, player_status)
+        bad_locations = [loc for loc, square in grid.items() if get_square_state(square) != before[loc]]
+        if bad_locations:
+            self.remark('ERROR: the incremental update differs from a full rescan at %d squares: %s' % (len(bad_locations), str(sorted(bad_locations))))
+        # Compare the cached location sets to those computed from scratch.
+        special_locations = saved_sets['special_locations']
+        interesting_base = saved_sets['interesting_base']
+        if special_locations != self.special_locations:
+            self.remark('ERROR: the incremental special locations differ from a full rescan: %s' % str(sorted(special_locations ^ self.special_locations)))
+        if interesting_base != self.interesting_base:
+            self.remark('ERROR: the incremental interesting locations differ from a full rescan: %s' % str(sorted(interesting_base ^ self.interesting_base)))
+        # Put back the incremental state, noting the passability changes that this undoes.
+        for index, neighbor_locations in enumerate(saved_arrays['passable_neighbor_locations']):
+            if grid.passable_neighbor_locations[index] != neighbor_locations:
+                grid.note_passable_change(grid.locations[index])
+        # The containers are refilled in place because other objects may hold references to them.
+        for name, values in saved_arrays.items():
+            getattr(grid, name)[:] = values
+        for name, values in saved_dicts.items():
+            getattr(grid, name).clear()
+            getattr(grid, name).update(values)
+        for name, values in saved_sets.items():
+            getattr(self, name).clear()
+            getattr(self, name).update(values)
+        self.screen_keys = saved_screen_keys
+        grid.dirty_locations.clear()
+
     def update_level_type(self, ansi):
         """
         Look at the map to see if that helps us to decide which level type we are on.
@@ -715,9 +1505,11 @@ class LevelMap(Rect):
             region.exploration_danger_level = DANGER_UNKNOWN
         # Try to go to squares that might give exploration information.
         interesting_locations = self.cached_interesting_locations
+        # Both searches are done in a single pass.
+        taboo_sets = (self.cached_untouchable_locations, set())
+        safe_loc_to_dist, suicidal_loc_to_dist = self.get_nested_location_evaluations(interesting_locations, taboo_sets)
         # First look at exploration that can be done without suicidal danger.
-        taboo_set = self.cached_untouchable_locations
-        loc_to_dist = self.get_location_evaluations(interesting_locations, taboo_set)
+        loc_to_dist = safe_loc_to_dist
         for region in self.regions:
             if region.location in loc_to_dist:
                 region.exploration_level = EXP_UNEXPLORED
@@ -726,8 +1518,7 @@ class LevelMap(Rect):
         if len([r for r in self.regions if r.exploration_danger_level == DANGER_SAFE]) == len(self.regions):
             return
         # For the remaining regions try a more dangerous search.
-        taboo_set = set()
-        loc_to_dist = self.get_location_evaluations(interesting_locations, taboo_set)
+        loc_to_dist = suicidal_loc_to_dist
         for region in self.regions:
             if region.exploration_level == EXP_UNKNOWN:
                 if region.location in loc_to_dist:
@@ -739,67 +1530,57 @@ class LevelMap(Rect):
                 region.exploration_level = EXP_EXPLORED
 
 
+    def get_component_parents(self):
+        """
+        Keep a union-find forest whose trees are the connected components of the passable squares.
+        Passages that open are merged into the forest,
+        but the forest is rebuilt when a passage closes because union-find cannot split a component.
+        @return: an array with the parent index of each square index
+        """
+        grid = self.level
+        width = grid.width
+        # Passability is symmetric, so the directions that go forward in the grid suffice.
+        forward = [(mask, drow * width + dcol) for mask, (drow, dcol) in zip(grid.passable_masks, passable_directions) if drow * width + dcol > 0]
+        masks = [mask for mask, delta in forward]
+        parents = self.component_parents
+        if parents is None or any(old_mask & ~mask for old_mask, mask in zip(self.component_masks, masks)):
+            parents = array('i', range(len(grid)))
+            added_masks = masks
+        else:
+            added_masks = [mask & ~old_mask for old_mask, mask in zip(self.component_masks, masks)]
+        for added_mask, (mask, delta) in zip(added_masks, forward):
+            for index in gen_mask_indices(added_mask):
+                union_components(parents, index, index + delta)
+        self.component_parents = parents
+        self.component_masks = masks
+        return parents
+
     def update_region_links(self):
         """
-        Find a path associated with each pair of regions.
-        This is without regard to the danger of the path.
-        Transitivity of links is assumed.
-        Note that this transitivity helps speed but loses distance information.
+        Link each pair of regions that are in the same connected component of the level.
+        This is without regard to the danger of the path,
+        except that the links that include the player region are marked as safe or suicidal.
         """
-        self.region_links = []
-        # add links of unknown danger level
-        linked_regions = []
+        grid = self.level
+        parents = self.get_component_parents()
+        # group the regions by component
+        root_to_regions = {}
         for region in self.regions:
-            # don't bother finding links to the sole unlinked region;
-            # according to transitivity it is not linked to anything.
-            if len(self.regions) == len(linked_regions) + 1:
-                break
-            # don't find links to a region that is already linked;
-            # these links have been taken care of by transitivity
-            if region in linked_regions:
-                continue
-            # find a clump of transitively linked regions
-            contiguous_regions = []
-            interesting_locations = set([region.location])
-            taboo_locations = set()
-            loc_to_dist = self.get_location_evaluations(interesting_locations, taboo_locations)
-            for target in self.regions:
-                if target.location in loc_to_dist:
-                    contiguous_regions.append(target)
-            # link all of the regions in the clump to each other
-            for r1 in contiguous_regions:
-                for r2 in contiguous_regions:
-                    if r1 is not r2:
-                        link = RegionLink()
-                        link.danger_level = DANGER_UNKNOWN
-                        link.distance = 10
-                        link.region_pair = (r1, r2)
-                        self.region_links.append(link)
-            # extend the linked_regions to include the contiguous_regions
-            linked_regions.extend(contiguous_regions)
-        # see which links that include the player region are safe
+            root = find_component(parents, grid.get_index(region.location))
+            root_to_regions.setdefault(root, []).append(region)
+        # see which regions the player region can reach safely
         player_region = self.get_player_region()
         interesting_locations = set([player_region.location])
         taboo_locations = self.cached_untouchable_locations
         loc_to_dist = self.get_location_evaluations(interesting_locations, taboo_locations)
-        for region in self.regions:
-            if region is player_region:
-                continue
-            if region.location in loc_to_dist:
-                for link in self.region_links:
-                    r1, r2 = link.region_pair
-                    if (r1 is player_region and r2 is region) or (r1 is region and r2 is player_region):
-                        link.danger_level = DANGER_SAFE
-        # links that include the player region and that haven't been marked safe are unsafe
-        for link in self.region_links:
-            if player_region in link.region_pair:
-                if link.danger_level == DANGER_UNKNOWN:
-                    link.danger_level = DANGER_SUICIDAL
-        # print the links for debugging
-        self.remark(('region ids on dlvl %d: ' % self.level_dlvl) + ' '.join(str(id(region)) for region in self.regions))
-        self.remark('links:')
-        for link in self.region_links:
-            self.remark(str(link))
+        safe_regions = [region for region in self.regions if region is not player_region and region.location in loc_to_dist]
+        self.region_links = RegionLinks(root_to_regions.values(), player_region, safe_regions)
+        # the region graph remembers neighbors until the links change
+        if self.dungeon.region_graph.notify_region_links(self):
+            # print the links for debugging
+            self.remark(('region ids on dlvl %d: ' % self.level_dlvl) + ' '.join(str(id(region)) for region in self.regions))
+            self.remark(str(self.region_links))
+        self.debug(self.get_distance_cache_summary())
 
     def update_regions(self, cursor_location):
         """
@@ -856,72 +1637,64 @@ class LevelMap(Rect):
         # Update the player region with the current location.
         player_region.location = cursor_location
 
-    def update_traps(self, ansi):
-        for loc, level_square in self.level.items():
+    def update_traps(self, ansi, locations=None):
+        """
+        @param locations: the locations to update, or None to update every location
+        """
+        grid = self.level
+        trod = grid.trod
+        trap = grid.trap
+        if locations is None:
+            locations = grid
+        for loc in locations:
+            index = grid.get_index(loc)
             # if you can see one of these characters,
             # then if you have stepped on the square we will say there is no trap.
             row, col = loc
             ansi_square = ansi.lines[row][col]
             if ansi_square.char in '.#{<>_':
-                if level_square.trod and level_square.trap == TRAP_UNKNOWN:
-                    level_square.trap = TRAP_NONE
+                if trod[index] and trap[index] == TRAP_UNKNOWN:
+                    trap[index] = TRAP_NONE
+                    grid.dirty_locations.add(loc)
 
-    def update_hardmap(self, ansi):
+    def update_hardmap(self, ansi, locations=None):
+        """
+        @param locations: the locations to update, or None to update every location
+        """
         cursor_location = (ansi.row, ansi.col)
+        grid = self.level
+        hard = grid.hard
+        boulders = grid.boulder
+        dirty_locations = grid.dirty_locations
+        track_boulders = (self.level_branch != LEVEL_BRANCH_SOKOBAN)
+        if locations is None:
+            locations = grid.locations
         # Process all locations including the player's location and neighboring locations.
-        for loc, level_square in self.level.items():
+        # Each square is classified by looking up its old value in the transition table for its screen appearance.
+        lines = ansi.lines
+        transitions = hardmap_transitions
+        row_min, col_min, width = grid.row_min, grid.col_min, grid.width
+        for loc in locations:
             row, col = loc
-            ansi_square = ansi.lines[row][col]
-            value = None
-            if ansi_square.char == ' ':
-                pass
-            elif ansi_square.char == '.':
-                if ansi_square.foreground:
-                    value = HM_OPEN
-                else:
-                    value = HM_FLOOR
-            elif ansi_square.char == '{':
-                value = HM_FLOOR
-            elif ansi_square.char == '#':
-                if ansi_square.foreground in (0, 37):
-                    value = HM_FLOOR
-                else:
-                    value = HM_MISC_OBSTACLE
-            elif ansi_square.char in 'IX':
-                # These monsters might be in walls.
-                pass
-            elif ansi_square.char == '_':
-                value = HM_ALTAR
-            elif ansi_square.char == '<':
-                # This might be a mimic
-                if level_square.hard != HM_UP_CONFIRMED:
-                    value = HM_UP_UNCONFIRMED
-            elif ansi_square.char == '>':
-                # This might be a mimic
-                if level_square.hard != HM_DOWN_CONFIRMED:
-                    value = HM_DOWN_UNCONFIRMED
-            elif ansi_square.char in '|-':
-                value = HM_WALL
-            elif ansi_square.char == ']' and ansi_square.foreground == 33:
-                # This might be a mimic
-                # If the door is known to be unlocked or locked then don't change the state
-                if level_square.hard not in (HM_LOCKED, HM_UNLOCKED):
-                    value = HM_CLOSED
-            elif ansi_square.char == '}':
-                if ansi_square.foreground == 31:
-                    value = HM_LAVA
-                elif ansi_square.foreground == 34:
-                    value = HM_WATER
+            index = (row - row_min) * width + (col - col_min)
+            ansi_square = lines[row][col]
+            char = ansi_square.char
+            key = (char, ansi_square.foreground)
+            if key in transitions:
+                transition = transitions[key]
             else:
-                # Assume that any other item means an unknown square is occupiable.
-                # This includes monsters and items.
-                if level_square.hard == HM_UNKNOWN:
-                    value = HM_OCCUPIABLE
-            if value is not None:
-                level_square.hard = value
+                transition = get_hardmap_transition(*key)
+            old_value = hard[index]
+            value = transition[old_value]
+            if value != old_value:
+                hard[index] = value
+                dirty_locations.add(loc)
             # Now deal with boulders on dungeon branches other than sokoban.
-            if self.level_branch != LEVEL_BRANCH_SOKOBAN:
-                level_square.boulder = (ansi_square.char == '0')
+            if track_boulders:
+                boulder = (char == '0')
+                if boulder != boulders[index]:
+                    boulders[index] = boulder
+                    dirty_locations.add(loc)
         # Reprocess locations adjacent to the player.
         neighbor_count = 0
         mapped_neighbor_count = 0
@@ -929,19 +1702,21 @@ class LevelMap(Rect):
             neighbor_count += 1
             row, col = loc
             ansi_square = ansi.lines[row][col]
-            level_square = self.level[loc]
+            index = grid.get_index(loc)
             if ansi_square.char == ' ':
-                if level_square.hard == HM_UNKNOWN:
-                    if not level_square.boulder:
-                        level_square.hard = HM_WALL
+                if hard[index] == HM_UNKNOWN:
+                    if not boulders[index]:
+                        hard[index] = HM_WALL
+                        dirty_locations.add(loc)
                         mapped_neighbor_count += 1
         #self.remark('player location: %s (%d)' % (str(ansi.get_location()), self.level[ansi.get_location()].hard))
         #self.remark('%d of %d neighbors were marked as invisible walls' % (mapped_neighbor_count, neighbor_count))
 
-    def update_softmap(self, ansi, player_status):
+    def update_softmap(self, ansi, player_status, monster_locations=None, item_locations=None):
         """
         Update the item and monster states.
         This function may be called while blind (to detect "I" monsters).
+        The monster and item locations to update default to every location.
 
             )        A weapon of some sort.
             [        A suit or piece of armor.
@@ -959,8 +1734,13 @@ class LevelMap(Rect):
         item_symbols = ')[%/=?!($*+"'
         special_monster_symbols = ":;&@'"
         cursor_location = (ansi.row, ansi.col)
+        if monster_locations is None:
+            monster_locations = self.level
+        if item_locations is None:
+            item_locations = self.level
         # Update the monster history at all locations including the player's location and neighboring locations.
-        for loc, level_square in self.level.items():
+        for loc in monster_locations:
+            level_square = self.level[loc]
             row, col = loc
             ansi_square = ansi.lines[row][col]
             if ansi_square.char.isalpha() or ansi_square.char in special_monster_symbols:
@@ -972,24 +1752,32 @@ class LevelMap(Rect):
                     level_square.monster = MonsterHistory(self.level_time, ansi_square)
         # Update the item history at all locations including the player's location and neighboring locations.
         if (not player_status.blind) and (not player_status.hallu):
-            for loc, level_square in self.level.items():
+            grid = self.level
+            boulders = grid.boulder
+            items = grid.item
+            for loc in item_locations:
+                index = grid.get_index(loc)
                 row, col = loc
                 ansi_square = ansi.lines[row][col]
-                if (not level_square.boulder) and (not ansi_square.char.isalpha()) and (not ansi_square.char in special_monster_symbols):
+                if (not boulders[index]) and (not ansi_square.char.isalpha()) and (not ansi_square.char in special_monster_symbols):
                     # if there is no monster and we know what we are looking for and there is no boulder on the square then update the item history
+                    item = items.get(index, None)
                     if ansi_square.char in item_symbols:
-                        if level_square.item and level_square.item.ansi_square == ansi_square:
+                        if item and item.ansi_square == ansi_square:
                             # if the square already has the known item on it then it is boring
                             pass
                         else:
                             # if the square appears to have a new or different item then it is interesting
-                            level_square.item = ItemHistory(ansi_square)
-                    else:
-                        level_square.item = None
+                            items[index] = ItemHistory(ansi_square)
+                            grid.dirty_locations.add(loc)
+                    elif item:
+                        del items[index]
+                        grid.dirty_locations.add(loc)
         # Clear the monster history of the player's location.
         # Mark the item at the player's location as explored.
         player_square = self.level[cursor_location]
-        player_square.monster = None
+        if player_square.monster:
+            player_square.monster = None
         if player_square.item:
             player_square.item.set_explored()
         # Clear the monster history at adjacent squares if no monster is observed.
@@ -997,18 +1785,21 @@ class LevelMap(Rect):
             row, col = loc
             ansi_square = ansi.lines[row][col]
             if not (ansi_square.char.isalpha() or ansi_square.char in special_monster_symbols):
-                self.level[loc].monster = None
+                if self.level[loc].monster:
+                    self.level[loc].monster = None
 
     def is_dead_end(self, loc):
         """
         Dead ends are common places to find secret doors.
         After exploring a level it might be useful to search for secret doors.
         """
-        if self.level[loc].hard in (HM_FLOOR, HM_OCCUPIABLE, HM_OPEN):
+        grid = self.level
+        hard = grid.hard
+        if hard[grid.get_index(loc)] in (HM_FLOOR, HM_OCCUPIABLE, HM_OPEN):
             wallcount = 0
             ortho_locations = set(self.cached_neighbor_locations_ortho[loc])
             for nloc in ortho_locations:
-                if self.level[nloc].hard == HM_WALL:
+                if hard[grid.get_index(nloc)] == HM_WALL:
                     wallcount += 1
             if wallcount == len(ortho_locations) - 1:
                 return True
@@ -1024,7 +1815,9 @@ class LevelMap(Rect):
         # TODO improve dealing with shopkeepers
         # so the bot can enter a store without getting trapped.
         untouchable_set = set()
-        for loc, square in self.level.items():
+        locations = self.get_special_locations()
+        for loc in locations:
+            square = self.level[loc]
             monster = square.monster
             if monster:
                 if monster.expect_presence(self.level_time):
@@ -1034,11 +1827,19 @@ class LevelMap(Rect):
                 untouchable_set.add(loc)
         # force traps to be untouchable in sokoban
         if self.level_branch == LEVEL_BRANCH_SOKOBAN:
-            for loc, square in self.level.items():
-                if square.trap not in (TRAP_NONE, TRAP_UNKNOWN):
+            for loc in locations:
+                if self.level[loc].trap not in (TRAP_NONE, TRAP_UNKNOWN):
                     untouchable_set.add(loc)
         return untouchable_set
 
+    def get_special_locations(self):
+        """
+        Scary and untouchable locations are found among these locations.
+        """
+        if self.special_locations is None:
+            return self.level
+        return self.special_locations
+
     def get_scary_locations(self):
         """
         These locations are dangerous.
@@ -1046,7 +1847,8 @@ class LevelMap(Rect):
         This set is a superset of untouchable locations.
         """
         scary_set = self.get_untouchable_locations()
-        for loc, square in self.level.items():
+        for loc in self.get_special_locations():
+            square = self.level[loc]
             monster = square.monster
             if square.store in (GM_ENTRANCE, GM_STORE):
                 scary_set.add(loc)
@@ -1075,38 +1877,11 @@ class LevelMap(Rect):
         An unexplored item square is interesting.
         In sokoban the square in front of the next boulder to push is interesting.
         """
-        empty_states = (HM_OPEN, HM_FLOOR, HM_OCCUPIABLE, HM_ALTAR, HM_UP_CONFIRMED, HM_DOWN_CONFIRMED, HM_UP_UNCONFIRMED, HM_DOWN_UNCONFIRMED)
-        interesting_set = set()
-        for loc, square in self.level.items():
-            if square.boulder:
-                continue
-            if square.hard not in empty_states:
-                continue
-            if (square.hard == HM_OPEN) and (not square.trod):
-                interesting_set.add(loc)
-                continue
-            if square.item and (not square.item.is_explored()):
-                interesting_set.add(loc)
-            found_frontier = False
-            for nloc in self.cached_neighbor_locations[loc]:
-                nsquare = self.level[nloc]
-                if nsquare.hard in (HM_CLOSED, HM_UNLOCKED):
-                    found_frontier = True
-                elif nsquare.hard == HM_UNKNOWN:
-                    if not nsquare.boulder:
-                        found_frontier = True
-            for nloc in self.cached_neighbor_locations_ortho[loc]:
-                if self.level[nloc].hard == HM_LOCKED:
-                    if self.get_kickable_status(nloc) != 'unkickable':
-                        found_frontier = True
-            if found_frontier:
-                interesting_set.add(loc)
-        # if we are in a level that might have secret doors then dead ends are interesting.
-        if self.has_secret_doors():
-            for loc, square in self.level.items():
-                if self.is_dead_end(loc):
-                    if square.search_count_from < 27:
-                        interesting_set.add(loc)
+        if self.interesting_base is None:
+            secret_doors = self.has_secret_doors()
+            interesting_set = set(loc for loc in self.level if self.is_interesting_location(loc, secret_doors))
+        else:
+            interesting_set = set(self.interesting_base)
         # In sokoban the square in front of the next boulder to push is interesting.
         if self.level_branch == LEVEL_BRANCH_SOKOBAN:
             if self.sokoban_queue:
@@ -1115,6 +1890,42 @@ class LevelMap(Rect):
                 interesting_set.add(target_player_location)
         return interesting_set
 
+    def is_interesting_location(self, loc, secret_doors):
+        """
+        This is the part of get_interesting_locations that depends only on the squares near the location.
+        @param secret_doors: True if the level might have secret doors
+        """
+        empty_states = (HM_OPEN, HM_FLOOR, HM_OCCUPIABLE, HM_ALTAR, HM_UP_CONFIRMED, HM_DOWN_CONFIRMED, HM_UP_UNCONFIRMED, HM_DOWN_UNCONFIRMED)
+        square = self.level[loc]
+        # if we are in a level that might have secret doors then dead ends are interesting.
+        if secret_doors:
+            if self.is_dead_end(loc):
+                if square.search_count_from < 27:
+                    return True
+        if square.boulder:
+            return False
+        if square.hard not in empty_states:
+            return False
+        if (square.hard == HM_OPEN) and (not square.trod):
+            return True
+        if square.item and (not square.item.is_explored()):
+            return True
+        grid = self.level
+        hard = grid.hard
+        for nloc in self.cached_neighbor_locations[loc]:
+            nindex = grid.get_index(nloc)
+            nhard = hard[nindex]
+            if nhard in (HM_CLOSED, HM_UNLOCKED):
+                return True
+            elif nhard == HM_UNKNOWN:
+                if not grid.boulder[nindex]:
+                    return True
+        for nloc in self.cached_neighbor_locations_ortho[loc]:
+            if hard[grid.get_index(nloc)] == HM_LOCKED:
+                if self.get_kickable_status(nloc) != 'unkickable':
+                    return True
+        return False
+
     def has_secret_doors(self):
         if self.level_special == LEVEL_SPECIAL_MINETOWN:
             if self.wall_type != WALL_TYPE_CAVERN:
@@ -1131,25 +1942,201 @@ class LevelMap(Rect):
         """
         Return a dict mapping a location to the distance from an interesting square.
         If a location is not in the dict, then no path exists.
+        The dict may be shared with other callers, so it must not be modified.
         """
-        shell = interesting_locations - scary_locations
-        loc_to_dist = {}
+        grid = self.level
+        generation = grid.passable_generation
+        if not self.distance_cache_size:
+            grid.forget_passable_changes(generation)
+            return self.compute_location_evaluations(interesting_locations, scary_locations)
+        # The distances depend only on the passable neighbor locations,
+        # which change whenever the hardmap or boulders change passability.
+        # Each cached distance field remembers the generation it was computed for,
+        # and an out of date field is repaired where the passable neighbor locations changed.
+        key = (frozenset(interesting_locations), frozenset(scary_locations))
+        entry = self.distance_cache.pop(key, None)
+        if entry is None:
+            self.distance_cache_misses += 1
+            loc_to_dist = self.compute_location_evaluations(interesting_locations, scary_locations)
+            if len(self.distance_cache) >= self.distance_cache_size:
+                self.distance_cache.popitem(last=False)
+            entry = [generation, loc_to_dist]
+        elif entry[0] != generation:
+            self.distance_cache_repairs += 1
+            changed_locations = grid.get_passable_changes(entry[0])
+            if len(changed_locations) * 8 > len(grid):
+                # So much has changed that starting again is cheaper.
+                entry[1] = self.compute_location_evaluations(interesting_locations, scary_locations)
+            else:
+                self.repair_location_evaluations(entry[1], key[0], key[1], changed_locations)
+            entry[0] = generation
+        else:
+            self.distance_cache_hits += 1
+        # The most recently used distance field goes at the end.
+        self.distance_cache[key] = entry
+        # Only the changes since the oldest cached field are needed.
+        grid.forget_passable_changes(min(cached_generation for cached_generation, d in self.distance_cache.itervalues()))
+        return entry[1]
+
+    def get_nested_location_evaluations(self, interesting_locations, taboo_sets):
+        """
+        Get the distance fields for several nested taboo sets at once.
+        Each taboo set must contain the next one.
+        If any of the fields is not cached then all of them are found in a single search,
+        but only the missing ones are added to the cache and the cached ones are still used.
+        @return: a list with the loc_to_dist dict for each taboo set
+        """
+        if not self.distance_cache_size:
+            return self.compute_nested_location_evaluations(interesting_locations, taboo_sets)
+        frozen_targets = frozenset(interesting_locations)
+        keys = [(frozen_targets, frozenset(taboo_set)) for taboo_set in taboo_sets]
+        if all(key in self.distance_cache for key in keys):
+            return [self.get_location_evaluations(interesting_locations, taboo_set) for taboo_set in taboo_sets]
+        computed_loc_to_dists = self.compute_nested_location_evaluations(interesting_locations, taboo_sets)
+        generation = self.level.passable_generation
+        loc_to_dists = []
+        for key, taboo_set, loc_to_dist in zip(keys, taboo_sets, computed_loc_to_dists):
+            if key in self.distance_cache:
+                loc_to_dists.append(self.get_location_evaluations(interesting_locations, taboo_set))
+                continue
+            self.distance_cache_misses += 1
+            if len(self.distance_cache) >= self.distance_cache_size:
+                self.distance_cache.popitem(last=False)
+            self.distance_cache[key] = [generation, loc_to_dist]
+            loc_to_dists.append(loc_to_dist)
+        self.level.forget_passable_changes(min(cached_generation for cached_generation, d in self.distance_cache.itervalues()))
+        return loc_to_dists
+
+    def compute_nested_location_evaluations(self, interesting_locations, taboo_sets):
+        """
+        This is a breadth first search that finds the distances for several nested taboo sets in one pass.
+        The shells of the searches for all of the taboo sets are advanced together,
+        each by shifting its bit mask along the passability masks.
+        Each taboo set must contain the next one, so a less strict search reaches every square
+        at the same depth as the stricter search or sooner.
+        Only the squares of a shell that are not in the stricter shell of the same depth get a dict entry of their own,
+        and the rest of each field is copied from the field of the stricter taboo set.
+        @return: a list with the loc_to_dist dict for each taboo set, as compute_location_evaluations would give
+        """
+        grid = self.level
+        locations = grid.locations
+        width = grid.width
+        steps = [(mask, drow * width + dcol) for mask, (drow, dcol) in zip(grid.passable_masks, passable_directions)]
+        target_mask = grid.get_mask(interesting_locations)
+        # the entries of each field that differ from the field of the stricter taboo set
+        differences = []
+        allowed_masks = []
+        shells = []
+        visited_masks = []
+        stricter_shell = 0
+        for taboo_set in taboo_sets:
+            allowed = ~grid.get_mask(taboo_set)
+            shell = target_mask & allowed
+            difference = {}
+            for index in gen_mask_indices(shell & ~stricter_shell):
+                difference[locations[index]] = 0
+            differences.append(difference)
+            allowed_masks.append(allowed)
+            shells.append(shell)
+            visited_masks.append(shell)
+            stricter_shell = shell
         depth = 0
-        for loc in shell:
-            loc_to_dist[loc] = depth
-        while shell:
+        while any(shells):
             depth += 1
-            next_shell = set()
-            for loc in shell:
-                square = self.level[loc]
-                for nloc in square.passable_neighbor_locations:
-                    if nloc in scary_locations:
-                        continue
-                    if nloc not in loc_to_dist:
-                        next_shell.add(nloc)
-                        loc_to_dist[nloc] = depth
-            shell = next_shell
-        return loc_to_dist
+            stricter_shell = 0
+            for taboo_index, shell in enumerate(shells):
+                if shell:
+                    next_shell = 0
+                    for mask, delta in steps:
+                        next_shell |= shift_mask(shell & mask, delta)
+                    next_shell &= allowed_masks[taboo_index] & ~visited_masks[taboo_index]
+                    visited_masks[taboo_index] |= next_shell
+                    shells[taboo_index] = next_shell
+                    difference = differences[taboo_index]
+                    for index in gen_mask_indices(next_shell & ~stricter_shell):
+                        difference[locations[index]] = depth
+                stricter_shell = shells[taboo_index]
+        loc_to_dists = [differences[0]]
+        for difference in differences[1:]:
+            loc_to_dist = dict(loc_to_dists[-1])
+            loc_to_dist.update(difference)
+            loc_to_dists.append(loc_to_dist)
+        return loc_to_dists
+
+    def repair_location_evaluations(self, loc_to_dist, interesting_locations, scary_locations, changed_locations):
+        """
+        Update a distance field in place after the passable neighbor locations of some squares changed.
+        First the squares whose distances may have depended on a lost path are removed,
+        then distances are relaxed outwards from the squares bordering the changes.
+        @param changed_locations: the locations whose passable neighbor locations changed
+        """
+        grid = self.level
+        passable_neighbor_locations = grid.passable_neighbor_locations
+        get_index = grid.get_index
+        neighbor_locations = self.cached_neighbor_locations
+        sources = interesting_locations - scary_locations
+        # A lost path can only lead from a changed square to one of its neighbors.
+        candidates = set(changed_locations)
+        for loc in changed_locations:
+            candidates.update(neighbor_locations[loc])
+        # Remove each square that no longer has a neighbor one step closer to a source.
+        removed = set()
+        while candidates:
+            loc = candidates.pop()
+            if loc in sources or loc not in loc_to_dist:
+                continue
+            supporting_dist = loc_to_dist[loc] - 1
+            supported = False
+            for nloc in neighbor_locations[loc]:
+                if loc_to_dist.get(nloc, None) == supporting_dist:
+                    if loc in passable_neighbor_locations[get_index(nloc)]:
+                        supported = True
+                        break
+            if not supported:
+                del loc_to_dist[loc]
+                removed.add(loc)
+                for nloc in passable_neighbor_locations[get_index(loc)]:
+                    if nloc in loc_to_dist:
+                        candidates.add(nloc)
+        # Relax distances outwards from the remaining squares next to removed or changed squares.
+        frontier = []
+        for loc in removed:
+            for nloc in neighbor_locations[loc]:
+                if nloc in loc_to_dist:
+                    frontier.append((loc_to_dist[nloc], nloc))
+        for loc in changed_locations:
+            if loc in loc_to_dist:
+                frontier.append((loc_to_dist[loc], loc))
+        heapq.heapify(frontier)
+        while frontier:
+            dist, loc = heapq.heappop(frontier)
+            if loc_to_dist[loc] != dist:
+                continue
+            for nloc in passable_neighbor_locations[get_index(loc)]:
+                if nloc in scary_locations:
+                    continue
+                if loc_to_dist.get(nloc, dist + 2) > dist + 1:
+                    loc_to_dist[nloc] = dist + 1
+                    heapq.heappush(frontier, (dist + 1, nloc))
+
+    def get_distance_cache_summary(self):
+        """
+        @return: a string describing the effectiveness of the distance field cache
+        """
+        total = self.distance_cache_hits + self.distance_cache_repairs + self.distance_cache_misses
+        if total:
+            percent = (100.0 * (self.distance_cache_hits + self.distance_cache_repairs)) / total
+        else:
+            percent = 0.0
+        return 'distance cache: %d hits, %d repairs, %d misses (%.1f%% reused), %d of %d entries' % (
+                self.distance_cache_hits, self.distance_cache_repairs, self.distance_cache_misses, percent,
+                len(self.distance_cache), self.distance_cache_size)
+
+    def compute_location_evaluations(self, interesting_locations, scary_locations):
+        """
+        This is the breadth first search that get_location_evaluations caches.
+        """
+        return self.compute_nested_location_evaluations(interesting_locations, (scary_locations,))[0]
 
     def is_passable(self, loca, locb):
         """
@@ -1160,43 +2147,49 @@ class LevelMap(Rect):
            That is, they should be exactly one square away from each other.
         """
         empty_states = (HM_OPEN, HM_FLOOR, HM_OCCUPIABLE, HM_ALTAR, HM_UP_CONFIRMED, HM_DOWN_CONFIRMED, HM_UP_UNCONFIRMED, HM_DOWN_UNCONFIRMED)
+        grid = self.level
+        hard = grid.hard
+        boulder = grid.boulder
+        width = grid.width
         rowa, cola = loca
         rowb, colb = locb
+        index_a = grid.get_index(loca)
+        index_b = index_a + (rowb - rowa) * width + (colb - cola)
         # check the first location for passability
-        square_a = self.level[loca]
-        if square_a.hard not in empty_states:
+        hard_a = hard[index_a]
+        if hard_a not in empty_states:
             return False
-        if square_a.boulder:
+        if boulder[index_a]:
             return False
         # check the second location for passability
-        square_b = self.level[locb]
-        if square_b.hard not in empty_states:
+        hard_b = hard[index_b]
+        if hard_b not in empty_states:
             return False
-        if square_b.boulder:
+        if boulder[index_b]:
             return False
         # check for passage orthogonality
         if rowa == rowb or cola == colb:
             return True
         # cannot cross an open doorway diagonally
-        if square_a.hard == HM_OPEN or square_b.hard == HM_OPEN:
+        if hard_a == HM_OPEN or hard_b == HM_OPEN:
             return False
         # check the two counter-diagonal squares for a way to squeeze through
-        mloca_square = self.level[(rowa, colb)]
-        mlocb_square = self.level[(rowb, cola)]
+        index_ma = index_a + (colb - cola)
+        index_mb = index_a + (rowb - rowa) * width
         if self.level_branch == LEVEL_BRANCH_SOKOBAN:
             # in sokoban levels we cannot squeeze between diagonal boulders
-            if (mloca_square.hard != HM_WALL) and (not mloca_square.boulder):
+            if (hard[index_ma] != HM_WALL) and (not boulder[index_ma]):
                 return True
-            if (mlocb_square.hard != HM_WALL) and (not mlocb_square.boulder):
+            if (hard[index_mb] != HM_WALL) and (not boulder[index_mb]):
                 return True
         else:
             # in non-sokoban levels we can squeeze between diagonal boulders
-            if mloca_square.hard != HM_WALL:
+            if hard[index_ma] != HM_WALL:
                 return True
-            if mlocb_square.hard != HM_WALL:
+            if hard[index_mb] != HM_WALL:
                 return True
         return False
-    
+
     def get_pickable_status(self, loc):
         """
         This returns whether or not we should pick a locked door at a given location.
@@ -0,0 +1,489 @@
+"""
+Buffered logging with levels and lazy formatting.
+
+A record is only a tuple until it is written.
+Records below the level of their logger are dropped without being formatted,
+and the others are formatted and written by a background thread.
+A logger can also write binary records that are formatted only when they are read.
+
+The bot modules share one sink with a level for each module,
+rate limiting of frequent messages, and a ring buffer of recent records
+that is written out only after an error or when the bot seems stuck.
+"""
+
+import atexit
+import marshal
+from pprint import pformat
+import struct
+import sys
+import threading
+import time
+from collections import deque
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+LEVEL_NAMES = {DEBUG: 'debug', INFO: 'info', WARNING: 'warning', ERROR: 'error'}
+
+BINARY_LOG_MAGIC = 'ASCL'
+BINARY_LOG_VERSION = 1
+# magic, version
+BINARY_HEADER_FORMAT = '<4sB'
+# seconds since the epoch, level, payload length
+BINARY_RECORD_FORMAT = '<dBI'
+
+# the seconds between flushes of the background thread
+FLUSH_INTERVAL = 1.0
+# wake the background thread early when a logger has this many records waiting
+MAX_BUFFERED_RECORDS = 10000
+
+# the log file of the shared sink
+SINK_FILENAME = 'bot.log'
+# the number of recent records that a sink keeps for dumping
+RING_SIZE = 2000
+# each message may be written this many times per rate period before it is suppressed
+RATE_LIMIT = 20
+RATE_PERIOD = 10.0
+# forget the rate periods that have ended when this many messages are being tracked
+MAX_RATE_KEYS = 10000
+
+
+class PrettyValue:
+    """
+    This defers the pretty printing of a value until its record is written.
+    """
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return pformat(self.value)
+
+
+def get_level(name):
+    """
+    @param name: a level name such as 'debug'
+    @return: the level
+    """
+    for level, level_name in LEVEL_NAMES.items():
+        if level_name == name.lower():
+            return level
+    raise ValueError('unknown log level: %s' % name)
+
+def format_message(msg, args):
+    if not args:
+        return msg
+    try:
+        return msg % args
+    except TypeError:
+        return '%s %r' % (msg, args)
+
+def get_prefix_level(line):
+    """
+    @return: the level of a line of text, judged by whether it starts with ERROR or WARNING
+    """
+    if line.startswith('ERROR'):
+        return ERROR
+    elif line.startswith('WARNING'):
+        return WARNING
+    return INFO
+
+def get_binary_args(args):
+    """
+    @return: the arguments in a form that marshal can save
+    """
+    values = tuple(arg.value if isinstance(arg, PrettyValue) else arg for arg in args)
+    try:
+        marshal.dumps(values)
+    except ValueError:
+        values = tuple(repr(value) for value in values)
+    return values
+
+
+class Logger:
+    def __init__(self, filename, level=INFO, binary=False):
+        """
+        The file is not opened until the first record is written,
+        so the level and format can be changed after the logger is created.
+        @param filename: the name of the file to append to
+        @param level: records below this level are dropped
+        @param binary: True to write binary records instead of text
+        """
+        self.filename = filename
+        self.level = level
+        self.binary = binary
+        self.fout = None
+        self.records = deque()
+        self.lock = threading.Lock()
+
+    def set_level(self, level):
+        self.level = level
+
+    def set_binary(self, binary):
+        assert self.fout is None, 'the format cannot change after the log is opened'
+        self.binary = binary
+
+    def is_enabled_for(self, level):
+        return level >= self.level
+
+    def log(self, level, msg, *args):
+        """
+        @param level: the level of the record
+        @param msg: the message, which is formatted with the arguments only when it is written
+        """
+        if level < self.level:
+            return
+        self.add_record(time.time(), level, msg, args)
+
+    def add_record(self, seconds, level, msg, args):
+        self.records.append((seconds, level, msg, args))
+        if len(self.records) > MAX_BUFFERED_RECORDS:
+            flusher.wake()
+
+    def debug(self, msg, *args):
+        self.log(DEBUG, msg, *args)
+
+    def info(self, msg, *args):
+        self.log(INFO, msg, *args)
+
+    def warning(self, msg, *args):
+        self.log(WARNING, msg, *args)
+
+    def error(self, msg, *args):
+        self.log(ERROR, msg, *args)
+
+    def open(self):
+        if self.binary:
+            fout = open(self.filename, 'ab+')
+            fout.seek(0)
+            magic = fout.read(len(BINARY_LOG_MAGIC))
+            if not magic:
+                fout.write(struct.pack(BINARY_HEADER_FORMAT, BINARY_LOG_MAGIC, BINARY_LOG_VERSION))
+            elif magic != BINARY_LOG_MAGIC:
+                fout.close()
+                raise ValueError('%s already has records that are not binary' % self.filename)
+            self.fout = fout
+        else:
+            self.fout = open(self.filename, 'a')
+
+    def flush(self):
+        """
+        Format and write the waiting records.
+        """
+        if not self.records:
+            return
+        self.lock.acquire()
+        try:
+            if self.fout is None:
+                self.open()
+            chunks = []
+            while True:
+                try:
+                    seconds, level, msg, args = self.records.popleft()
+                except IndexError:
+                    break
+                if self.binary:
+                    payload = marshal.dumps((msg, get_binary_args(args)))
+                    chunks.append(struct.pack(BINARY_RECORD_FORMAT, seconds, level, len(payload)))
+                    chunks.append(payload)
+                else:
+                    line = format_message(msg, args)
+                    chunks.append(time.asctime(time.localtime(seconds)) + ': ' + line + '\n')
+            self.fout.write(''.join(chunks))
+            self.fout.flush()
+        finally:
+            self.lock.release()
+
+
+class Flusher:
+    """
+    Flush every logger from a background thread.
+    """
+    def __init__(self):
+        self.loggers = {}
+        self.event = threading.Event()
+        self.thread = None
+        self.stopped = False
+
+    def add_logger(self, logger):
+        self.loggers[logger.filename] = logger
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run)
+            self.thread.setDaemon(True)
+            self.thread.start()
+
+    def wake(self):
+        self.event.set()
+
+    def flush(self):
+        for logger in self.loggers.values():
+            try:
+                logger.flush()
+            except (IOError, ValueError), e:
+                print >> sys.stderr, 'failed to write %s: %s' % (logger.filename, e)
+
+    def reset_after_fork(self):
+        """
+        Forget the records that the parent process will write, and start a background thread for this process.
+        """
+        for logger in self.loggers.values():
+            logger.records.clear()
+            logger.fout = None
+            logger.lock = threading.Lock()
+        self.event = threading.Event()
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop the background thread and then write what is left.
+        This runs at exit, before the interpreter tears down the modules that a running thread would still use.
+        """
+        self.stopped = True
+        self.event.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.flush()
+
+    def run(self):
+        while not self.stopped:
+            self.event.wait(FLUSH_INTERVAL)
+            self.event.clear()
+            self.flush()
+
+flusher = Flusher()
+atexit.register(flusher.stop)
+
+def get_logger(filename, level=INFO, binary=False):
+    """
+    @param filename: the name of the log file
+    @return: the logger for the file, which is created with the given level and format if necessary
+    """
+    logger = flusher.loggers.get(filename)
+    if logger is None:
+        logger = Logger(filename, level, binary)
+        flusher.add_logger(logger)
+    return logger
+
+
+
+class LogSink:
+    """
+    Collect the records of every module in one log.
+    Each module has its own level, and a message that is written too often is suppressed for a while.
+    The latest records of every level are kept in a ring buffer
+    and written out after an error or when the bot seems stuck.
+    Records in the ring buffer are formatted when they are dumped,
+    so their arguments show the state they have at that time.
+    """
+    def __init__(self, logger, default_level=INFO, ring_size=RING_SIZE, rate_limit=RATE_LIMIT, rate_period=RATE_PERIOD):
+        """
+        @param logger: the logger to write to; the sink does its own filtering
+        @param default_level: the level of modules that have no level of their own
+        @param ring_size: the number of recent records to keep for dumping
+        @param rate_limit: the number of times a message may be written in each rate period
+        @param rate_period: the length of a rate period in seconds
+        """
+        self.logger = logger
+        self.logger.set_level(DEBUG)
+        self.default_level = default_level
+        self.module_levels = {}
+        self.ring = deque(maxlen=ring_size)
+        self.rate_limit = rate_limit
+        self.rate_period = rate_period
+        # (module, message key) -> [start of the rate period, records written, records suppressed]
+        self.rates = {}
+        self.channels = {}
+
+    def set_default_level(self, level):
+        self.default_level = level
+
+    def set_level(self, module, level):
+        self.module_levels[module] = level
+
+    def get_level(self, module):
+        return self.module_levels.get(module, self.default_level)
+
+    def set_levels(self, spec):
+        """
+        @param spec: a level such as 'info' for every module, followed by module levels such as 'dungeon=debug', separated by commas
+        """
+        for item in spec.split(','):
+            if '=' in item:
+                module, name = item.split('=')
+                self.set_level(module.strip(), get_level(name.strip()))
+            elif item.strip():
+                self.set_default_level(get_level(item.strip()))
+
+    def get_channel(self, module):
+        """
+        @return: the file-like channel of the module
+        """
+        channel = self.channels.get(module)
+        if channel is None:
+            channel = LogChannel(self, module)
+            self.channels[module] = channel
+        return channel
+
+    def is_rate_limited(self, module, key, now):
+        if len(self.rates) > MAX_RATE_KEYS:
+            self.rates = dict((k, rate) for k, rate in self.rates.items() if now - rate[0] < self.rate_period)
+        rate = self.rates.get((module, key))
+        if rate is None or now - rate[0] >= self.rate_period:
+            if rate and rate[2]:
+                self.logger.add_record(now, INFO, '%s: suppressed %d records like: %s', (module, rate[2], key))
+            self.rates[(module, key)] = [now, 1, 0]
+            return False
+        if rate[1] < self.rate_limit:
+            rate[1] += 1
+            return False
+        rate[2] += 1
+        return True
+
+    def add_record(self, module, level, msg, args, key):
+        """
+        @param key: the part of the message that identifies it for rate limiting
+        """
+        now = time.time()
+        self.ring.append((now, level, module, msg, args))
+        if level < self.get_level(module):
+            return
+        if level < ERROR and self.is_rate_limited(module, key, now):
+            return
+        self.logger.add_record(now, level, module + ': ' + msg, args)
+        if level >= ERROR:
+            self.dump('of an error in %s' % module)
+
+    def log(self, module, level, msg, *args):
+        self.add_record(module, level, msg, args, msg)
+
+    def dump(self, reason):
+        """
+        Write out the records in the ring buffer, whatever their level.
+        @param reason: why the records are dumped
+        """
+        records = list(self.ring)
+        self.ring.clear()
+        self.logger.add_record(time.time(), WARNING, 'dumping the last %d records because %s', (len(records), reason))
+        for seconds, level, module, msg, args in records:
+            self.logger.add_record(seconds, level, 'dump: ' + module + ': ' + msg, args)
+        self.logger.add_record(time.time(), WARNING, 'end of the dump', ())
+
+
+class LogChannel:
+    """
+    This is the part of a sink that belongs to one module.
+    It can be used like a file with print, in which case
+    each line is a record whose level depends on whether it starts with ERROR or WARNING,
+    and the first thing printed on the line identifies it for rate limiting.
+    """
+    def __init__(self, sink, module):
+        self.sink = sink
+        self.module = module
+        self.parts = []
+
+    def write(self, data):
+        self.parts.append(data)
+        if data.endswith('\n'):
+            parts = self.parts
+            self.parts = []
+            line = ''.join(parts)[:-1]
+            self.sink.add_record(self.module, get_prefix_level(line), line, (), parts[0])
+
+    def flush(self):
+        # the sink decides when records are written
+        pass
+
+    def is_enabled_for(self, level):
+        return level >= self.sink.get_level(self.module)
+
+    def log(self, level, msg, *args):
+        self.sink.add_record(self.module, level, msg, args, msg)
+
+    def debug(self, msg, *args):
+        self.sink.add_record(self.module, DEBUG, msg, args, msg)
+
+    def info(self, msg, *args):
+        self.sink.add_record(self.module, INFO, msg, args, msg)
+
+    def warning(self, msg, *args):
+        self.sink.add_record(self.module, WARNING, msg, args, msg)
+
+    def error(self, msg, *args):
+        self.sink.add_record(self.module, ERROR, msg, args, msg)
+
+    def remark(self, msg, *args):
+        """
+        Log a message whose level depends on whether it starts with ERROR or WARNING.
+        """
+        self.sink.add_record(self.module, get_prefix_level(msg), msg, args, msg)
+
+    def dump(self, reason):
+        self.sink.dump(reason)
+
+
+sink = None
+
+def get_sink():
+    """
+    @return: the sink that the bot modules share
+    """
+    global sink
+    if sink is None:
+        sink = LogSink(get_logger(SINK_FILENAME, DEBUG))
+    return sink
+
+def reset_after_fork(sink_filename=SINK_FILENAME):
+    """
+    Call this in a new process so that it flushes its own records and has its own sink.
+    @param sink_filename: the log file of the sink of the new process
+    """
+    global sink
+    flusher.reset_after_fork()
+    sink = LogSink(get_logger(sink_filename, DEBUG))
+
+def get_channel(module):
+    """
+    @return: the channel of a module in the shared sink
+    """
+    return get_sink().get_channel(module)
+
+def read_binary_log(filename):
+    """
+    @param filename: the name of a binary log file
+    @return: a list of (seconds, level, message) triples
+    """
+    fin = open(filename, 'rb')
+    data = fin.read()
+    fin.close()
+    header_size = struct.calcsize(BINARY_HEADER_FORMAT)
+    record_size = struct.calcsize(BINARY_RECORD_FORMAT)
+    magic, version = struct.unpack_from(BINARY_HEADER_FORMAT, data)
+    if magic != BINARY_LOG_MAGIC:
+        raise ValueError('this is not a binary log file')
+    if version != BINARY_LOG_VERSION:
+        raise ValueError('unsupported binary log version: %d' % version)
+    records = []
+    offset = header_size
+    while offset + record_size <= len(data):
+        seconds, level, length = struct.unpack_from(BINARY_RECORD_FORMAT, data, offset)
+        offset += record_size
+        if offset + length > len(data):
+            break
+        msg, args = marshal.loads(data[offset:offset+length])
+        offset += length
+        records.append((seconds, level, format_message(msg, args)))
+    return records
+
+def main():
+    if len(sys.argv) != 2:
+        print 'usage: %s binary-log' % sys.argv[0]
+        return
+    for seconds, level, message in read_binary_log(sys.argv[1]):
+        print '%s: %s: %s' % (time.asctime(time.localtime(seconds)), LEVEL_NAMES.get(level, level), message)
+
+if __name__ == '__main__':
+    main()
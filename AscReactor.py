@@ -0,0 +1,251 @@
+"""
+Drive many telnet sessions from a single select loop.
+
+Each session owns one connection and the layers on top of its Telnet object.
+When a connection breaks the session reconnects with exponential backoff,
+so that dozens of accounts can be played from one process.
+"""
+
+import errno
+import select
+import socket
+import time
+import traceback
+
+from AscTelnet import STATE_WANT_TO_SEND_DATA
+from AscTelnet import STATE_WAITING_FOR_DATA
+from AscTelnet import STATE_WANT_TO_SEND_PING
+from AscTelnet import STATE_WAITING_FOR_DATA_AND_PONG
+
+# these socket errors mean that the operation should be tried again later
+RETRY_ERRNOS = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+CONNECTING_ERRNOS = (errno.EINPROGRESS, errno.EALREADY, errno.EWOULDBLOCK)
+
+
+def set_nodelay(sock):
+    """
+    Each command is a complete message, so do not let Nagle's algorithm hold it back.
+    """
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+def send_buffers(sock, buffers):
+    """
+    Send the buffers with one system call.
+    Python 2 sockets have no sendmsg, so the buffers are always joined into one string,
+    which is cheap for commands and pings.
+    @param sock: a connected socket
+    @param buffers: a nonempty list of strings or buffers
+    @return: the number of bytes sent
+    """
+    if len(buffers) == 1:
+        return sock.send(buffers[0])
+    return sock.send(''.join(map(str, buffers)))
+
+
+class Session:
+    """
+    A connection to the server and the layers that play over it.
+    """
+    def __init__(self, address, make_layers, name='session', log=None,
+            min_backoff=1.0, max_backoff=300.0, idle_timeout=60.0):
+        """
+        @param address: the (host, port) of the telnet server
+        @param make_layers: a function that returns a new (telnet, bot) pair for each connection
+        @param name: a name for logging
+        @param log: a file for logging, or None
+        @param min_backoff: the seconds to wait before the first reconnection attempt
+        @param max_backoff: the most seconds to wait between reconnection attempts
+        @param idle_timeout: the seconds without progress after which the connection is dropped
+        """
+        self.address = address
+        self.make_layers = make_layers
+        self.name = name
+        self.log = log
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.idle_timeout = idle_timeout
+        self.sock = None
+        self.telnet = None
+        self.bot = None
+        self.connecting = False
+        self.finished = False
+        self.backoff = min_backoff
+        self.reconnect_time = 0
+        self.last_progress_time = None
+        self.nconnections = 0
+        self.ncrashes = 0
+
+    def remark(self, message):
+        if self.log:
+            print >> self.log, '%s %s: %s' % (time.asctime(), self.name, message)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def is_connected(self):
+        return self.sock is not None
+
+    def connect(self, now):
+        self.telnet, self.bot = self.make_layers()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(0)
+        set_nodelay(sock)
+        err = sock.connect_ex(self.address)
+        if err and err not in CONNECTING_ERRNOS:
+            sock.close()
+            self.remark('failed to connect: %s' % errno.errorcode.get(err, err))
+            self.schedule_reconnect(now)
+            return
+        self.sock = sock
+        self.connecting = True
+        self.last_progress_time = now
+        self.nconnections += 1
+        self.remark('connecting (attempt %d)' % self.nconnections)
+
+    def disconnect(self, now, reason):
+        self.remark('disconnected: %s' % reason)
+        if self.telnet.get_smoothed_rtt() is not None:
+            self.remark('round trip time: %.3f seconds' % self.telnet.get_smoothed_rtt())
+        if self.sock is not None:
+            self.sock.close()
+        # a connection that was never established is always retried
+        played = not self.connecting
+        self.sock = None
+        self.connecting = False
+        if played and not self.bot.loops_forever():
+            self.remark('the bot does not want to loop forever')
+            self.finished = True
+        else:
+            self.schedule_reconnect(now)
+
+    def schedule_reconnect(self, now):
+        self.reconnect_time = now + self.backoff
+        self.remark('reconnecting in %.1f seconds' % self.backoff)
+        self.backoff = min(self.backoff * 2, self.max_backoff)
+
+    def wants_to_read(self):
+        if self.connecting:
+            return False
+        return self.telnet.network_state in (STATE_WAITING_FOR_DATA, STATE_WAITING_FOR_DATA_AND_PONG)
+
+    def wants_to_write(self):
+        if self.connecting:
+            return True
+        return self.telnet.network_state in (STATE_WANT_TO_SEND_DATA, STATE_WANT_TO_SEND_PING)
+
+    def notify_writable(self, now):
+        if self.connecting:
+            err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                self.disconnect(now, 'connection failed: %s' % errno.errorcode.get(err, err))
+                return
+            self.connecting = False
+            self.remark('connected')
+            return
+        buffers = self.telnet.get_pending_buffers()
+        if not buffers:
+            # there is nothing to send, so the telnet layer goes back to waiting
+            self.telnet.notify_bytes_sent(0)
+            return
+        try:
+            nsent = send_buffers(self.sock, buffers)
+        except socket.error, e:
+            if e.args[0] in RETRY_ERRNOS:
+                return
+            self.disconnect(now, e)
+            return
+        if nsent:
+            self.telnet.notify_bytes_sent(nsent)
+            self.last_progress_time = now
+
+    def notify_readable(self, now):
+        try:
+            data = self.sock.recv(4096)
+        except socket.error, e:
+            if e.args[0] in RETRY_ERRNOS:
+                return
+            self.disconnect(now, e)
+            return
+        if not data:
+            self.disconnect(now, 'the server closed the connection')
+            return
+        self.telnet.process_incoming(data)
+        self.last_progress_time = now
+        # the connection works, so the next failure starts the backoff over
+        self.backoff = self.min_backoff
+
+    def notify_crash(self, now):
+        """
+        The layers raised an exception, so drop them and start over on a new connection.
+        """
+        self.ncrashes += 1
+        self.remark('ERROR: the session crashed\n%s' % traceback.format_exc())
+        if self.sock is None:
+            self.schedule_reconnect(now)
+        else:
+            self.disconnect(now, 'crashed')
+
+    def check_timeout(self, now):
+        if now - self.last_progress_time > self.idle_timeout:
+            self.disconnect(now, 'timeout in network state %s' % self.telnet.network_state)
+
+
+class Reactor:
+    """
+    This is the select loop shared by all of the sessions.
+    """
+    def __init__(self):
+        self.sessions = []
+
+    def add_session(self, session):
+        self.sessions.append(session)
+
+    def service(self, session, method, now):
+        """
+        A crash in one session does not stop the others.
+        """
+        try:
+            method(now)
+        except Exception:
+            session.notify_crash(now)
+
+    def run_once(self, max_timeout=1.0):
+        """
+        Connect the sessions that are due, then wait for sockets and service them.
+        """
+        now = time.time()
+        for session in self.sessions:
+            if not session.finished and not session.is_connected() and session.reconnect_time <= now:
+                self.service(session, session.connect, now)
+        connected = [session for session in self.sessions if session.is_connected()]
+        readers = [session for session in connected if session.wants_to_read()]
+        writers = [session for session in connected if session.wants_to_write()]
+        # do not sleep past the next reconnection
+        timeout = max_timeout
+        for session in self.sessions:
+            if not session.finished and not session.is_connected():
+                timeout = max(0, min(timeout, session.reconnect_time - now))
+        # The exceptional conditions of select are urgent data, which telnet uses for its SYNCH,
+        # so they are not errors; a broken socket shows up as an error of recv, send or SO_ERROR.
+        if readers or writers:
+            canread, canwrite, ignored = select.select(readers, writers, [], timeout)
+        else:
+            time.sleep(timeout)
+            canread, canwrite = [], []
+        now = time.time()
+        for session in canwrite:
+            if session.is_connected():
+                self.service(session, session.notify_writable, now)
+        for session in canread:
+            if session.is_connected():
+                self.service(session, session.notify_readable, now)
+        for session in self.sessions:
+            if session.is_connected():
+                session.check_timeout(now)
+
+    def run(self):
+        """
+        Run until every session is finished.
+        """
+        while [session for session in self.sessions if not session.finished]:
+            self.run_once()
@@ -0,0 +1,267 @@
+"""
+Record the raw telnet stream of a game and replay it without a network.
+
+A recording is a small header followed by one record per chunk of data.
+The header has the random seed and the settings of the telnet and terminal layers,
+so that the replay builds the layers the same way.
+Each record has a kind ('r' for received or 's' for sent),
+the number of seconds since the recording started, the payload length, and the payload.
+Replaying pushes the received chunks through the telnet, ansi, nethack and bot layers
+as fast as possible and reports the time spent in each layer.
+"""
+
+import os
+import random
+import struct
+import sys
+import time
+
+from AscTelnet import Telnet
+from AscTelnet import DEFAULT_WINDOW_SIZE
+from AscTelnet import STATE_WANT_TO_SEND_DATA
+from AscTelnet import STATE_WANT_TO_SEND_PING
+from AscTerminal import Terminal
+
+RECORDING_MAGIC = 'ASCR'
+RECORDING_VERSION = 2
+# magic, version, random seed, window width, window height, pipelined flag
+HEADER_FORMAT = '<4sBIHHB'
+# magic, version, random seed
+VERSION_1_HEADER_FORMAT = '<4sBI'
+# kind, seconds since the start, payload length
+RECORD_FORMAT = '<cdI'
+
+RECORD_RECEIVED = 'r'
+RECORD_SENT = 's'
+
+
+class RecordingError(Exception):
+    pass
+
+
+class RecordingHeader:
+    def __init__(self, seed, pipelined=False, window_size=DEFAULT_WINDOW_SIZE):
+        """
+        @param seed: the random seed of the recorded game
+        @param pipelined: True if the telnet layer pinged right after each command instead of in lock step
+        @param window_size: the (width, height) of the window that was reported to the server
+        """
+        self.seed = seed
+        self.pipelined = pipelined
+        self.window_size = window_size
+
+
+class Recorder:
+    """
+    Write each chunk of data that goes over the socket to a recording file.
+    """
+    def __init__(self, filename, seed=None, pipelined=False, window_size=DEFAULT_WINDOW_SIZE):
+        """
+        @param filename: the name of the recording file to create
+        @param seed: the random seed of the recorded game, or None to pick one
+        @param pipelined: True if the telnet layer pings right after each command instead of in lock step
+        @param window_size: the (width, height) of the window that is reported to the server
+        """
+        if seed is None:
+            seed = int(time.time())
+        self.seed = seed
+        self.fout = open(filename, 'wb')
+        width, height = window_size
+        self.fout.write(struct.pack(HEADER_FORMAT, RECORDING_MAGIC, RECORDING_VERSION, seed, width, height, int(pipelined)))
+        self.start_time = time.time()
+
+    def add_record(self, kind, data):
+        elapsed = time.time() - self.start_time
+        self.fout.write(struct.pack(RECORD_FORMAT, kind, elapsed, len(data)))
+        self.fout.write(data)
+
+    def notify_received(self, data):
+        self.add_record(RECORD_RECEIVED, data)
+
+    def notify_sent(self, data):
+        self.add_record(RECORD_SENT, data)
+        # flush at each send so a crashed session still leaves a useful recording
+        self.fout.flush()
+
+    def close(self):
+        self.fout.close()
+
+
+class RecordingSocket:
+    """
+    This wraps a socket so that everything sent and received is recorded.
+    It can be passed to select because it has a fileno.
+    """
+    def __init__(self, sock, recorder):
+        self.sock = sock
+        self.recorder = recorder
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def recv(self, bufsize):
+        data = self.sock.recv(bufsize)
+        if data:
+            self.recorder.notify_received(data)
+        return data
+
+    def send(self, data):
+        nsent = self.sock.send(data)
+        self.recorder.notify_sent(data[:nsent])
+        return nsent
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+
+def read_recording(filename):
+    """
+    @param filename: the name of a recording file
+    Recordings of version 1 have only the seed, and they were made with the default settings.
+    @return: (header, records) where the header is a RecordingHeader
+        and each record is a (kind, seconds, payload) triple
+    """
+    fin = open(filename, 'rb')
+    data = fin.read()
+    fin.close()
+    record_size = struct.calcsize(RECORD_FORMAT)
+    if len(data) < struct.calcsize(VERSION_1_HEADER_FORMAT):
+        raise RecordingError('the recording is too short to have a header')
+    magic, version, seed = struct.unpack_from(VERSION_1_HEADER_FORMAT, data)
+    if magic != RECORDING_MAGIC:
+        raise RecordingError('this is not a recording file')
+    if version == 1:
+        header_size = struct.calcsize(VERSION_1_HEADER_FORMAT)
+        header = RecordingHeader(seed)
+    elif version == RECORDING_VERSION:
+        header_size = struct.calcsize(HEADER_FORMAT)
+        if len(data) < header_size:
+            raise RecordingError('the recording is too short to have a header')
+        magic, version, seed, width, height, pipelined = struct.unpack_from(HEADER_FORMAT, data)
+        header = RecordingHeader(seed, bool(pipelined), (width, height))
+    else:
+        raise RecordingError('unsupported recording version: %d' % version)
+    records = []
+    offset = header_size
+    while offset + record_size <= len(data):
+        kind, seconds, length = struct.unpack_from(RECORD_FORMAT, data, offset)
+        offset += record_size
+        payload = data[offset:offset+length]
+        if len(payload) < length:
+            # the recording was cut off in the middle of a record
+            break
+        offset += length
+        records.append((kind, seconds, payload))
+    return header, records
+
+
+class TimedLayer:
+    """
+    This wraps a layer to measure the time spent in one of its methods.
+    The time includes the time spent in the layers below it.
+    Everything else is passed through to the wrapped layer.
+    """
+    def __init__(self, layer, method_name='process_incoming'):
+        self.layer = layer
+        self.method = getattr(layer, method_name)
+        self.method_name = method_name
+        self.elapsed = 0.0
+        self.ncalls = 0
+
+    def timed_call(self, *args):
+        start = time.time()
+        try:
+            return self.method(*args)
+        finally:
+            self.elapsed += time.time() - start
+            self.ncalls += 1
+
+    def __getattr__(self, name):
+        if name == self.method_name:
+            return self.timed_call
+        return getattr(self.layer, name)
+
+
+class ReplayReport:
+    def __init__(self):
+        self.nchunks = 0
+        self.nbytes = 0
+        self.nscreens = 0
+        self.turns = 0
+        self.wall_time = 0.0
+        # (layer name, time spent in the layer but not in the layers below it)
+        self.layer_times = []
+
+    def __str__(self):
+        lines = []
+        lines.append('replayed %d chunks (%d bytes) in %.3f seconds' % (self.nchunks, self.nbytes, self.wall_time))
+        for name, elapsed in self.layer_times:
+            lines.append('%s: %.3f seconds' % (name, elapsed))
+        if self.wall_time:
+            lines.append('%.1f screens per second' % (self.nscreens / self.wall_time))
+            lines.append('%.1f turns per second' % (self.turns / self.wall_time))
+        return '\n'.join(lines)
+
+
+def replay(filename):
+    """
+    Push a recording through a new bot as fast as possible.
+    @param filename: the name of a recording file
+    @return: a ReplayReport
+    """
+    # net imports this module for recording
+    from net import Nethack, GatherBot
+    header, records = read_recording(filename)
+    random.seed(header.seed)
+    # create the layers as net.main does, with a timer between each pair of layers
+    telnet = Telnet(header.pipelined, window_size=header.window_size)
+    ansi = Terminal(header.window_size)
+    timed_ansi = TimedLayer(ansi)
+    telnet.add_listener(timed_ansi)
+    nethack = Nethack()
+    nethack.add_slave(telnet)
+    timed_nethack = TimedLayer(nethack)
+    ansi.add_listener(timed_nethack)
+    bot = GatherBot()
+    timed_bot = TimedLayer(bot)
+    nethack.set_bot(timed_bot)
+    # the telnet layer echoes each screen to stdout
+    old_stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    report = ReplayReport()
+    telnet_elapsed = 0.0
+    start = time.time()
+    try:
+        for kind, seconds, payload in records:
+            if kind != RECORD_RECEIVED:
+                continue
+            # send whatever the bot wants to send so the telnet layer expects the next chunk
+            while telnet.network_state in (STATE_WANT_TO_SEND_DATA, STATE_WANT_TO_SEND_PING):
+                data = telnet.get_pending_output()
+                telnet.notify_bytes_sent(len(data))
+            chunk_start = time.time()
+            telnet.process_incoming(payload)
+            telnet_elapsed += time.time() - chunk_start
+            report.nchunks += 1
+            report.nbytes += len(payload)
+    finally:
+        sys.stdout.close()
+        sys.stdout = old_stdout
+    report.wall_time = time.time() - start
+    report.nscreens = timed_nethack.ncalls
+    report.turns = bot.status.turns or 0
+    report.layer_times = [
+            ('telnet', telnet_elapsed - timed_ansi.elapsed),
+            ('ansi', timed_ansi.elapsed - timed_nethack.elapsed),
+            ('nethack', timed_nethack.elapsed - timed_bot.elapsed),
+            ('bot', timed_bot.elapsed)]
+    return report
+
+def main():
+    if len(sys.argv) != 2:
+        print 'usage: %s recording' % sys.argv[0]
+        return
+    print replay(sys.argv[1])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,306 @@
+"""
+A local stand-in for the nethack.alt.org telnet server.
+
+It negotiates telnet options the way the real server does,
+answers each ping from AscTelnet with a pong,
+and serves either a scripted fake dgamelaunch menu or the screens of an AscReplay recording.
+Many sessions are served at once by a single select loop,
+so many bots can be load tested on one machine.
+"""
+
+from optparse import OptionParser
+import select
+import socket
+import sys
+
+from AscTelnet import IAC, WILL, WONT, DO
+from AscTelnet import get_telnet_command
+from AscTelnet import PING_OPTIONS
+from AscReplay import read_recording, RECORD_RECEIVED, RECORD_SENT
+
+DEFAULT_PORT = 2323
+
+PINGS = [IAC + DO + option for option in PING_OPTIONS]
+PONGS = [IAC + WONT + option for option in PING_OPTIONS]
+
+# These are the option negotiations that Telnet.process_incoming_control knows how to answer.
+NEGOTIATION = ''.join([
+    IAC + DO + '\x18',
+    IAC + DO + '\x20',
+    IAC + DO + '\x23',
+    IAC + DO + '\x27',
+    IAC + WILL + '\x03',
+    IAC + DO + '\x01',
+    IAC + DO + '\x1f',
+    IAC + WILL + '\x05',
+    IAC + DO + '\x21',
+    IAC + WILL + '\x01'])
+
+CLEAR_SCREEN = '\x1b[H\x1b[2J'
+
+
+def make_screen(lines):
+    """
+    @param lines: the lines of text on the screen
+    @return: a string that clears the terminal and draws the lines
+    """
+    return CLEAR_SCREEN + '\r\n'.join(lines)
+
+def split_telnet_stream(msg):
+    """
+    Separate the data from the telnet commands, keeping their order.
+    A command that is cut off at the end of the message is treated as incomplete.
+    @return: (items, remainder) where each item is an (is_command, bytes) pair
+    and remainder is the incomplete end of the message
+    """
+    items = []
+    while msg:
+        index = msg.find(IAC)
+        if index < 0:
+            items.append((False, msg))
+            msg = ''
+        elif index > 0:
+            items.append((False, msg[:index]))
+            msg = msg[index:]
+        else:
+            command = get_telnet_command(msg)
+            if not command:
+                break
+            items.append((True, command))
+            msg = msg[len(command):]
+    return items, msg
+
+
+class ScriptedSession:
+    """
+    Walk through a fake dgamelaunch login menu, then show the same game screen for every command.
+    """
+    def __init__(self):
+        self.state = 'menu'
+        self.line = ''
+        self.username = None
+
+    def get_greeting(self):
+        return NEGOTIATION + self.get_menu_screen()
+
+    def get_menu_screen(self):
+        return make_screen([
+            ' ## nethack.alt.org - http://nethack.alt.org/',
+            ' ##',
+            ' ## Not logged in.',
+            '',
+            ' l) Login',
+            ' q) Quit'])
+
+    def get_logged_in_screen(self):
+        return make_screen([
+            ' ## nethack.alt.org - http://nethack.alt.org/',
+            ' ##',
+            ' ## Logged in as: %s' % self.username,
+            '',
+            ' p) Play NetHack',
+            ' q) Quit'])
+
+    def get_game_screen(self):
+        return make_screen([
+            'Hello %s, welcome to NetHack!  You are a neutral male gnomish Wizard.' % self.username,
+            '',
+            '',
+            '                                  -----',
+            '                                  |...|',
+            '                                  |.@.|',
+            '                                  |...|',
+            '                                  -----'] + [''] * 14 + [
+            '%s the Evoker         St:10 Dx:14 Co:12 In:19 Wi:11 Ch:8 Neutral' % self.username,
+            'Dlvl:1 $:0 HP:12(12) Pw:7(7) AC:9 Xp:1/0 T:1'])
+
+    def process_input(self, data):
+        """
+        @param data: the bytes that the client sent, without telnet commands
+        @return: the bytes to send back
+        """
+        response = ''
+        for c in data:
+            if self.state == 'menu':
+                if c == 'l':
+                    self.state = 'username'
+                    response = make_screen(['Please enter your username.'])
+            elif self.state in ('username', 'password'):
+                if c in '\r\n':
+                    if self.state == 'username':
+                        self.username = self.line
+                        self.state = 'password'
+                        response = make_screen(['Please enter your password.'])
+                    else:
+                        self.state = 'logged in'
+                        response = self.get_logged_in_screen()
+                    self.line = ''
+                else:
+                    self.line += c
+            elif self.state == 'logged in':
+                if c == 'p':
+                    self.state = 'playing'
+                    response = self.get_game_screen()
+            else:
+                response = self.get_game_screen()
+        if not response:
+            # always answer so the client is never left waiting for a screen
+            response = '\x1b[H'
+        return response
+
+
+class RecordedSession:
+    """
+    Serve the screens of a recording, one response for each command the client sends.
+    The responses are the data the recorded client received between its recorded commands,
+    including the negotiation of the recorded server,
+    so a bot that makes the same decisions sees the same game.
+    """
+    def __init__(self, responses):
+        self.responses = responses
+        self.index = 1
+
+    def get_greeting(self):
+        return self.responses[0]
+
+    def process_input(self, data):
+        if self.index >= len(self.responses):
+            return None
+        response = self.responses[self.index]
+        self.index += 1
+        return response
+
+
+def remove_pongs(msg):
+    for pong in PONGS:
+        msg = msg.replace(pong, '')
+    return msg
+
+def load_recorded_responses(filename):
+    """
+    @return: a list with the greeting and then the response to each recorded command
+    """
+    header, records = read_recording(filename)
+    responses = []
+    received = []
+    for kind, seconds, payload in records:
+        if kind == RECORD_RECEIVED:
+            received.append(payload)
+        elif kind == RECORD_SENT:
+            items, remainder = split_telnet_stream(payload)
+            if [data for is_command, data in items if not is_command]:
+                responses.append(remove_pongs(''.join(received)))
+                received = []
+    responses.append(remove_pongs(''.join(received)))
+    return responses
+
+
+class Connection:
+    def __init__(self, sock, session):
+        self.sock = sock
+        self.session = session
+        self.inbuffer = ''
+        self.outbuffer = session.get_greeting()
+        self.closing = False
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def process_incoming(self, msg):
+        items, self.inbuffer = split_telnet_stream(self.inbuffer + msg)
+        # The answers to the negotiation need no reply.
+        # Data and pings are answered in order, so a pong always follows the screen it acknowledges.
+        for is_command, item in items:
+            if is_command:
+                if item in PINGS:
+                    # refuse the unassigned option, echoing the tag of a pipelined ping
+                    self.outbuffer += IAC + WONT + item[2:]
+            elif not self.closing:
+                response = self.session.process_input(item)
+                if response is None:
+                    self.closing = True
+                else:
+                    self.outbuffer += response
+
+
+class StandInServer:
+    def __init__(self, address, session_factory, log=None):
+        """
+        @param address: the (host, port) to listen on
+        @param session_factory: a function that makes a session for each connection
+        @param log: a file for logging connections, or None
+        """
+        self.session_factory = session_factory
+        self.log = log
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(address)
+        self.listener.listen(128)
+        self.connections = []
+
+    def remark(self, message):
+        if self.log:
+            print >> self.log, message
+
+    def close_connection(self, connection):
+        self.connections.remove(connection)
+        connection.sock.close()
+        self.remark('closed a connection; %d remain' % len(self.connections))
+
+    def serve_once(self, timeout=None):
+        """
+        Wait for the sockets to be ready and do what they are ready for.
+        """
+        readers = [self.listener] + self.connections
+        writers = [c for c in self.connections if c.outbuffer]
+        canread, canwrite, haserr = select.select(readers, writers, [], timeout)
+        for connection in canwrite:
+            try:
+                nsent = connection.sock.send(connection.outbuffer)
+            except socket.error, e:
+                self.remark(e)
+                self.close_connection(connection)
+                continue
+            connection.outbuffer = connection.outbuffer[nsent:]
+            if connection.closing and not connection.outbuffer:
+                self.close_connection(connection)
+        for reader in canread:
+            if reader is self.listener:
+                sock, address = self.listener.accept()
+                self.connections.append(Connection(sock, self.session_factory()))
+                self.remark('accepted a connection from %s; %d open' % (str(address), len(self.connections)))
+            elif reader in self.connections:
+                try:
+                    msg = reader.sock.recv(4096)
+                except socket.error, e:
+                    self.remark(e)
+                    msg = ''
+                if msg:
+                    reader.process_incoming(msg)
+                else:
+                    self.close_connection(reader)
+
+    def serve_forever(self):
+        while True:
+            self.serve_once()
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--host", dest="host", default="localhost",
+                      help="the address to listen on", metavar="HOST")
+    parser.add_option("-p", "--port", dest="port", type="int", default=DEFAULT_PORT,
+                      help="the port to listen on", metavar="PORT")
+    parser.add_option("-r", "--recording", dest="recording",
+                      help="serve the screens of this AscReplay recording instead of a scripted menu", metavar="FILENAME")
+    (options, args) = parser.parse_args()
+    if options.recording:
+        responses = load_recorded_responses(options.recording)
+        session_factory = lambda: RecordedSession(responses)
+    else:
+        session_factory = ScriptedSession
+    server = StandInServer((options.host, options.port), session_factory, sys.stderr)
+    server.serve_forever()
+
+if __name__ == '__main__':
+    main()
@@ -12,15 +12,24 @@ Commands:
 
 
 import StringIO
+import fcntl
+import mmap
 import os
 import profile
+import tempfile
 import time
 
-from AscUtil import Rect, vi_delta_pairs
+from AscUtil import Rect, vi_delta_pairs, gen_mask_indices, get_bounding_coordinates, get_lowest_mask_index
 import AscDP
 
 from heapq import heappush, heappop
 
+# For detection purposes any ascii '-' or '|' is a wall.
+SOKOBAN_WALL_CHARACTERS = ('-', '|')
+
+# The solutions are stored next to this module, where a store of solved levels is checked in.
+DEFAULT_SOLUTION_STORE_FILENAME = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sokoban.store')
+
 all_level_strings_and_names = []
 
 all_level_strings_and_names.append((
@@ -172,7 +181,7 @@ def sokoban_string_to_map(level_string):
     This function is designed to be used inside or outside the context of SokoMap.
     """
     level = {}
-    raw_lines = [line.rstrip() for line in StringIO.StringIO(level_string)]
+    raw_lines = [line.rstrip() for line in level_string.splitlines()]
     while not raw_lines[0]:
         del raw_lines[0]
     while not raw_lines[-1]:
@@ -191,7 +200,7 @@ def sokoban_string_to_map(level_string):
 
 def load_push_sequence(level_name):
     """
-    Load the sequence of player moves that push a boulder.
+    Load the sequence of player moves that push a boulder from a .soko file written by older versions.
     Each line in the file has four tab separated numbers:
         (player_row, player_col, boulder_row, boulder_col)
     @return: a list of boulder pushes or None if the file is empty or does not exist
@@ -210,65 +219,477 @@ def load_push_sequence(level_name):
         push_sequence.append(push_command)
     return push_sequence
 
+def get_layout_string(level_name, boulder_locations, trap_locations):
+    """
+    @param boulder_locations: the locations of the boulders relative to the upper left corner of the level
+    @param trap_locations: the locations of the traps that are not yet filled
+    @return: a string that identifies the level and its boulders and traps and that has no tabs or newlines
+    """
+    boulder_string = ';'.join('%d,%d' % loc for loc in sorted(boulder_locations))
+    trap_string = ';'.join('%d,%d' % loc for loc in sorted(trap_locations))
+    return '%s|%s|%s' % (level_name, boulder_string, trap_string)
+
+def parse_layout_string(layout):
+    """
+    @param layout: a string made by get_layout_string
+    @return: a (level_name, boulder_locations, trap_locations) triple where the locations are sets
+    """
+    level_name, boulder_string, trap_string = layout.split('|')
+    boulder_locations = set(tuple(int(x) for x in loc.split(',')) for loc in boulder_string.split(';') if loc)
+    trap_locations = set(tuple(int(x) for x in loc.split(',')) for loc in trap_string.split(';') if loc)
+    return level_name, boulder_locations, trap_locations
+
+def get_configuration_key(level_name, boulder_locations, trap_locations, player_location):
+    """
+    The same boulders and traps can be solved in different ways depending on which side of them the player is,
+    so the key includes the region of the player, named by the first square of the region.
+    @param boulder_locations: the locations of the boulders relative to the upper left corner of the level
+    @param trap_locations: the locations of the traps that are not yet filled
+    @param player_location: the location of the player
+    @return: a string that identifies the level and the configuration and that has no tabs or newlines
+    """
+    grid = get_catalogue().get_info(level_name).get_grid()
+    boulders = grid.get_mask(grid.get_index(loc) for loc in boulder_locations)
+    traps = grid.get_mask(grid.get_index(loc) for loc in trap_locations)
+    region = grid.flood(grid.get_index(player_location), boulders, traps)
+    region_location = grid.get_location(get_lowest_mask_index(region))
+    return '%s|%d,%d' % ((get_layout_string(level_name, boulder_locations, trap_locations),) + region_location)
+
+def apply_push(boulder_locations, trap_locations, push):
+    """
+    Move a boulder, or fill a trap with it.
+    @param boulder_locations: a set of boulder locations that is modified
+    @param trap_locations: a set of trap locations that is modified
+    @param push: a (player_row, player_col, boulder_row, boulder_col) push
+    """
+    player_row, player_col, boulder_row, boulder_col = push
+    boulder_location = (boulder_row, boulder_col)
+    target_location = (2*boulder_row - player_row, 2*boulder_col - player_col)
+    boulder_locations.remove(boulder_location)
+    if target_location in trap_locations:
+        trap_locations.remove(target_location)
+    else:
+        boulder_locations.add(target_location)
+
+
+def get_solution_index(level_name, solutions):
+    """
+    Replay the solutions of a level to find every configuration that they pass through.
+    When two solutions pass through the same configuration the one that was saved first is used,
+    and when a solution passes through a configuration twice the shorter rest of it is used.
+    @param solutions: a list of (boulder_locations, trap_locations, push_sequence) solutions of the level
+    @return: a dict mapping a configuration key to a (solution index, push offset) pair
+    """
+    key_to_position = {}
+    for solution_index, (boulder_locations, trap_locations, push_sequence) in enumerate(solutions):
+        boulders = set(boulder_locations)
+        traps = set(trap_locations)
+        key_to_offset = {}
+        for offset, push in enumerate(push_sequence):
+            # the player is in the region of the square where the push starts
+            key_to_offset[get_configuration_key(level_name, boulders, traps, push[:2])] = offset
+            apply_push(boulders, traps, push)
+        for key, offset in key_to_offset.items():
+            if key not in key_to_position:
+                key_to_position[key] = (solution_index, offset)
+    return key_to_position
+
+
+class SokoSolutionStore:
+    """
+    Remember the boulder pushes that solve each level from the configurations of boulders and traps where they were found.
+    Locations are relative to the upper left corner of the level, as in SokoLevelInfo.
+    The store is a text file with a header line and then one line per solution:
+        layout <tab> pushes
+    where the layout is the string of get_layout_string for the boulders and traps where the solution starts,
+    each push is four comma separated numbers, and the pushes are separated by spaces.
+    Each solution is stored once.
+    To look up a configuration in the middle of a level, for example after a disconnect,
+    the solutions of the level are replayed into an index from the configuration key before each push
+    to the (solution index, push offset) pair, and the rest of that solution is the answer.
+    The file is only ever replaced by a rename, so a reader sees either the old file or the new file and never needs a lock.
+    A writer holds an exclusive lock on a separate lock file while it merges its solution into the current file,
+    so processes that save at the same time do not lose each other's solutions.
+    """
+    header = '# sokoban solutions\n'
+
+    def __init__(self, filename=DEFAULT_SOLUTION_STORE_FILENAME):
+        self.filename = filename
+        self.lock_filename = filename + '.lock'
+
+    def load(self, level_name, boulder_locations, trap_locations, player_location):
+        """
+        @return: a list of (player_row, player_col, boulder_row, boulder_col) pushes or None if none is stored
+        """
+        solutions = self.load_level(level_name)
+        if not solutions:
+            return None
+        key = get_configuration_key(level_name, boulder_locations, trap_locations, player_location)
+        position = get_solution_index(level_name, solutions).get(key, None)
+        if position is None:
+            return None
+        solution_index, offset = position
+        boulders, traps, push_sequence = solutions[solution_index]
+        return push_sequence[offset:]
+
+    def load_level(self, level_name):
+        """
+        The file is mapped instead of read, and only the records of the level are parsed.
+        @return: a list of (boulder_locations, trap_locations, push_sequence) solutions in the order that they were saved
+        """
+        if not os.path.exists(self.filename):
+            return []
+        fin = open(self.filename, 'rb')
+        try:
+            if not os.fstat(fin.fileno()).st_size:
+                return []
+            mapped = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                # every record follows a newline because the file starts with the header line
+                prefix = '\n%s|' % level_name
+                lines = []
+                start = mapped.find(prefix)
+                while start >= 0:
+                    end = mapped.find('\n', start + 1)
+                    if end < 0:
+                        end = len(mapped)
+                    lines.append(mapped[start+1:end])
+                    start = mapped.find(prefix, end)
+            finally:
+                mapped.close()
+        finally:
+            fin.close()
+        solutions = []
+        for line in lines:
+            layout, value = line.split('\t')
+            name, boulder_locations, trap_locations = parse_layout_string(layout)
+            push_sequence = [tuple(int(x) for x in push.split(',')) for push in value.split()]
+            solutions.append((boulder_locations, trap_locations, push_sequence))
+        return solutions
+
+    def load_start(self, level_name):
+        """
+        Look up the pushes that solve the level from where it starts.
+        A solution found in a .soko file written by older versions is moved into the store.
+        @return: a list of pushes or None if none is stored
+        """
+        info = get_catalogue().get_info(level_name)
+        push_sequence = self.load(level_name, info.boulder_locations, info.trap_locations, info.start_location)
+        if push_sequence is None:
+            push_sequence = load_push_sequence(level_name)
+            if push_sequence is not None:
+                self.save(level_name, info.boulder_locations, info.trap_locations, push_sequence)
+        return push_sequence
+
+    def save(self, level_name, boulder_locations, trap_locations, push_sequence):
+        """
+        Add a solution to the store unless the store already has one for the configuration where it starts.
+        @param push_sequence: a nonempty list of (player_row, player_col, boulder_row, boulder_col) pushes
+        """
+        lock_file = open(self.lock_filename, 'a')
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            # the player is in the region of the square where the first push starts
+            if self.load(level_name, boulder_locations, trap_locations, push_sequence[0][:2]) is not None:
+                return
+            records = list(self.gen_records())
+            value = ' '.join('%d,%d,%d,%d' % tuple(push) for push in push_sequence)
+            records.append((get_layout_string(level_name, boulder_locations, trap_locations), value))
+            self.write_records(records)
+        finally:
+            # closing the file releases the lock
+            lock_file.close()
+
+    def save_start(self, level_name, push_sequence):
+        """
+        Record a solution of the level from where it starts.
+        """
+        info = get_catalogue().get_info(level_name)
+        self.save(level_name, info.boulder_locations, info.trap_locations, push_sequence)
+
+    def gen_records(self):
+        """
+        Yield (layout, value) pairs where the value is the unparsed string of pushes.
+        """
+        if not os.path.exists(self.filename):
+            return
+        for line in open(self.filename):
+            line = line.rstrip('\n')
+            if line and not line.startswith('#'):
+                layout, value = line.split('\t')
+                yield layout, value
+
+    def write_records(self, records):
+        """
+        Write the whole store to a temporary file in the same directory and then rename it over the store.
+        This should be called only while holding the lock.
+        """
+        directory = os.path.dirname(os.path.abspath(self.filename))
+        fd, temp_filename = tempfile.mkstemp(prefix='.sokoban', dir=directory)
+        try:
+            fout = os.fdopen(fd, 'w')
+            fout.write(self.header)
+            for layout, value in records:
+                print >> fout, '%s\t%s' % (layout, value)
+            fout.flush()
+            os.fsync(fout.fileno())
+            fout.close()
+            # a temporary file is private, but the store is not
+            os.chmod(temp_filename, 0644)
+            os.rename(temp_filename, self.filename)
+        except:
+            if os.path.exists(temp_filename):
+                os.remove(temp_filename)
+            raise
+
+def get_wall_signature(wall_locations):
+    """
+    Describe a pattern of walls independently of where it is drawn.
+    The walls are moved so that the top and left walls touch the upper left corner,
+    and then each row of walls is packed into an integer with one bit per column.
+    @param wall_locations: a nonempty collection of (row, col) wall locations
+    @return: a hashable tuple of row bitmasks
+    """
+    row_min, col_min, row_max, col_max = get_bounding_coordinates(wall_locations)
+    row_masks = [0] * (row_max - row_min + 1)
+    for row, col in wall_locations:
+        row_masks[row - row_min] |= 1 << (col - col_min)
+    return tuple(row_masks)
+
+
+class SokoLevelInfo:
+    """
+    What is known about a hardcoded sokoban level before it is played.
+    Locations are relative to the upper left corner of the drawing of the level,
+    which is also the upper left corner of its walls.
+    """
+    def __init__(self, level_string, level_name):
+        level = sokoban_string_to_map(level_string)
+        self.level_string = level_string
+        self.level_name = level_name
+        self.wall_locations = frozenset(loc for loc, c in level.items() if c in SOKOBAN_WALL_CHARACTERS)
+        self.wall_signature = get_wall_signature(self.wall_locations)
+        self.bounding_coordinates = get_bounding_coordinates(self.wall_locations)
+        self.trap_locations = tuple(sorted(loc for loc, c in level.items() if c == '^'))
+        self.boulder_locations = tuple(sorted(loc for loc, c in level.items() if c == '0'))
+        start_locations = [loc for loc, c in level.items() if c == '>']
+        assert len(start_locations) == 1
+        self.start_location = start_locations[0]
+        self.grid = None
+
+    def get_grid(self):
+        """
+        @return: the SokoGrid of the level, which is built the first time that it is needed
+        """
+        if self.grid is None:
+            self.grid = SokoGrid(sokoban_string_to_map(self.level_string))
+        return self.grid
+
+
+class SokoCatalogue:
+    """
+    Index the hardcoded sokoban levels by name and by wall pattern.
+    Detecting a level from the walls on the screen is then a single dict lookup.
+    """
+    def __init__(self, level_strings_and_names):
+        self.level_names = []
+        self.name_to_info = {}
+        self.signature_to_names = {}
+        for level_string, level_name in level_strings_and_names:
+            info = SokoLevelInfo(level_string, level_name)
+            self.level_names.append(level_name)
+            self.name_to_info[level_name] = info
+            self.signature_to_names.setdefault(info.wall_signature, []).append(level_name)
+
+    def get_info(self, level_name):
+        """
+        @return: the SokoLevelInfo of the level, or None if no level has this name
+        """
+        return self.name_to_info.get(level_name)
+
+    def get_matching_level_names(self, wall_locations):
+        """
+        The match is bidirectional, so every wall of a matching level must have been observed and vice versa.
+        @param wall_locations: the nonempty set of observed wall locations in any position on the screen
+        @return: the list of names of the levels that have the same wall pattern
+        """
+        return list(self.signature_to_names.get(get_wall_signature(wall_locations), []))
+
+
+catalogue = None
+
+def get_catalogue():
+    """
+    The catalogue is built the first time that it is needed,
+    so importing this module does not parse the level drawings.
+    """
+    global catalogue
+    if catalogue is None:
+        catalogue = SokoCatalogue(all_level_strings_and_names)
+    return catalogue
+
+
+class SokoGrid:
+    """
+    This is an integer indexed copy of the walls of a sokoban level, for searches that do not touch the level dict.
+    The square at (row, col) has index row * width + col.
+    There is a column of rock to the right of the level and a row of rock below it,
+    so every neighbor of a floor square has an index and no step wraps from floor onto floor.
+    A set of squares is packed into an int mask with the bit of each index set,
+    and a single boulder search state is packed into the int boulder_index * size + player_index.
+    """
+    def __init__(self, level):
+        """
+        @param level: a dict like the one made by sokoban_string_to_map
+        """
+        self.nrows = max(row for row, col in level) + 2
+        self.width = max(col for row, col in level) + 2
+        self.size = self.nrows * self.width
+        width = self.width
+        is_floor = [False] * self.size
+        for location, c in level.items():
+            if c not in '-| ':
+                is_floor[self.get_index(location)] = True
+        self.is_floor = is_floor
+        self.floor_mask = self.get_mask(index for index in range(self.size) if is_floor[index])
+        # the direction at index k is opposite to the direction at index k ^ 1
+        self.directions = (-width, width, -1, 1)
+        # the orthogonal floor neighbors of each floor square
+        self.neighbors = [[index + d for d in self.directions if is_floor[index + d]] if is_floor[index] else []
+                for index in range(self.size)]
+        # the diagonal floor neighbors of each floor square with the two squares beside each diagonal step
+        self.diagonals = [[] for index in range(self.size)]
+        for index in range(self.size):
+            if is_floor[index]:
+                for drow in (-width, width):
+                    for dcol in (-1, 1):
+                        if is_floor[index + drow + dcol]:
+                            self.diagonals[index].append((index + drow + dcol, index + dcol, index + drow))
+        # the (back, front) pairs of the ways to push a boulder off of each square
+        self.back_front_pairs = [[(index - d, index + d) for d in self.directions if is_floor[index - d] and is_floor[index + d]]
+                if is_floor[index] else [] for index in range(self.size)]
+        # the same pushes by the square that the boulder is pushed to
+        self.front_to_source_back_pairs = [[] for index in range(self.size)]
+        for source, pairs in enumerate(self.back_front_pairs):
+            for back, front in pairs:
+                self.front_to_source_back_pairs[front].append((source, back))
+
+    def get_index(self, location):
+        row, col = location
+        return row * self.width + col
+
+    def get_location(self, index):
+        return divmod(index, self.width)
+
+    def get_mask(self, indices):
+        """
+        @return: a mask with the bit of each index set
+        """
+        mask = 0
+        for index in indices:
+            mask |= 1 << index
+        return mask
+
+    def get_glyph_mask(self, level, glyphs):
+        """
+        @return: a mask with the bit of each square of the level dict whose glyph is in the string of glyphs
+        """
+        return self.get_mask(self.get_index(location) for location, c in level.items() if c in glyphs)
+
+    def flood(self, start, boulders, traps):
+        """
+        Find the squares that the player can walk to without pushing a boulder or stepping on a trap.
+        The flood grows by a step in all eight directions at once.
+        A diagonal step is allowed unless both squares beside it are walls or boulders.
+        @param start: the index of the player
+        @param boulders: the mask of the boulders
+        @param traps: the mask of the traps
+        @return: the mask of the reachable squares
+        """
+        width = self.width
+        wide = width + 1
+        narrow = width - 1
+        open_mask = self.floor_mask & ~boulders
+        free = open_mask & ~traps
+        # the squares from which a diagonal step can squeeze past on at least one side
+        east = open_mask >> 1
+        west = open_mask << 1
+        south = open_mask >> width
+        north = open_mask << width
+        southeast = east | south
+        southwest = west | south
+        northeast = east | north
+        northwest = west | north
+        reachable = 1 << start
+        while True:
+            grown = reachable | (reachable << 1 | reachable >> 1 | reachable << width | reachable >> width |
+                    (reachable & southeast) << wide | (reachable & southwest) << narrow |
+                    (reachable & northeast) >> narrow | (reachable & northwest) >> wide) & free
+            if grown == reachable:
+                return reachable
+            reachable = grown
+
 
 class BoulderTransition:
     """
-    This object defines transitions between (boulder location, player location) states.
-    The boulder in question is a single active boulder that has been removed from the level.
+    This object defines transitions between (boulder location, player location) states,
+    packed into ints by the SokoGrid of the map.
+    The boulder in question is a single active boulder that is left out of the boulder mask of the map.
     One of these objects should be created for each active boulder.
+    Its cache stays valid while the other boulders and the traps stay where they are.
     """
-    def __init__(self, rect, level, floor_neighbors, location_to_back_front_pairs):
-        self.level = level
-        self.rect = rect
-        self.location_to_back_front_pairs = location_to_back_front_pairs
-        self.manhattan_transition = ManhattanTransition(rect, level, floor_neighbors)
-        # maps a (boulder location, player location) state to the set of reachable boulder side locations
+    def __init__(self, sokomap, boulder_index):
+        """
+        @param sokomap: the ActiveSokoMap whose grid and boulder and trap masks are searched
+        @param boulder_index: the index of the active boulder on the map
+        """
+        self.sokomap = sokomap
+        self.grid = sokomap.grid
+        self.boulder_index = boulder_index
+        # maps a state to the mask of reachable boulder sides
         self.side_cache = {}
     def __call__(self, source):
         """
         Interesting moves include pushing the boulder and moving to a different side of the boulder to push it.
         """
-        boulder_location, player_location = source
-        # Keep a set of the next states to return at the end of the function.
-        next_states = set()
-        # Make sure that the state is valid.
-        assert self.rect.is_inbounds(boulder_location)
-        assert self.rect.is_inbounds(player_location)
-        assert self.level[boulder_location] not in '0-|^', (boulder_location, self.level[boulder_location])
-        assert self.level[player_location] not in '0-|^', (player_location, self.leve[player_location])
-        # Put the boulder on the floor.
-        self.level[boulder_location] = '0'
-        # Keep a set of the locations we want to visit to push the boulder in a different direction.
-        target_locations = set()
-        # This set includes all target locations and may include the current location.
-        all_desirable_sides = set()
-        for back, front in self.location_to_back_front_pairs[boulder_location]:
+        grid = self.grid
+        size = grid.size
+        boulder_index, player_index = divmod(source, size)
+        others = self.sokomap.boulder_mask & ~(1 << self.boulder_index)
+        traps = self.sokomap.trap_mask
+        solid = others | traps
+        # Keep a list of the next states to return at the end of the function.
+        next_states = []
+        # Keep a mask of the sides we want to visit to push the boulder in a different direction.
+        target_sides = 0
+        # This mask includes all target sides and may include the current location.
+        all_desirable_sides = 0
+        for back, front in grid.back_front_pairs[boulder_index]:
             # You cannot push a boulder while standing on a trap or solid object.
-            if self.level[back] in '0^':
+            if solid >> back & 1:
                 continue
             # You cannot push a boulder into a solid object
-            if self.level[front] == '0':
+            if others >> front & 1:
                 continue
             # At this point the boulder is pushable if we can get behind it.
-            all_desirable_sides.add(back)
-            if player_location == back:
+            all_desirable_sides |= 1 << back
+            if player_index == back:
                 # If we are already behind it then add a boulder push to the list of next states.
-                next_states.add((front, boulder_location))
+                next_states.append(front * size + boulder_index)
             else:
-                # Otherwise add the location behind the boulder to a list of places we want to reach.
-                target_locations.add(back)
-        # See which of the target locations we can reach while the boulder is on the floor.
-        if target_locations:
+                # Otherwise add the side to the mask of places we want to reach.
+                target_sides |= 1 << back
+        # See which of the target sides we can reach while the boulder is on the floor.
+        if target_sides:
             reachable_desirable_sides = self.side_cache.get(source, None)
-            if not reachable_desirable_sides:
-                reachable_desirable_sides = AscDP.flood_all_targets([player_location], all_desirable_sides, self.manhattan_transition)
-            for back in reachable_desirable_sides:
-                adjacent_state = (boulder_location, back)
+            if reachable_desirable_sides is None:
+                reachable = grid.flood(player_index, others | 1 << boulder_index, traps)
+                reachable_desirable_sides = reachable & all_desirable_sides
+            for back in gen_mask_indices(reachable_desirable_sides):
+                adjacent_state = boulder_index * size + back
                 self.side_cache[adjacent_state] = reachable_desirable_sides
                 if adjacent_state != source:
-                    next_states.add(adjacent_state)
-        # Take the boulder back off of the floor.
-        self.level[boulder_location] = '.'
+                    next_states.append(adjacent_state)
         return next_states
 
 
@@ -316,12 +737,112 @@ class BoulderTransitionHeuristic:
         self.boulder_location_to_lower_bound = AscDP.measure_all_states(relaxed_targets, relaxed_reverse_transition)
     def __call__(self, source):
         """
-        @return: None if impossible, 0 if finished, otherwise and optimistic distance guess.
+        @return: None if impossible, 0 if finished, otherwise an optimistic distance guess.
         """
         boulder_location, player_location = source
         return self.boulder_location_to_lower_bound.get(boulder_location, None)
 
 
+class IncrementalBoulderHeuristic:
+    """
+    This gives the same lower bounds as BoulderTransitionHeuristic,
+    but it can be refreshed after other squares of the level change instead of being rebuilt.
+    The pushes of the relaxation are checked against the boulder and trap masks of the map when they are needed,
+    and the active boulder is treated as floor.
+    The bounds are kept by square index.
+    """
+    def __init__(self, sokomap, boulder_index):
+        """
+        @param sokomap: the ActiveSokoMap whose grid and boulder and trap masks are searched
+        @param boulder_index: the index of the active boulder on the map
+        """
+        self.sokomap = sokomap
+        self.grid = sokomap.grid
+        self.boulder_index = boulder_index
+        relaxed_targets = list(gen_mask_indices(sokomap.trap_mask))
+        self.boulder_index_to_lower_bound = AscDP.measure_all_states(relaxed_targets, self.get_sources)
+
+    def is_push_allowed(self, source, back, front):
+        """
+        This has the same rules as RelaxedBoulderReverseTransition.
+        """
+        others = self.sokomap.boulder_mask & ~(1 << self.boulder_index)
+        solid = others | self.sokomap.trap_mask
+        return not (solid >> source & 1 or solid >> back & 1 or others >> front & 1)
+
+    def get_sources(self, sink):
+        """
+        @return: the indices from which the boulder can be pushed to the sink
+        """
+        return [source for source, back in self.grid.front_to_source_back_pairs[sink] if self.is_push_allowed(source, back, sink)]
+
+    def get_sinks(self, source):
+        """
+        @return: the indices to which the boulder can be pushed from the source
+        """
+        return [front for back, front in self.grid.back_front_pairs[source] if self.is_push_allowed(source, back, front)]
+
+    def refresh(self, changed_indices):
+        """
+        Update the lower bounds after the masks of the map have changed at some squares.
+        A push depends only on the masks at its source, back and front,
+        so only the bounds of the changed squares and of their neighbors are checked,
+        and only the bounds that depended on a push that is no longer allowed are recomputed.
+        @param changed_indices: the indices of the changed squares
+        """
+        bounds = self.boulder_index_to_lower_bound
+        back_front_pairs = self.grid.back_front_pairs
+        traps = self.sokomap.trap_mask
+        affected = set()
+        for index in changed_indices:
+            affected.add(index)
+            for neighbor in self.grid.neighbors[index]:
+                if back_front_pairs[neighbor]:
+                    affected.add(neighbor)
+        # Forget each bound that is no longer supported by a neighbor with a bound one lower.
+        invalid = set()
+        stack = [index for index in affected if index in bounds]
+        while stack:
+            index = stack.pop()
+            if index in invalid:
+                continue
+            bound = bounds[index]
+            if bound == 0 and traps >> index & 1:
+                continue
+            if [sink for sink in self.get_sinks(index) if bounds.get(sink, None) == bound - 1]:
+                continue
+            invalid.add(index)
+            del bounds[index]
+            for source in self.get_sources(index):
+                if bounds.get(source, None) == bound + 1:
+                    stack.append(source)
+        # Recompute the forgotten bounds and lower the bounds that new pushes made smaller.
+        pq = []
+        for index in affected | invalid:
+            if traps >> index & 1:
+                heappush(pq, (0, index))
+            else:
+                sink_bounds = [bounds[sink] for sink in self.get_sinks(index) if sink in bounds]
+                if sink_bounds:
+                    heappush(pq, (min(sink_bounds) + 1, index))
+        while pq:
+            bound, index = heappop(pq)
+            old_bound = bounds.get(index, None)
+            if old_bound is not None and old_bound <= bound:
+                continue
+            bounds[index] = bound
+            for source in self.get_sources(index):
+                old_bound = bounds.get(source, None)
+                if old_bound is None or old_bound > bound + 1:
+                    heappush(pq, (bound + 1, source))
+
+    def __call__(self, source):
+        """
+        @return: None if impossible, 0 if finished, otherwise an optimistic distance guess.
+        """
+        return self.boulder_index_to_lower_bound.get(source // self.grid.size, None)
+
+
 class SlowNeighborTransition:
     """
     This is a simple but slow transition function that is not for inner loops.
@@ -334,26 +855,6 @@ class SlowNeighborTransition:
             if self.passability_provider.is_passable(source, sink):
                 yield sink
 
-class ManhattanTransition(Rect):
-    """
-    This transition function uses a lot of precomputation.
-    One of these objects should be created for each active boulder.
-    """
-    def __init__(self, rect, level, floor_neighbors):
-        Rect.__init__(self, rect.row_min, rect.col_min, rect.row_max, rect.col_max)
-        self.level = level
-        self.source_to_sinks = {}
-        for source, potential_sinks in floor_neighbors.items():
-            if level[source] not in '0^':
-                sinks = [sink for sink in potential_sinks if level[sink] not in '0^']
-                if sinks:
-                    self.source_to_sinks[source] = sinks
-    def __call__(self, source):
-        potential_sinks = self.source_to_sinks.get(source, [])
-        for sink in potential_sinks:
-            if self.level[sink] != '0':
-                yield sink
-
 class SokoMap(Rect):
     """
     Use this class for running the demo but use a derived class when AI is needed.
@@ -496,43 +997,21 @@ class SokoMap(Rect):
 class ActiveSokoMap(SokoMap):
     """
     This derived class adds caching for the AI.
+    The AI searches an integer indexed copy of the level with the boulders and traps packed into int masks,
+    so that it never has to change the level dict.
     """
     def __init__(self, level_string, level_name):
         SokoMap.__init__(self, level_string, level_name)
         # log boulder pushes
         self.push_list = []
-        # cache the non-wall manhattan neighbors of each non-wall square
-        self.floor_neighbors = {}
-        for location in self.gen_locations():
-            if self.level[location] not in '-|':
-                neighbors = []
-                for neighbor in self.gen_manhattan_neighbors(location):
-                    if self.level[neighbor] not in '-|':
-                        neighbors.append(neighbor)
-                if neighbors:
-                    self.floor_neighbors[location] = neighbors
-        # cache some ways of pushing a boulder
-        self.location_to_back_front_pairs = {}
-        for location in self.gen_locations():
-            if self.level[location] not in '-|':
-                srow, scol = location
-                pairs = []
-                for drow, dcol in ((0,1),(1,0)):
-                    side_a = (srow - drow, scol - dcol)
-                    side_b = (srow + drow, scol + dcol)
-                    for pair in ((side_a, side_b), (side_b, side_a)):
-                        back, front = pair
-                        if not self.is_inbounds(back):
-                            continue
-                        if not self.is_inbounds(front):
-                            continue
-                        if self.level[back] in '-|':
-                            continue
-                        if self.level[front] in '-|':
-                            continue
-                        pairs.append(pair)
-                if pairs:
-                    self.location_to_back_front_pairs[location] = pairs
+        # the walls and the ways of pushing a boulder are compiled once
+        self.grid = SokoGrid(self.level)
+        # the masks are kept in step with the level dict by on_boulder_push
+        self.boulder_mask = self.grid.get_glyph_mask(self.level, '0')
+        self.trap_mask = self.grid.get_glyph_mask(self.level, '^')
+        # the planning state of each boulder is kept across pushes and refreshed by on_boulder_push
+        self.boulder_transitions = {}
+        self.boulder_heuristics = {}
         # there is no good path known
         self.traceback = None
         # initialize the traceback
@@ -547,16 +1026,45 @@ class ActiveSokoMap(SokoMap):
         new_row, new_col = new_player_location
         args = (old_row, old_col, new_row, new_col)
         self.push_list.append(args)
+        old_boulder_location = new_player_location
+        new_boulder_location = (2*new_row - old_row, 2*new_col - old_col)
+        old_boulder_index = self.grid.get_index(old_boulder_location)
+        new_boulder_index = self.grid.get_index(new_boulder_location)
+        # The boulder either moved or filled a trap.
+        self.boulder_mask &= ~(1 << old_boulder_index)
+        if self.level[new_boulder_location] == '0':
+            self.boulder_mask |= 1 << new_boulder_index
+        else:
+            self.trap_mask &= ~(1 << new_boulder_index)
+        self.refresh_boulder_planners(old_boulder_index, new_boulder_index)
+
+    def refresh_boulder_planners(self, old_boulder_index, new_boulder_index):
+        """
+        Only two squares changed, so refresh the planning state of each boulder instead of rebuilding it.
+        The pushed boulder sees the same level as before, so its planning state moves with it unchanged
+        unless it filled a trap.
+        The other boulders see both squares change, so their lower bounds are refreshed around those squares
+        and their caches of reachable boulder sides are cleared.
+        """
+        heuristic = self.boulder_heuristics.pop(old_boulder_index, None)
+        transition = self.boulder_transitions.pop(old_boulder_index, None)
+        changed_indices = (old_boulder_index, new_boulder_index)
+        for other_heuristic in self.boulder_heuristics.values():
+            other_heuristic.refresh(changed_indices)
+        for other_transition in self.boulder_transitions.values():
+            other_transition.side_cache.clear()
+        if self.boulder_mask >> new_boulder_index & 1 and heuristic and transition:
+            heuristic.boulder_index = new_boulder_index
+            transition.boulder_index = new_boulder_index
+            self.boulder_heuristics[new_boulder_index] = heuristic
+            self.boulder_transitions[new_boulder_index] = transition
 
     def notify_success(self):
         """
-        This should be called when the level has been completed so that the boulder pushes can be written to a file.
-        To redo a level delete the corresponding file manually and run this script again.
+        This should be called when the level has been completed so that the boulder pushes can be stored.
+        To redo a level delete the solution store manually and run this script again.
         """
-        filename = '%s.soko' % self.name
-        self.logfile = open(filename, 'w')
-        for args in self.push_list:
-            print >> self.logfile, '%d\t%d\t%d\t%d' % args
+        SokoSolutionStore().save_start(self.name, self.push_list)
 
     def process_command(self, command):
         """
@@ -570,47 +1078,60 @@ class ActiveSokoMap(SokoMap):
     def invalidate(self):
         """
         A boulder has been moved so the traceback must be recalculated.
+        Only the per-boulder transition and heuristic tables persist across pushes;
+        the searches themselves are rebuilt because their explored states
+        assume the old boulder positions.
         """
         # calling this function means something has caused the old traceback to become invalid
         self.traceback = None
-        # see where the boulders are
-        boulder_locations = [loc for loc, c in self.level.items() if c == '0']
+        grid = self.grid
+        player_index = grid.get_index(self.player_location)
         # create solvers associated with boulder locations
         pq = []
-        distance_solver_location_triples = []
-        for boulder_location in boulder_locations:
-            self.level[boulder_location] = '.'
-            boulder_transition = BoulderTransition(self, self.level, self.floor_neighbors, self.location_to_back_front_pairs)
-            boulder_heuristic = BoulderTransitionHeuristic(self, self.level, self.location_to_back_front_pairs)
-            initial_state = (boulder_location, self.player_location)
+        for boulder_index in gen_mask_indices(self.boulder_mask):
+            boulder_transition, boulder_heuristic = self.get_boulder_planner(boulder_index)
+            initial_state = boulder_index * grid.size + player_index
             solver = AscDP.MeasureInformedTraceback([initial_state], boulder_transition, boulder_heuristic)
             solver.step()
-            self.level[boulder_location] = '0'
             distance = solver.get_distance()
             if distance is not None:
-                heappush(pq, (distance, solver, boulder_location))
+                heappush(pq, (distance, solver, boulder_index))
         # Keep going until a solver has finished or until they have all failed to find a solution.
         best_path = None
         while pq:
-            distance, solver, boulder_location = heappop(pq)
+            distance, solver, boulder_index = heappop(pq)
             solution = solver.get_solution()
             if solution:
                 best_path = AscDP.traceback_to_path(*solution)
                 break
-            self.level[boulder_location] = '.'
             solver.step()
-            self.level[boulder_location] = '0'
             distance = solver.get_distance()
             if distance is not None:
-                heappush(pq, (distance, solver, boulder_location))
+                heappush(pq, (distance, solver, boulder_index))
         # Set the path if one was found.
         if best_path:
             # Convert the path to boulder pushes.
             assert len(best_path) > 1
             self.traceback = []
-            for (new_boulder, new_player), (old_boulder, old_player) in zip(best_path[0:-1], best_path[1:]):
+            for new_state, old_state in zip(best_path[0:-1], best_path[1:]):
+                new_boulder, new_player = divmod(new_state, grid.size)
+                old_boulder, old_player = divmod(old_state, grid.size)
                 if new_boulder != old_boulder:
-                    self.traceback.append((new_player, old_player))
+                    self.traceback.append((grid.get_location(new_player), grid.get_location(old_player)))
+
+    def get_boulder_planner(self, boulder_index):
+        """
+        @return: the (transition, heuristic) pair of the boulder, which is made the first time it is needed
+        """
+        transition = self.boulder_transitions.get(boulder_index, None)
+        if transition is None:
+            transition = BoulderTransition(self, boulder_index)
+            self.boulder_transitions[boulder_index] = transition
+        heuristic = self.boulder_heuristics.get(boulder_index, None)
+        if heuristic is None:
+            heuristic = IncrementalBoulderHeuristic(self, boulder_index)
+            self.boulder_heuristics[boulder_index] = heuristic
+        return transition, heuristic
 
     def auto_command_finish(self):
         # If the traceback does not exist then it means the bot has not found a path.
@@ -674,10 +1195,11 @@ def do_curses_demo(stdscr):
     # create the subscreen to leave room at the top for a message
     sokoban_screen = stdscr.subpad(1, 0)
     # solve each level
+    store = SokoSolutionStore()
     for level_string, level_name in all_level_strings_and_names:
-        # load the list of boulder pushes from the file
-        push_list = load_push_sequence(level_name)
-        # all of the soko files should exist when this function is called
+        # load the list of boulder pushes from the store
+        push_list = store.load_start(level_name)
+        # all of the solutions should be stored when this function is called
         assert push_list
         # load the level
         level = SokoMap(level_string, level_name)
@@ -778,9 +1300,9 @@ def do_curses_main(stdscr, unfinished_level_strings_and_names):
 def do_curses(stdscr):
     # which levels still need to be completed?
     unfinished_level_strings_and_names = []
+    store = SokoSolutionStore()
     for level_string, level_name in all_level_strings_and_names:
-        filename = '%s.soko' % level_name
-        if not os.path.exists(filename):
+        if store.load_start(level_name) is None:
             unfinished_level_strings_and_names.append((level_string, level_name))
     # if there are no levels on startup then run a demo
     if not unfinished_level_strings_and_names:
@@ -0,0 +1,837 @@
+"""
+Solve whole sokoban levels by searching over configurations of all of the boulders.
+
+A move of the search takes one boulder to any square that it can be pushed to while the other boulders stay put,
+so a single move can be a long sequence of pushes.
+Filling a trap never hurts, so when a boulder can be pushed into a trap that is the only move that is tried.
+The search is a weighted best-first search over moves.
+It is guided by the number of traps left and by the number of boulders that are in the way
+of the easiest boulder to push into a trap.
+States are packed into int masks of the squares of the boulders and of the traps,
+and they are identified by Zobrist hashes in a transposition table.
+Dead squares and frozen boulders are pruned, and a boulder pushed into a tunnel is pushed along it.
+The lower bound is a minimum cost matching of the remaining traps to the boulders.
+A solution is a list of (player_row, player_col, boulder_row, boulder_col) boulder pushes like those in AscSokoban.SokoSolutionStore.
+"""
+
+from optparse import OptionParser
+from heapq import heappush, heappop
+import random
+import time
+
+from AscUtil import gen_mask_indices, get_lowest_mask_index, get_mask_size
+import AscSokoban
+
+# the cost of a move relative to the cost of a trap that is left or a boulder that is in the way
+MOVE_COST = 10
+HEURISTIC_WEIGHT = 30
+
+# give up after expanding this many states
+DEFAULT_MAX_EXPANSIONS = 20000
+
+# the search of the boulders around a corral gives up after this many states
+CORRAL_MAX_STATES = 30
+
+# a bot that solves a level while it plays gives up after this many seconds,
+# because the search blocks every session of the process
+LIVE_MAX_SECONDS = 1.0
+
+# a distance that is larger than any real distance
+INFINITY = 1000000
+
+# the same random numbers are used for every search so that hashes are reproducible
+ZOBRIST_SEED = 0x50c0ba4
+
+
+class SolverError(Exception):
+    pass
+
+
+def get_minimum_matching_cost(costs, ncols):
+    """
+    Find the cost of assigning each row to a different column with the Hungarian method.
+    @param costs: a list of rows of costs, with no more rows than columns
+    @param ncols: the number of columns
+    @return: the minimum total cost
+    """
+    nrows = len(costs)
+    # the potentials and matches are indexed from one, with column zero as a sentinel
+    u = [0] * (nrows + 1)
+    v = [0] * (ncols + 1)
+    col_to_row = [0] * (ncols + 1)
+    way = [0] * (ncols + 1)
+    for row in range(1, nrows + 1):
+        col_to_row[0] = row
+        col0 = 0
+        minv = [INFINITY * (nrows + 1)] * (ncols + 1)
+        used = [False] * (ncols + 1)
+        while True:
+            used[col0] = True
+            row0 = col_to_row[col0]
+            cost_row = costs[row0 - 1]
+            u_row0 = u[row0]
+            delta = INFINITY * (nrows + 1)
+            col1 = 0
+            for col in range(1, ncols + 1):
+                if not used[col]:
+                    cur = cost_row[col - 1] - u_row0 - v[col]
+                    if cur < minv[col]:
+                        minv[col] = cur
+                        way[col] = col0
+                    if minv[col] < delta:
+                        delta = minv[col]
+                        col1 = col
+            for col in range(ncols + 1):
+                if used[col]:
+                    u[col_to_row[col]] += delta
+                    v[col] -= delta
+                else:
+                    minv[col] -= delta
+            col0 = col1
+            if col_to_row[col0] == 0:
+                break
+        while col0:
+            col1 = way[col0]
+            col_to_row[col0] = col_to_row[col1]
+            col0 = col1
+    return sum(costs[col_to_row[col] - 1][col - 1] for col in range(1, ncols + 1) if col_to_row[col])
+
+
+class FloorTables:
+    """
+    These are the push distances of the level with the squares of some immovable boulders turned into walls.
+    An immovable boulder can never be pushed again, so it is in the way of the other boulders and of the player for good.
+    """
+    def __init__(self, grid, traps, immovable):
+        """
+        @param grid: the AscSokoban.SokoGrid of the level
+        @param traps: the mask of the traps of the level
+        @param immovable: the mask of the immovable boulders
+        """
+        self.grid = grid
+        self.immovable = immovable
+        self.directions = grid.directions
+        self.is_floor = [is_floor and not immovable >> index & 1 for index, is_floor in enumerate(grid.is_floor)]
+        self.init_distances(traps)
+        self.init_components()
+        self.init_player_distances(traps)
+        # the relaxed path of a boulder to a trap depends only on the boulder and on the remaining traps
+        self.path_cache = {}
+
+    def init_distances(self, traps):
+        """
+        For each trap find the number of pushes that move a boulder from each square into the trap.
+        The other boulders are ignored and the other traps are treated as floor, so these are lower bounds.
+        A boulder on a square from which no trap can be reached is stuck for good.
+        """
+        self.trap_to_distances = {}
+        is_floor = self.is_floor
+        for trap in gen_mask_indices(traps):
+            distances = [INFINITY] * len(is_floor)
+            distances[trap] = 0
+            shell = [trap]
+            distance = 0
+            while shell:
+                distance += 1
+                next_shell = []
+                for sink in shell:
+                    for d in self.directions:
+                        # the boulder was pushed from the source by the player standing behind it
+                        source = sink - d
+                        if is_floor[source] and is_floor[source - d] and distances[source] == INFINITY:
+                            distances[source] = distance
+                            next_shell.append(source)
+                shell = next_shell
+            self.trap_to_distances[trap] = distances
+        # the pushes from each square to the nearest trap
+        self.nearest_distances = [min(field[index] for field in self.trap_to_distances.values())
+                for index in range(len(is_floor))]
+        self.is_live = [nearest < INFINITY for nearest in self.nearest_distances]
+
+    def init_components(self):
+        """
+        With a lone boulder on a square, the rest of the floor may fall apart into pieces.
+        For each square and each direction find the piece that contains the neighbor in that direction.
+        A piece is labeled by the index of the first direction whose neighbor is in it, or -1 if the neighbor is not floor.
+        """
+        is_floor = self.is_floor
+        self.components = [None] * len(is_floor)
+        for index in range(len(is_floor)):
+            if not is_floor[index]:
+                continue
+            labels = [-1] * 4
+            for k, d in enumerate(self.directions):
+                if not is_floor[index + d] or labels[k] >= 0:
+                    continue
+                piece = self.grid.flood(index + d, 1 << index | self.immovable, 0)
+                for j in range(k, 4):
+                    if piece >> (index + self.directions[j]) & 1:
+                        labels[j] = k
+            self.components[index] = labels
+
+    def init_player_distances(self, traps):
+        """
+        For each trap find the number of pushes that move a lone boulder from each square into the trap,
+        taking into account the piece of the floor that the player is in.
+        The distance of a boulder with the player in piece c of its square is in distances[boulder][c].
+        """
+        self.trap_to_player_distances = {}
+        components = self.components
+        directions = self.directions
+        for trap in gen_mask_indices(traps):
+            distances = [[INFINITY] * 4 for index in range(len(self.is_floor))]
+            queue = []
+            for k in range(4):
+                if components[trap][k] == k:
+                    distances[trap][k] = 0
+                    queue.append((trap, k))
+            for sink, piece in queue:
+                for k, d in enumerate(directions):
+                    # the player stood behind the source and ended up on the source, on the far side of the sink
+                    source = sink - d
+                    if not self.is_floor[source] or not self.is_floor[source - d]:
+                        continue
+                    if components[sink][k ^ 1] != piece:
+                        continue
+                    source_piece = components[source][k ^ 1]
+                    if distances[source][source_piece] > distances[sink][piece] + 1:
+                        distances[source][source_piece] = distances[sink][piece] + 1
+                        queue.append((source, source_piece))
+            self.trap_to_player_distances[trap] = distances
+
+    def get_relaxed_path(self, boulder, traps):
+        """
+        Find the pushes that would take the boulder into the nearest trap if there were no other boulders.
+        @return: a list of (player, boulder) index pairs or None if no trap can be reached
+        """
+        cache_key = (boulder, traps)
+        if cache_key in self.path_cache:
+            return self.path_cache[cache_key]
+        best = (INFINITY, None, None)
+        for trap in gen_mask_indices(traps):
+            distances = self.trap_to_player_distances[trap][boulder]
+            for piece in self.components[boulder]:
+                if piece >= 0 and distances[piece] < best[0]:
+                    best = (distances[piece], trap, piece)
+        distance, trap, piece = best
+        if distance == INFINITY:
+            path = None
+        else:
+            trap_distances = self.trap_to_player_distances[trap]
+            components = self.components
+            path = []
+            while distance:
+                # one of the pushes from the square must get one push closer to the trap
+                for k, d in enumerate(self.directions):
+                    target = boulder + d
+                    if components[boulder][k ^ 1] != piece or not self.is_floor[target]:
+                        continue
+                    target_piece = components[target][k ^ 1]
+                    if target_piece >= 0 and trap_distances[target][target_piece] == distance - 1:
+                        break
+                else:
+                    raise SolverError('inconsistent distances to the trap at %s' % (self.grid.get_location(trap),))
+                path.append((boulder - d, boulder))
+                boulder, piece = target, target_piece
+                distance -= 1
+        self.path_cache[cache_key] = path
+        return path
+
+
+class SokobanSolver:
+    """
+    The level is compiled into an AscSokoban.SokoGrid, so squares are integer indices
+    and sets of squares are int masks with the bit of each index set.
+    A search state is a (boulders, traps, player) triple of a boulder mask, a trap mask and the index of the player,
+    and it is identified by a Zobrist hash.
+    The player walks like in the game: diagonal steps are allowed unless both squares beside the step are blocked,
+    but boulders are pushed only by orthogonal steps.
+    """
+    def __init__(self, level, player_location):
+        """
+        @param level: a dict like the one made by AscSokoban.sokoban_string_to_map
+        @param player_location: the (row, col) of the player
+        """
+        self.grid = AscSokoban.SokoGrid(level)
+        self.ncols = self.grid.width
+        self.is_floor = self.grid.is_floor
+        self.directions = self.grid.directions
+        self.neighbors = self.grid.neighbors
+        self.initial_boulders = self.grid.get_glyph_mask(level, '0')
+        self.initial_traps = self.grid.get_glyph_mask(level, '^')
+        self.initial_player = self.grid.get_index(player_location)
+        # the floor tables of each set of immovable boulders, made when the set first turns up
+        self.immovable_to_tables = {}
+        self.is_live = self.get_tables(0).is_live
+        # the most deliveries of the boulders around each corral that has been searched
+        self.corral_to_deliveries = {}
+        self.init_zobrist()
+
+    def get_location(self, index):
+        return self.grid.get_location(index)
+
+    def get_tables(self, immovable):
+        """
+        @param immovable: the mask of the immovable boulders
+        @return: the FloorTables of the level with the immovable boulders as walls
+        """
+        tables = self.immovable_to_tables.get(immovable, None)
+        if tables is None:
+            tables = FloorTables(self.grid, self.initial_traps, immovable)
+            self.immovable_to_tables[immovable] = tables
+        return tables
+
+    def is_tunnel(self, index, d):
+        """
+        @return: True if the squares on both sides of the square across the direction are not floor
+        """
+        side = self.ncols if d in (-1, 1) else 1
+        return not self.is_floor[index - side] and not self.is_floor[index + side]
+
+    def init_zobrist(self):
+        rng = random.Random(ZOBRIST_SEED)
+        n = len(self.is_floor)
+        self.boulder_keys = [rng.getrandbits(64) for i in range(n)]
+        self.trap_keys = [rng.getrandbits(64) for i in range(n)]
+        self.player_keys = [rng.getrandbits(64) for i in range(n)]
+
+    def get_hash(self, boulders, traps):
+        """
+        @return: the hash of the boulders and traps, without the player
+        The search combines it with the player key of the smallest index that the player can reach,
+        and a move changes it only at the squares that the boulder left and entered.
+        """
+        key = 0
+        for boulder in gen_mask_indices(boulders):
+            key ^= self.boulder_keys[boulder]
+        for trap in gen_mask_indices(traps):
+            key ^= self.trap_keys[trap]
+        return key
+
+    def get_reachable(self, boulders, traps, player):
+        """
+        @return: the mask of the squares that the player can walk to without pushing a boulder or falling into a trap
+        """
+        return self.grid.flood(player, boulders, traps)
+
+    def is_frozen(self, boulder, boulders, checked=None):
+        """
+        A frozen boulder can never be moved again because it is blocked along both axes
+        by walls, by dead squares, or by other frozen boulders.
+        """
+        if checked is None:
+            checked = set()
+        checked.add(boulder)
+        for d in (1, self.ncols):
+            before = boulder - d
+            after = boulder + d
+            blocked = False
+            if not self.is_floor[before] or not self.is_floor[after]:
+                blocked = True
+            elif not self.is_live[before] and not self.is_live[after]:
+                blocked = True
+            else:
+                for neighbor in (before, after):
+                    if boulders >> neighbor & 1 and (neighbor in checked or self.is_frozen(neighbor, boulders, checked)):
+                        blocked = True
+                        break
+            if not blocked:
+                return False
+        return True
+
+    def get_immovable_mask(self, boulders):
+        """
+        A boulder is immovable if along both axes it has a wall or an immovable boulder on at least one side.
+        Unlike a frozen boulder it does not matter whether the squares beside it are dead,
+        so it stays immovable whatever happens to the rest of the level.
+        @return: the mask of the immovable boulders
+        """
+        immovable = boulders
+        changed = True
+        while changed:
+            changed = False
+            for boulder in gen_mask_indices(immovable):
+                for d in (1, self.ncols):
+                    before = boulder - d
+                    after = boulder + d
+                    if (self.is_floor[before] and not immovable >> before & 1
+                            and self.is_floor[after] and not immovable >> after & 1):
+                        immovable &= ~(1 << boulder)
+                        changed = True
+                        break
+        return immovable
+
+    def get_corral_losses(self, boulders, traps, reachable, tables, usable, spare):
+        """
+        A corral is a piece of the floor that the player cannot reach because boulders close it off.
+        The usable boulders around a corral are searched alone when each of their pushes
+        either goes into the corral or cannot happen while the corral is closed, so that the player may never get around them.
+        Without the other boulders the player can do anything that it could do with them,
+        so the most of them that reach traps alone is the most of them that can ever reach traps.
+        @param usable: the mask of the boulders that are not already known to be lost
+        @param spare: the number of usable boulders that can be lost, after which the search stops
+        @return: the number of usable boulders that are lost to corrals, which is at most spare unless the traps cannot be filled
+        """
+        width = self.ncols
+        is_floor = tables.is_floor
+        empty = self.grid.floor_mask & ~boulders & ~traps & ~reachable
+        player = get_lowest_mask_index(reachable)
+        claimed = 0
+        losses = 0
+        while empty and losses <= spare:
+            corral = self.grid.flood(get_lowest_mask_index(empty), boulders, traps)
+            empty &= ~corral
+            around = corral | corral << 1 | corral >> 1
+            around |= around << width | around >> width
+            edge = around & usable
+            # corrals with no boulders in common lose different boulders
+            if not edge or edge & claimed:
+                continue
+            for boulder in gen_mask_indices(edge):
+                for d in self.directions:
+                    behind = boulder - d
+                    ahead = boulder + d
+                    if not is_floor[behind] or corral >> behind & 1 or not is_floor[ahead] or corral >> ahead & 1:
+                        continue
+                    break
+                else:
+                    continue
+                break
+            else:
+                # only a search that delivers too few of the boulders matters
+                nedge = get_mask_size(edge)
+                enough = nedge - (spare - losses)
+                if enough <= 0:
+                    continue
+                most = self.get_most_deliveries(edge, traps, player, tables, enough)
+                if most is not None and most < enough:
+                    claimed |= edge
+                    losses += nedge - most
+        return losses
+
+    def get_most_deliveries(self, boulders, traps, player, tables, enough):
+        """
+        Search the moves of a few boulders alone for the most of them that can be pushed into traps.
+        Deliveries are forced like in the main search, and the states whose boulders are nearest to traps are expanded first,
+        so a set of boulders that can be delivered is usually found at once.
+        @param tables: the FloorTables of the immovable boulders, which stay where they are
+        @param enough: the search stops once this many boulders are delivered
+        @return: the number of boulders, at most enough, or None if the search gives up
+        """
+        immovable = tables.immovable
+        reachable = self.get_reachable(boulders | immovable, traps, player)
+        corral_key = (boulders, immovable, traps, get_lowest_mask_index(reachable), enough)
+        if corral_key in self.corral_to_deliveries:
+            return self.corral_to_deliveries[corral_key]
+        ntraps = get_mask_size(traps)
+        most = 0
+        visited = set()
+        pq = [(0, 0, 0, boulders | immovable, traps, reachable)]
+        npushed = 1
+        while pq and most < enough:
+            ndelivered, distance, order, boulders, traps, reachable = heappop(pq)
+            key = (boulders, traps, get_lowest_mask_index(reachable))
+            if key in visited:
+                continue
+            if len(visited) == CORRAL_MAX_STATES:
+                most = None
+                break
+            visited.add(key)
+            most = max(most, -ndelivered)
+            for next_boulders, next_traps, next_player, npushes, segment in self.gen_successors(boulders, traps, reachable):
+                next_reachable = self.get_reachable(next_boulders, next_traps, next_player)
+                distance = sum(tables.nearest_distances[boulder] for boulder in gen_mask_indices(next_boulders & ~immovable))
+                heappush(pq, (get_mask_size(next_traps) - ntraps, distance, npushed, next_boulders, next_traps, next_reachable))
+                npushed += 1
+        self.corral_to_deliveries[corral_key] = most
+        return most
+
+    def get_lower_bound(self, boulders, traps, reachable, tables):
+        """
+        @param reachable: the mask of the squares that the player can walk to
+        @param tables: the FloorTables of the immovable boulders
+        @return: a lower bound on the number of pushes that fill the remaining traps, or None if they cannot be filled
+        """
+        if not traps:
+            return 0
+        trap_indices = list(gen_mask_indices(traps))
+        usable = [boulder for boulder in gen_mask_indices(boulders) if tables.is_live[boulder] and not self.is_frozen(boulder, boulders)]
+        spare = len(usable) - len(trap_indices)
+        if spare < 0:
+            return None
+        usable_mask = 0
+        for boulder in usable:
+            usable_mask |= 1 << boulder
+        if self.get_corral_losses(boulders, traps, reachable, tables, usable_mask, spare) > spare:
+            return None
+        costs = []
+        for trap in trap_indices:
+            distances = tables.trap_to_distances[trap]
+            row = [distances[boulder] for boulder in usable]
+            if min(row) == INFINITY:
+                return None
+            costs.append(row)
+        cost = get_minimum_matching_cost(costs, len(usable))
+        if cost >= INFINITY:
+            return None
+        return cost
+
+    def get_walk_shells(self, boulders, blocked, sources, goals):
+        """
+        Find walks of the player from the sources that step on as few boulders as possible.
+        The walks grow in shells of orthogonal steps, and each level of shells steps on one more boulder than the last.
+        @param boulders: the mask of the boulders that a walk may step on
+        @param blocked: the mask of the squares that the walks must avoid
+        @param sources: the mask of the squares where the walks may start
+        @param goals: the search stops once the costs of the walks to the squares of this mask are known
+        @return: a list of levels, each a list of shell masks, where the first shell of each level but the first holds boulders
+        """
+        width = self.ncols
+        free = self.grid.floor_mask & ~boulders & ~blocked
+        boulders &= ~blocked
+        reached = sources
+        shell = sources
+        levels = []
+        while True:
+            shells = [shell]
+            while goals & ~reached:
+                shell = (shell << 1 | shell >> 1 | shell << width | shell >> width) & free & ~reached
+                if not shell:
+                    break
+                shells.append(shell)
+                reached |= shell
+            levels.append(shells)
+            if not goals & ~reached:
+                return levels
+            shell = (reached << 1 | reached >> 1 | reached << width | reached >> width) & boulders & ~reached
+            if not shell:
+                return levels
+            reached |= shell
+
+    def mark_walk(self, levels, goal):
+        """
+        Follow a walk back from the goal through the shells.
+        A square of a shell was reached from the previous shell of its level,
+        and a boulder that starts a level was reached from any shell of the previous level.
+        @param levels: the shells from get_walk_shells
+        @return: the mask of the boulders on the walk to the goal, or zero if no walk reaches it
+        """
+        goal_bit = 1 << goal
+        for level, shells in enumerate(levels):
+            for step, shell in enumerate(shells):
+                if shell & goal_bit:
+                    break
+            else:
+                continue
+            break
+        else:
+            return 0
+        marked = 0
+        index = goal
+        while level or step:
+            if step:
+                steps = (step - 1,)
+            else:
+                marked |= 1 << index
+                level -= 1
+                steps = range(len(levels[level]))
+            shells = levels[level]
+            for neighbor in self.neighbors[index]:
+                for step in steps:
+                    if shells[step] >> neighbor & 1:
+                        break
+                else:
+                    continue
+                break
+            else:
+                raise SolverError('the walk to %s could not be followed' % (self.get_location(goal),))
+            index = neighbor
+        return marked
+
+    def get_blocker_count(self, boulders, traps, reachable, tables):
+        """
+        Count the movable boulders that are in the way of the boulder that is easiest to push into a trap.
+        The immovable boulders are walls of the tables, so the relaxed paths and the walks go around them.
+        A boulder is in the way if it is on the relaxed path of the pushed boulder,
+        on a square where the player has to stand, or on a walk of the player between pushes.
+        The walks are estimated twice, once from where the player is now, ignoring where the pushed boulder has gone,
+        and once from where the player was left by the previous push.
+        Each estimate can miss boulders that are in the way so the larger count is used.
+        """
+        if not traps:
+            return 0
+        movable = boulders & ~tables.immovable
+        blocked = traps | tables.immovable
+        best_from_start = INFINITY
+        best_from_push = INFINITY
+        for boulder in gen_mask_indices(movable):
+            path = tables.get_relaxed_path(boulder, traps)
+            if path is None:
+                continue
+            boulder_bit = 1 << boulder
+            others = movable & ~boulder_bit
+            # the walks from where the player is now all start from the same squares and avoid the same boulder
+            start_levels = None
+            from_start = 0
+            from_push = 0
+            sources = reachable
+            for player, location in path:
+                target = 2 * location - player
+                in_the_way = others & (1 << player | 1 << target)
+                from_start |= in_the_way
+                from_push |= in_the_way
+                # the walks from where the player is now cannot get behind the boulder where it started
+                if player == boulder:
+                    from_start |= boulder_bit
+                if get_mask_size(from_start) < best_from_start and not reachable >> player & 1:
+                    if start_levels is None:
+                        goals = 0
+                        for index, ignored in path:
+                            goals |= 1 << index
+                        start_levels = self.get_walk_shells(others, blocked | boulder_bit, reachable, goals & ~reachable)
+                    from_start |= self.mark_walk(start_levels, player)
+                if get_mask_size(from_push) < best_from_push and not sources >> player & 1:
+                    push_levels = self.get_walk_shells(others, blocked | 1 << location, sources, 1 << player)
+                    from_push |= self.mark_walk(push_levels, player)
+                sources = 1 << location
+            best_from_start = min(best_from_start, get_mask_size(from_start))
+            best_from_push = min(best_from_push, get_mask_size(from_push))
+            if not best_from_start and not best_from_push:
+                break
+        return max(best_from_start, best_from_push)
+
+    def gen_boulder_moves(self, boulder, boulders, traps, reachable, visited=None):
+        """
+        Yield a (boulders, traps, player, pushes, segment) tuple for each square that the boulder can be pushed to
+        with the other boulders fixed, where pushes is the number of pushes.
+        A boulder that reaches a trap fills it.
+        A boulder that is pushed into a tunnel is pushed along it without stopping.
+        The segment is a (parent, boulder, direction, count, pushes) tuple of the last pushes,
+        where the parent is a key of the visited dict.
+        @param visited: a dict that is filled with the segment of each (boulder, smallest reachable index) key
+        """
+        is_floor = self.is_floor
+        size = self.grid.size
+        others = boulders & ~(1 << boulder)
+        if visited is None:
+            visited = {}
+        start = boulder * size + get_lowest_mask_index(reachable)
+        visited[start] = None
+        queue = [(boulder, reachable, start, 0)]
+        for location, region, key, npushes in queue:
+            for d in self.directions:
+                if not region >> (location - d) & 1:
+                    continue
+                target = location + d
+                if not is_floor[target] or others >> target & 1:
+                    continue
+                # keep pushing while the boulder and the player behind it are both stuck in a tunnel
+                player = location
+                count = 1
+                while not traps >> target & 1 and self.is_tunnel(player, d) and self.is_tunnel(target, d):
+                    following = target + d
+                    if not is_floor[following] or others >> following & 1:
+                        break
+                    player, target = target, following
+                    count += 1
+                segment = (key, location, d, count, npushes + count)
+                if traps >> target & 1:
+                    yield others, traps & ~(1 << target), player, npushes + count, segment
+                    continue
+                next_boulders = others | 1 << target
+                next_region = self.grid.flood(player, next_boulders, traps)
+                next_key = target * size + get_lowest_mask_index(next_region)
+                if next_key in visited:
+                    continue
+                visited[next_key] = segment
+                queue.append((target, next_region, next_key, npushes + count))
+                yield next_boulders, traps, player, npushes + count, segment
+
+    def get_pushes(self, visited, segment):
+        """
+        @return: the list of (player, boulder) index pairs of the pushes that end with the segment
+        """
+        pushes = []
+        while segment is not None:
+            key, location, d, count, npushes = segment
+            for i in reversed(range(count)):
+                pushes.append((location + (i - 1) * d, location + i * d))
+            segment = visited[key]
+        pushes.reverse()
+        return pushes
+
+    def gen_successors(self, boulders, traps, reachable):
+        """
+        @return: a list of (boulders, traps, player, pushes, segment) tuples, one for each move of a boulder
+        If some boulder can be pushed into a trap then the only move is the shortest such delivery.
+        """
+        successors = []
+        best_delivery = None
+        for boulder in gen_mask_indices(boulders):
+            for successor in self.gen_boulder_moves(boulder, boulders, traps, reachable):
+                if successor[1] != traps:
+                    if best_delivery is None or successor[3] < best_delivery[3]:
+                        best_delivery = successor
+                elif best_delivery is None:
+                    successors.append(successor)
+        if best_delivery is not None:
+            return [best_delivery]
+        return successors
+
+    def solve(self, max_expansions=DEFAULT_MAX_EXPANSIONS, max_seconds=None):
+        """
+        @param max_expansions: the number of states to expand before giving up
+        @param max_seconds: if given, the number of seconds to search before giving up
+        @return: a list of (player_row, player_col, boulder_row, boulder_col) pushes, or None if no solution was found
+        """
+        boulders = self.initial_boulders
+        traps = self.initial_traps
+        tables = self.get_tables(self.get_immovable_mask(boulders))
+        reachable = self.get_reachable(boulders, traps, self.initial_player)
+        bound = self.get_lower_bound(boulders, traps, reachable, tables)
+        if bound is None:
+            return None
+        board_key = self.get_hash(boulders, traps)
+        key = board_key ^ self.player_keys[get_lowest_mask_index(reachable)]
+        # the transposition table maps a hash to the fewest moves that reached the state
+        key_to_moves = {key : 0}
+        # each hash maps to a (parent hash, boulder, target, player) tuple of the move from the parent
+        key_to_parent = {key : None}
+        blockers = self.get_blocker_count(boulders, traps, reachable, tables)
+        ntraps = get_mask_size(traps)
+        # ties are broken in favor of the states that were found first
+        pq = [(HEURISTIC_WEIGHT * (ntraps + blockers), ntraps, bound, 0, 0, key, board_key, boulders, traps, self.initial_player)]
+        nexpansions = 0
+        npushed = 1
+        start_time = time.time()
+        while pq:
+            priority, ntraps, bound, nmoves, order, key, board_key, boulders, traps, player = heappop(pq)
+            if nmoves > key_to_moves[key]:
+                continue
+            if not traps:
+                return self.get_solution(key_to_parent, key)
+            nexpansions += 1
+            if nexpansions > max_expansions:
+                return None
+            if max_seconds is not None and time.time() - start_time > max_seconds:
+                return None
+            reachable = self.get_reachable(boulders, traps, player)
+            next_nmoves = nmoves + 1
+            for next_boulders, next_traps, next_player, npushes, segment in self.gen_successors(boulders, traps, reachable):
+                key_of_parent, location, d, count, npushes = segment
+                target = location + count * d
+                # a boulder can come back to its own square with the player on another side of it
+                boulder = get_lowest_mask_index(boulders & ~next_boulders) if boulders != next_boulders else target
+                if next_traps != traps:
+                    next_board_key = board_key ^ self.boulder_keys[boulder] ^ self.trap_keys[target]
+                else:
+                    next_board_key = board_key ^ self.boulder_keys[boulder] ^ self.boulder_keys[target]
+                next_reachable = self.get_reachable(next_boulders, next_traps, next_player)
+                next_key = next_board_key ^ self.player_keys[get_lowest_mask_index(next_reachable)]
+                if key_to_moves.get(next_key, INFINITY) <= next_nmoves:
+                    continue
+                tables = self.get_tables(self.get_immovable_mask(next_boulders))
+                bound = self.get_lower_bound(next_boulders, next_traps, next_reachable, tables)
+                if bound is None:
+                    continue
+                key_to_moves[next_key] = next_nmoves
+                key_to_parent[next_key] = (key, boulder, target, next_player)
+                blockers = self.get_blocker_count(next_boulders, next_traps, next_reachable, tables)
+                next_ntraps = get_mask_size(next_traps)
+                priority = MOVE_COST * next_nmoves + HEURISTIC_WEIGHT * (next_ntraps + blockers)
+                heappush(pq, (priority, next_ntraps, bound, next_nmoves, npushed, next_key, next_board_key, next_boulders, next_traps, next_player))
+                npushed += 1
+        return None
+
+    def get_solution(self, key_to_parent, key):
+        """
+        Only the moves are kept during the search, so their pushes are found again by replaying them.
+        """
+        moves = []
+        while key_to_parent[key] is not None:
+            key, boulder, target, player = key_to_parent[key]
+            moves.append((boulder, target, player))
+        moves.reverse()
+        boulders = self.initial_boulders
+        traps = self.initial_traps
+        player = self.initial_player
+        solution = []
+        for boulder, target, next_player in moves:
+            reachable = self.get_reachable(boulders, traps, player)
+            if traps >> target & 1:
+                expected = (boulders & ~(1 << boulder), traps & ~(1 << target), next_player)
+            else:
+                expected = (boulders & ~(1 << boulder) | 1 << target, traps, next_player)
+            visited = {}
+            for next_boulders, next_traps, next_player, npushes, segment in self.gen_boulder_moves(boulder, boulders, traps, reachable, visited):
+                if (next_boulders, next_traps, next_player) == expected:
+                    break
+            else:
+                raise SolverError('the move of the boulder at %s could not be replayed' % (self.get_location(boulder),))
+            for push_player, push_boulder in self.get_pushes(visited, segment):
+                solution.append(self.get_location(push_player) + self.get_location(push_boulder))
+            boulders, traps, player = expected
+        return solution
+
+
+def get_level_info(level_name):
+    info = AscSokoban.get_catalogue().get_info(level_name)
+    if info is None:
+        raise SolverError('unknown sokoban level: %s' % level_name)
+    return info
+
+def solve_level(level_name, max_expansions=DEFAULT_MAX_EXPANSIONS):
+    """
+    Solve a level from the start, where the player is on the down staircase.
+    @param level_name: the name of a level in the AscSokoban catalogue
+    @return: a list of (player_row, player_col, boulder_row, boulder_col) pushes, or None if no solution was found
+    """
+    info = get_level_info(level_name)
+    return solve_configuration(level_name, info.boulder_locations, info.trap_locations, info.start_location, max_expansions)
+
+def solve_configuration(level_name, boulder_locations, trap_locations, player_location,
+        max_expansions=DEFAULT_MAX_EXPANSIONS, max_seconds=None):
+    """
+    Solve a level from partway through, for example after a disconnect.
+    Locations are relative to the upper left corner of the level.
+    @param level_name: the name of a level in the AscSokoban catalogue
+    @param boulder_locations: the locations of the boulders
+    @param trap_locations: the locations of the traps that are not yet filled
+    @param player_location: the location of the player
+    @param max_seconds: if given, the number of seconds to search before giving up
+    @return: a list of (player_row, player_col, boulder_row, boulder_col) pushes, or None if no solution was found
+    """
+    info = get_level_info(level_name)
+    level = AscSokoban.sokoban_string_to_map(info.level_string)
+    # the boulders and traps of the drawing are replaced by the given ones
+    for loc in info.boulder_locations + info.trap_locations:
+        level[loc] = '.'
+    for loc in trap_locations:
+        level[loc] = '^'
+    for loc in boulder_locations:
+        level[loc] = '0'
+    solver = SokobanSolver(level, player_location)
+    return solver.solve(max_expansions, max_seconds)
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("-w", "--write", dest="write", action="store_true", default=False,
+                      help="write each solution to the sokoban solution store")
+    parser.add_option("-m", "--max-expansions", dest="max_expansions", type="int", default=DEFAULT_MAX_EXPANSIONS,
+                      help="give up on a level after expanding this many states", metavar="COUNT")
+    (options, args) = parser.parse_args()
+    level_names = args or AscSokoban.get_catalogue().level_names
+    for level_name in level_names:
+        start = time.time()
+        solution = solve_level(level_name, options.max_expansions)
+        elapsed = time.time() - start
+        if solution is None:
+            print '%s: no solution found in %.2f seconds' % (level_name, elapsed)
+            continue
+        print '%s: %d pushes in %.2f seconds' % (level_name, len(solution), elapsed)
+        if options.write:
+            AscSokoban.SokoSolutionStore().save_start(level_name, solution)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,284 @@
+"""
+Play many accounts at once on every core of a farm host.
+
+The accounts are split among worker processes,
+and each worker plays its accounts in one AscReactor select loop,
+where a session that crashes starts over on a new connection.
+The supervisor restarts workers that die and collects the statistics of every session.
+"""
+
+from optparse import OptionParser
+import multiprocessing
+import os
+import Queue
+import time
+
+from AscTelnet import DEFAULT_WINDOW_SIZE
+from AscReactor import Reactor, Session
+from AscLog import get_channel, reset_after_fork
+
+# the seconds between reports from the workers and from the supervisor
+REPORT_INTERVAL = 10.0
+# the seconds to wait before restarting a worker, doubled for each restart
+MIN_RESTART_BACKOFF = 1.0
+MAX_RESTART_BACKOFF = 300.0
+# a worker that ran for this many seconds before it died is restarted without delay
+STABLE_WORKER_SECONDS = 60.0
+
+# the statistics that accumulate across connections and worker restarts
+COUNTED_STATISTICS = ('connections', 'crashes', 'screens', 'deaths')
+
+
+class SessionTracker:
+    """
+    Make the layers for each connection of an account and count what happens across connections.
+    """
+    def __init__(self, account, create_all_layers, pipelined, window_size):
+        """
+        @param account: a (username, password, server, port) tuple
+        @param create_all_layers: a function like net.create_all_layers
+        @param pipelined: True to ping right after each command instead of in lock step
+        @param window_size: the (width, height) of the window to report to the server
+        """
+        self.username, self.password, self.server, self.port = account
+        self.create_all_layers = create_all_layers
+        self.pipelined = pipelined
+        self.window_size = window_size
+        self.session = None
+        self.layers = None
+        # the screens and deaths of the connections before the current one
+        self.screens = 0
+        self.deaths = 0
+
+    def make_layers(self):
+        screens, deaths, turn = self.get_current_counts()
+        self.screens += screens
+        self.deaths += deaths
+        self.layers = self.create_all_layers(self.username, self.password, self.pipelined, self.window_size)
+        telnet, ansi, nethack, bot = self.layers
+        return telnet, bot
+
+    def get_current_counts(self):
+        """
+        @return: (screens, deaths, turn) of the current connection
+        """
+        if not self.layers:
+            return 0, 0, 0
+        telnet, ansi, nethack, bot = self.layers
+        return telnet.get_pong_count(), nethack.ndeaths, bot.status.turns or 0
+
+    def get_statistics(self):
+        screens, deaths, turn = self.get_current_counts()
+        return {
+                'username' : self.username,
+                'server' : '%s:%d' % (self.server, self.port),
+                'connections' : self.session.nconnections,
+                'crashes' : self.session.ncrashes,
+                'screens' : self.screens + screens,
+                'deaths' : self.deaths + deaths,
+                'turn' : turn,
+                'rtt' : self.layers and self.layers[0].get_smoothed_rtt()}
+
+
+def run_worker(worker_id, accounts, create_all_layers, pipelined, window_size, queue):
+    """
+    Play the accounts forever, sending the statistics of each session to the supervisor now and then.
+    Each report carries the pid of the worker so that a late report from a dead worker can be recognized.
+    """
+    reset_after_fork('bot-%d.log' % worker_id)
+    log = get_channel('worker')
+    reactor = Reactor()
+    trackers = []
+    for account in accounts:
+        tracker = SessionTracker(account, create_all_layers, pipelined, window_size)
+        tracker.session = Session((tracker.server, tracker.port), tracker.make_layers, tracker.username, log)
+        reactor.add_session(tracker.session)
+        trackers.append(tracker)
+    pid = os.getpid()
+    next_report_time = time.time()
+    while True:
+        reactor.run_once()
+        now = time.time()
+        if now >= next_report_time:
+            queue.put((worker_id, pid, [session_tracker.get_statistics() for session_tracker in trackers]))
+            next_report_time = now + REPORT_INTERVAL
+
+
+class Worker:
+    def __init__(self, worker_id, accounts):
+        self.worker_id = worker_id
+        self.accounts = accounts
+        self.process = None
+        self.start_time = None
+        self.restart_time = 0
+        self.backoff = MIN_RESTART_BACKOFF
+
+
+class Supervisor:
+    def __init__(self, accounts, nworkers, create_all_layers, pipelined=False, window_size=DEFAULT_WINDOW_SIZE, log=None):
+        """
+        @param accounts: a list of (username, password, server, port) tuples
+        @param nworkers: the number of worker processes
+        @param create_all_layers: a function like net.create_all_layers
+        @param pipelined: True to ping right after each command instead of in lock step
+        @param window_size: the (width, height) of the window to report to the server
+        @param log: a file for the reports, or None
+        """
+        self.create_all_layers = create_all_layers
+        self.pipelined = pipelined
+        self.window_size = window_size
+        self.log = log
+        self.queue = multiprocessing.Queue()
+        # deal the accounts to the workers like cards
+        self.workers = []
+        for worker_id in range(min(nworkers, len(accounts))):
+            self.workers.append(Worker(worker_id, accounts[worker_id::nworkers]))
+        self.nrestarts = 0
+        # the latest statistics of each session, by username
+        self.statistics = {}
+        # the statistics of sessions whose worker was restarted, with the counts of every old worker, by username
+        self.carried_statistics = {}
+        self.last_report_time = time.time()
+        self.last_report_screens = 0
+
+    def remark(self, message):
+        if self.log:
+            print >> self.log, message
+
+    def start_worker(self, worker, now):
+        args = (worker.worker_id, worker.accounts, self.create_all_layers, self.pipelined, self.window_size, self.queue)
+        worker.process = multiprocessing.Process(target=run_worker, args=args)
+        worker.process.daemon = True
+        worker.process.start()
+        worker.start_time = now
+        self.remark('started worker %d (pid %d) with %d accounts' % (worker.worker_id, worker.process.pid, len(worker.accounts)))
+
+    def notify_worker_death(self, worker, now):
+        self.remark('ERROR: worker %d died with exit code %s' % (worker.worker_id, worker.process.exitcode))
+        worker.process = None
+        if now - worker.start_time >= STABLE_WORKER_SECONDS:
+            worker.backoff = MIN_RESTART_BACKOFF
+        worker.restart_time = now + worker.backoff
+        worker.backoff = min(worker.backoff * 2, MAX_RESTART_BACKOFF)
+        self.nrestarts += 1
+        # the new worker counts from zero, so keep what the old one counted
+        for username, password, server, port in worker.accounts:
+            stats = self.statistics.pop(username, None)
+            if not stats:
+                continue
+            carried = self.carried_statistics.get(username)
+            if carried:
+                for name in COUNTED_STATISTICS:
+                    carried[name] += stats[name]
+            else:
+                self.carried_statistics[username] = dict(stats)
+
+    def check_workers(self, now):
+        for worker in self.workers:
+            if worker.process is None:
+                if worker.restart_time <= now:
+                    self.start_worker(worker, now)
+            elif not worker.process.is_alive():
+                worker.process.join()
+                self.notify_worker_death(worker, now)
+
+    def collect(self, timeout):
+        """
+        Wait for statistics from the workers.
+        A report that a worker sent before it died can arrive after its counts were carried,
+        so only reports from the current process of each worker are used.
+        """
+        try:
+            worker_id, pid, session_statistics = self.queue.get(True, timeout)
+        except Queue.Empty:
+            return
+        process = self.workers[worker_id].process
+        if process is None or process.pid != pid:
+            return
+        for stats in session_statistics:
+            self.statistics[stats['username']] = stats
+
+    def get_session_statistics(self):
+        """
+        @return: the statistics of each session, including the counts of its restarted workers
+        """
+        result = []
+        for username in sorted(set(self.statistics) | set(self.carried_statistics)):
+            stats = self.statistics.get(username)
+            carried = self.carried_statistics.get(username)
+            if stats is None:
+                # the restarted worker has not reported yet
+                result.append(dict(carried))
+                continue
+            stats = dict(stats)
+            if carried:
+                for name in COUNTED_STATISTICS:
+                    stats[name] += carried[name]
+            result.append(stats)
+        return result
+
+    def report(self, now):
+        session_statistics = self.get_session_statistics()
+        total_screens = sum(stats['screens'] for stats in session_statistics)
+        total_deaths = sum(stats['deaths'] for stats in session_statistics)
+        elapsed = now - self.last_report_time
+        rate = (total_screens - self.last_report_screens) / elapsed if elapsed else 0.0
+        self.remark('%s: %d sessions, %d screens (%.1f per second), %d deaths, %d worker restarts' % (
+            time.asctime(), len(session_statistics), total_screens, rate, total_deaths, self.nrestarts))
+        for stats in session_statistics:
+            rtt = stats['rtt']
+            self.remark('\t%s@%s: %d connections, %d crashes, %d screens, %d deaths, turn %d, rtt %s' % (
+                stats['username'], stats['server'], stats['connections'], stats['crashes'],
+                stats['screens'], stats['deaths'], stats['turn'], '%.3f' % rtt if rtt is not None else '?'))
+        self.last_report_time = now
+        self.last_report_screens = total_screens
+
+    def run_once(self):
+        now = time.time()
+        self.check_workers(now)
+        self.collect(1.0)
+        now = time.time()
+        if now - self.last_report_time >= REPORT_INTERVAL:
+            self.report(now)
+
+    def stop(self):
+        for worker in self.workers:
+            if worker.process is not None:
+                worker.process.terminate()
+                worker.process.join()
+                worker.process = None
+
+    def run(self):
+        try:
+            while True:
+                self.run_once()
+        finally:
+            self.stop()
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("-a", "--accounts", dest="accounts_filename",
+                      help="a file with a username, a password and optionally a server[:port] on each line", metavar="FILENAME")
+    parser.add_option("-w", "--workers", dest="nworkers", type="int", default=multiprocessing.cpu_count(),
+                      help="the number of worker processes", metavar="COUNT")
+    parser.add_option("-s", "--server", dest="server", default="nethack.alt.org",
+                      help="the telnet server of accounts that do not name one", metavar="SERVER")
+    parser.add_option("--port", dest="port", type="int", default=23,
+                      help="the port of accounts that do not name one", metavar="PORT")
+    parser.add_option("--pipelined", dest="pipelined", action="store_true", default=False,
+                      help="ping right after each command instead of waiting for the screen to start")
+    parser.add_option("--window-size", dest="window_size", default="%dx%d" % DEFAULT_WINDOW_SIZE,
+                      help="the window size to report to the server", metavar="WIDTHxHEIGHT")
+    (options, args) = parser.parse_args()
+    if not options.accounts_filename:
+        parser.error('an accounts file is required')
+    # net imports every layer of the bot, so only the entry point needs it
+    from net import create_all_layers, read_accounts
+    accounts = read_accounts(options.accounts_filename, options.server, options.port)
+    window_size = tuple(int(x) for x in options.window_size.split('x'))
+    supervisor = Supervisor(accounts, options.nworkers, create_all_layers, options.pipelined, window_size, get_channel('supervisor'))
+    supervisor.run()
+
+if __name__ == '__main__':
+    main()
@@ -7,6 +7,7 @@ import time
 
 from AscUtil import no_op, hex_to_ascii
 from cosby_log import cosby_log
+from AscLog import WARNING, ERROR
 
 SE = chr(240)
 SB = chr(250)
@@ -16,11 +17,54 @@ DO = chr(253)
 DONT = chr(254)
 IAC = chr(255)
 
+# telnet options
+TELOPT_ECHO = chr(1)
+TELOPT_SGA = chr(3)
+TELOPT_STATUS = chr(5)
+TELOPT_TTYPE = chr(24)
+TELOPT_NAWS = chr(31)
+TELOPT_TSPEED = chr(32)
+TELOPT_LFLOW = chr(33)
+TELOPT_XDISPLOC = chr(35)
+TELOPT_NEW_ENVIRON = chr(39)
+
+# subnegotiation commands of the terminal type option
+TTYPE_IS = chr(0)
+TTYPE_SEND = chr(1)
+
+DEFAULT_TERMINAL_TYPE = 'xterm-color'
+DEFAULT_WINDOW_SIZE = (160, 48)
+
 STATE_WANT_TO_SEND_DATA = 0
 STATE_WAITING_FOR_DATA = 1
 STATE_WANT_TO_SEND_PING = 2
 STATE_WAITING_FOR_DATA_AND_PONG = 3
 
+# A ping is a request to enable one of these unassigned options,
+# and the server refuses it with a pong.
+# Pipelined pings cycle through them so that each pong can be matched to its ping.
+PING_OPTIONS = [chr(code) for code in range(0x63, 0x73)]
+
+# the weight of each new round trip time in the smoothed round trip time
+RTT_GAIN = 0.125
+
+
+def get_telnet_command_end(msg, start=0):
+    """
+    Find the end of the telnet command that starts with the escape character at the start index.
+    @return: the index just past the command, or -1 if the command is not complete
+    """
+    if len(msg) - start < 2:
+        return -1
+    if msg[start+1] == SB:
+        end_index = msg.find(IAC + SE, start + 2)
+        if end_index < 0:
+            return -1
+        return end_index + 2
+    elif len(msg) - start < 3:
+        return -1
+    else:
+        return start + 3
 
 def get_telnet_command(msg):
     """
@@ -29,33 +73,163 @@ def get_telnet_command(msg):
     """
     if not msg.startswith(IAC):
         return ''
-    if len(msg) == 1:
+    end_index = get_telnet_command_end(msg)
+    if end_index < 0:
         return ''
-    if msg.startswith(IAC + SB):
-        end_index = msg.find(IAC + SE)
-        if end_index < 0:
-            return ''
-        return msg[:end_index+2]
-    elif len(msg) == 2:
+    return msg[:end_index]
+
+def make_option_responses():
+    """
+    @return: (accept_responses, refuse_responses) that map each option command to its answer
+    """
+    accept_responses = {}
+    refuse_responses = {}
+    for code in range(256):
+        option = chr(code)
+        accept_responses[IAC + DO + option] = IAC + WILL + option
+        refuse_responses[IAC + DO + option] = IAC + WONT + option
+        refuse_responses[IAC + DONT + option] = IAC + WONT + option
+        accept_responses[IAC + WILL + option] = IAC + DO + option
+        refuse_responses[IAC + WILL + option] = IAC + DONT + option
+        refuse_responses[IAC + WONT + option] = IAC + DONT + option
+    return accept_responses, refuse_responses
+
+ACCEPT_RESPONSES, REFUSE_RESPONSES = make_option_responses()
+
+def escape_iac(data):
+    """
+    Double each escape character so that binary data can be sent in a subnegotiation.
+    """
+    return data.replace(IAC, IAC + IAC)
+
+
+class Negotiator:
+    """
+    Answer the telnet option negotiation of the server.
+    The answers are built once, and the state of each option is tracked
+    so that a request for the state that an option is already in is not answered again.
+    """
+    # the options that we agree to perform when the server asks
+    local_options = (TELOPT_ECHO, TELOPT_TTYPE, TELOPT_NAWS)
+    # the options that we agree to let the server perform when it offers
+    remote_options = (TELOPT_SGA,)
+
+    def __init__(self, terminal_type=DEFAULT_TERMINAL_TYPE, window_size=DEFAULT_WINDOW_SIZE):
+        """
+        @param terminal_type: the terminal type to report
+        @param window_size: the (width, height) of the window to report
+        """
+        self.terminal_type = terminal_type
+        self.local_enabled = set()
+        self.remote_enabled = set()
+        # the options that have been refused, so that a repeated request is not refused again
+        self.local_refused = set()
+        self.remote_refused = set()
+        # the subnegotiation to send right after agreeing to perform an option
+        self.subnegotiations = {}
+        self.subnegotiations[TELOPT_TTYPE] = self.get_terminal_type_subnegotiation()
+        self.set_window_size(window_size)
+        # answers to subnegotiation requests
+        self.subnegotiation_responses = {
+                IAC + SB + TELOPT_TTYPE + TTYPE_SEND + IAC + SE : self.subnegotiations[TELOPT_TTYPE]}
+
+    def get_terminal_type_subnegotiation(self):
+        return IAC + SB + TELOPT_TTYPE + TTYPE_IS + escape_iac(self.terminal_type) + IAC + SE
+
+    def set_window_size(self, window_size):
+        """
+        @return: the subnegotiation to send if the server already knows the window size, or an empty string
+        """
+        width, height = window_size
+        self.window_size = window_size
+        size = chr(width >> 8) + chr(width & 0xff) + chr(height >> 8) + chr(height & 0xff)
+        self.subnegotiations[TELOPT_NAWS] = IAC + SB + TELOPT_NAWS + escape_iac(size) + IAC + SE
+        if TELOPT_NAWS in self.local_enabled:
+            return self.subnegotiations[TELOPT_NAWS]
         return ''
-    else:
-        return msg[:3]
+
+    def get_response(self, msg):
+        """
+        @param msg: a three byte option command from the server
+        @return: the bytes to send back, or an empty string if no answer is needed,
+        or None if the command is not an option command
+        """
+        command = msg[1:2]
+        option = msg[2:]
+        if command == DO:
+            if option not in self.local_options:
+                if option in self.local_refused:
+                    return ''
+                self.local_refused.add(option)
+                return REFUSE_RESPONSES[msg]
+            if option in self.local_enabled:
+                return ''
+            self.local_enabled.add(option)
+            return ACCEPT_RESPONSES[msg] + self.subnegotiations.get(option, '')
+        elif command == DONT:
+            if option not in self.local_enabled:
+                return ''
+            self.local_enabled.remove(option)
+            return REFUSE_RESPONSES[msg]
+        elif command == WILL:
+            if option not in self.remote_options:
+                if option in self.remote_refused:
+                    return ''
+                self.remote_refused.add(option)
+                return REFUSE_RESPONSES[msg]
+            if option in self.remote_enabled:
+                return ''
+            self.remote_enabled.add(option)
+            return ACCEPT_RESPONSES[msg]
+        elif command == WONT:
+            if option not in self.remote_enabled:
+                return ''
+            self.remote_enabled.remove(option)
+            return REFUSE_RESPONSES[msg]
+        return None
+
+    def get_subnegotiation_response(self, msg):
+        """
+        @param msg: a subnegotiation from the server, including the escape sequences around it
+        @return: the bytes to send back, or an empty string if no answer is needed
+        """
+        return self.subnegotiation_responses.get(msg, '')
 
 
 class Telnet:
-    def __init__(self):
+    def __init__(self, pipelined=False, terminal_type=DEFAULT_TERMINAL_TYPE, window_size=DEFAULT_WINDOW_SIZE):
+        """
+        @param pipelined: True to also send a ping right after each command, which measures the round trip without waiting for the answer
+        @param terminal_type: the terminal type to report to the server
+        @param window_size: the (width, height) of the window to report to the server
+        """
+        self.pipelined = pipelined
+        self.negotiator = Negotiator(terminal_type, window_size)
         self.network_state = STATE_WAITING_FOR_DATA
+        # the start of a telnet command that was cut off at the end of the last message
         self.inbuffer = ''
-        self.inbuffer_ansi = ''
-        self.outbuffer = ''
+        # the runs of data received since the last screen, joined when the screen is delivered
+        self.inbuffer_ansi = []
+        # the bytes before outbuffer_start have already been sent
+        self.outbuffer = bytearray()
+        self.outbuffer_start = 0
+        # the number of bytes of the current ping that have already been sent
+        self.ping_start = 0
         self.user_command = ''
         self.listeners = []
         self.custom_action = no_op
         self.npings = 0
         self.npongs = 0
+        # this counts the commands that have been completely sent
+        self.ncommands = 0
+        # (option, send time, command count, framing) for each ping that has not been answered,
+        # where a framing ping was sent after the answer to the command had started to arrive
+        self.pings_in_flight = []
+        self.last_rtt = None
+        self.smoothed_rtt = None
 
     def transition(self, new_state):
-        cosby_log(str(self.network_state) + '->' + str(new_state))
+        cosby_log('transition', (self.network_state, new_state))
         self.network_state = new_state
     
     def get_ping_count(self):
@@ -64,6 +238,18 @@ class Telnet:
     def get_pong_count(self):
         return self.npongs
 
+    def get_last_rtt(self):
+        """
+        @return: the seconds between sending the last answered ping and receiving its pong, or None
+        """
+        return self.last_rtt
+
+    def get_smoothed_rtt(self):
+        """
+        @return: a moving average of the round trip time in seconds, or None
+        """
+        return self.smoothed_rtt
+
     def get_network_state(self):
         return self.network_state
 
@@ -89,90 +275,195 @@ class Telnet:
                 self.outbuffer += '\n'
         self.user_command = commands[-1]
 
+    def set_window_size(self, window_size):
+        """
+        @param window_size: the new (width, height) of the window to report to the server
+        """
+        self.send_control_response(self.negotiator.set_window_size(window_size))
+
+    def send_control_response(self, response):
+        if not response:
+            return
+        self.outbuffer += response
+        if self.network_state == STATE_WAITING_FOR_DATA:
+            self.transition(STATE_WANT_TO_SEND_PING)
+        elif self.pipelined and self.network_state == STATE_WAITING_FOR_DATA_AND_PONG:
+            # answer now instead of waiting for the pong
+            self.transition(STATE_WANT_TO_SEND_DATA)
+
     def process_incoming_control_subcommand(self, msg):
-        cosby_log('subcommand:', hex_to_ascii(msg))
+        self.send_control_response(self.negotiator.get_subnegotiation_response(msg))
 
     def process_incoming_normal(self, msg):
         assert msg
-        self.inbuffer_ansi += msg
+        self.inbuffer_ansi.append(msg)
         if self.network_state == STATE_WAITING_FOR_DATA:
             self.transition(STATE_WANT_TO_SEND_PING)
+        elif self.network_state == STATE_WAITING_FOR_DATA_AND_PONG and not self.has_framing_ping():
+            # the pipelined ping went out before any of the answer,
+            # so its pong could overtake the answer and it cannot frame the screen
+            self.transition(STATE_WANT_TO_SEND_PING)
 
-    def process_incoming_control(self, msg):
-        cosby_log('control sequence:', hex_to_ascii(msg))
-        ctrl_io = {
-            IAC + DO   + '\x18' : IAC + WILL + '\x18' + IAC + SB + '\x18\x00' + 'xterm-color' + IAC + SE,
-            IAC + DO   + '\x20' : IAC + WONT + '\x20',
-            IAC + DO   + '\x23' : IAC + WONT + '\x23',
-            IAC + DO   + '\x27' : IAC + WONT + '\x27',
-            IAC + WILL + '\x03' : IAC + DO   + '\x03',
-            IAC + DO   + '\x01' : IAC + WILL + '\x01',
-            IAC + DO   + '\x1f' : IAC + WILL + '\x1f' + IAC + SB + '\x1f\x00\xa0\x00\x30' + IAC + SE,
-            IAC + WILL + '\x05' : IAC + DONT + '\x05',
-            IAC + DO   + '\x21' : IAC + WONT + '\x21',
-            IAC + WILL + '\x01' : IAC + DONT + '\x01',
-            IAC + DONT + '\x01' : IAC + WONT + '\x01'
-        }
-        if msg == IAC + WONT + '\x63':
+    def has_framing_ping(self):
+        """
+        @return: True if a ping in flight was sent after the answer to the latest command had started to arrive
+        """
+        for ping_option, send_time, command_count, framing in self.pings_in_flight:
+            if framing and command_count == self.ncommands:
+                return True
+        return False
+
+    def get_ping_option(self):
+        if self.pipelined:
+            return PING_OPTIONS[self.npings % len(PING_OPTIONS)]
+        return PING_OPTIONS[0]
+
+    def notify_rtt(self, rtt):
+        self.last_rtt = rtt
+        if self.smoothed_rtt is None:
+            self.smoothed_rtt = rtt
+        else:
+            self.smoothed_rtt += RTT_GAIN * (rtt - self.smoothed_rtt)
+
+    def deliver_screen(self):
+        if self.inbuffer_ansi:
+            # the listeners parse the screen as a str, so the runs are joined rather than viewed,
+            # and a screen that arrived as a single run is passed on without a copy
+            screen = ''.join(self.inbuffer_ansi)
+            sys.stdout.write(screen)
+            sys.stdout.flush()
+            for listener in self.listeners:
+                listener.process_incoming(screen)
+        else:
+            cosby_log('ERROR: received a pong but no ansi buffer', level=ERROR)
+        self.inbuffer_ansi = []
+
+    def process_pong(self, option):
+        # pongs come back in the order that the pings were sent
+        while self.pings_in_flight:
+            ping_option, send_time, command_count, framing = self.pings_in_flight.pop(0)
+            if ping_option == option:
+                break
+        else:
+            cosby_log('ERROR: received a pong for a ping that is not in flight', level=ERROR)
+            return
+        self.npongs += 1
+        self.notify_rtt(time.time() - send_time)
+        if not self.pipelined:
             assert self.network_state == STATE_WAITING_FOR_DATA_AND_PONG
-            self.npongs += 1
             self.transition(STATE_WANT_TO_SEND_DATA)
-            if self.inbuffer_ansi:
-                sys.stdout.write(self.inbuffer_ansi)
-                sys.stdout.flush()
-                for listener in self.listeners:
-                    listener.process_incoming(self.inbuffer_ansi)
-            else:
-                cosby_log('ERROR: received a pong but no ansi buffer')
-            self.inbuffer_ansi = ''
-        elif msg in ctrl_io:
-            response = ctrl_io[msg]
-            self.outbuffer += response
-            if self.network_state == STATE_WAITING_FOR_DATA:
-                self.transition(STATE_WANT_TO_SEND_PING)
+            self.deliver_screen()
+            return
+        if self.network_state != STATE_WAITING_FOR_DATA_AND_PONG or command_count < self.ncommands:
+            # the ping was sent before the latest command, so it does not frame the screen
+            return
+        if framing:
+            # as in lock step, the answer had started to arrive before the ping was sent
+            self.transition(STATE_WANT_TO_SEND_DATA)
+            self.deliver_screen()
+        elif not self.pings_in_flight:
+            # the server has not answered the command yet,
+            # and the first data of the answer will trigger a framing ping
+            self.transition(STATE_WAITING_FOR_DATA)
+
+    def process_incoming_control(self, msg):
+        if msg.startswith(IAC + WONT) and msg[2:] in PING_OPTIONS:
+            self.process_pong(msg[2:])
+            return
+        response = self.negotiator.get_response(msg)
+        if response is None:
+            cosby_log('I do not know how to respond to the telnet sequence:', hex_to_ascii(msg), WARNING)
         else:
-            cosby_log('I do not know how to respond to the telnet sequence.')
+            self.send_control_response(response)
 
     def process_incoming(self, msg):
         #print >> self.log, '%s: received %d bytes' % (time.asctime(), len(msg))
         cosby_log("incoming message", msg)
-        self.inbuffer += msg
-        while True:
-            index = self.inbuffer.find(IAC)
-            if index == 0:
-                command = get_telnet_command(self.inbuffer)
-                if command.startswith(IAC + SB):
-                    self.process_incoming_control_subcommand(command)
-                else:
-                    self.process_incoming_control(command)
-                self.inbuffer = self.inbuffer[len(command):]
-            elif index > 0:
-                self.process_incoming_normal(self.inbuffer[:index])
-                self.inbuffer = self.inbuffer[index:]
-            else:
-                if self.inbuffer:
-                    self.process_incoming_normal(self.inbuffer)
-                self.inbuffer = ''
+        if self.inbuffer:
+            msg = self.inbuffer + msg
+            self.inbuffer = ''
+        # A message without telnet commands is kept whole,
+        # otherwise each run of normal data is sliced out once.
+        start = 0
+        while start < len(msg):
+            index = msg.find(IAC, start)
+            if index < 0:
+                self.process_incoming_normal(msg[start:] if start else msg)
                 break
+            if index > start:
+                self.process_incoming_normal(msg[start:index])
+            end_index = get_telnet_command_end(msg, index)
+            if end_index < 0:
+                # wait for the rest of the command
+                self.inbuffer = msg[index:]
+                break
+            command = msg[index:end_index]
+            if command.startswith(IAC + SB):
+                self.process_incoming_control_subcommand(command)
+            else:
+                self.process_incoming_control(command)
+            start = end_index
 
-    def get_pending_output(self):
+    def get_ping(self):
+        invalid_request_as_ping = IAC + DO + self.get_ping_option()
+        return invalid_request_as_ping
+
+    def get_pending_buffers(self):
+        """
+        In pipelined mode the ping is queued behind the command,
+        so that both can go out in one send.
+        @return: a list of the buffers to send in order, which is empty if there is nothing to send
+        """
         if self.network_state == STATE_WANT_TO_SEND_PING:
-            invalid_request_as_ping = IAC + DO + '\x63'
-            return invalid_request_as_ping 
+            return [self.get_ping()[self.ping_start:]]
         elif self.network_state == STATE_WANT_TO_SEND_DATA:
-            return self.outbuffer
+            if self.outbuffer_start == len(self.outbuffer):
+                return []
+            # this view of the unsent bytes is only valid until the buffer changes
+            buffers = [buffer(self.outbuffer, self.outbuffer_start)]
+            if self.pipelined:
+                buffers.append(self.get_ping())
+            return buffers
         else:
+            return []
+
+    def get_pending_output(self):
+        buffers = self.get_pending_buffers()
+        if not buffers:
             return None
+        if len(buffers) == 1:
+            return buffers[0]
+        return ''.join(map(str, buffers))
 
     def notify_bytes_sent(self, nsent):
+        """
+        @param nsent: the number of bytes of the pending output that were sent, which may run past the command into the ping
+        """
         if self.network_state == STATE_WANT_TO_SEND_PING:
-            assert nsent == 3
+            self.ping_start += nsent
+            if self.ping_start < len(self.get_ping()):
+                return
+            self.ping_start = 0
+            framing = bool(self.inbuffer_ansi)
+            self.pings_in_flight.append((self.get_ping_option(), time.time(), self.ncommands, framing))
             self.npings += 1
             self.transition(STATE_WAITING_FOR_DATA_AND_PONG)
         elif self.network_state == STATE_WANT_TO_SEND_DATA:
-            self.outbuffer = self.outbuffer[nsent:]
-            if not self.outbuffer:
-                self.transition(STATE_WAITING_FOR_DATA)
+            ncommand_bytes = min(nsent, len(self.outbuffer) - self.outbuffer_start)
+            self.outbuffer_start += ncommand_bytes
+            if self.outbuffer_start == len(self.outbuffer):
+                del self.outbuffer[:]
+                self.outbuffer_start = 0
+                if nsent:
+                    self.ncommands += 1
+                if self.pipelined and nsent:
+                    # ping right away so the pong frames the answer to the command
+                    self.transition(STATE_WANT_TO_SEND_PING)
+                    if nsent > ncommand_bytes:
+                        # the ping went out in the same send as the command
+                        self.notify_bytes_sent(nsent - ncommand_bytes)
+                else:
+                    self.transition(STATE_WAITING_FOR_DATA)
         else:
             assert False
 
@@ -0,0 +1,545 @@
+"""
+An ANSI terminal emulator that keeps the screen in flat planes.
+
+The glyph, foreground, background and attributes of the cells are stored
+in parallel bytearrays indexed by row * ncols + col.
+Each message is parsed in one pass, and the indices of the cells that it changed
+are collected in a damage set so that the layers above can look at only those cells.
+For the existing callers the lines attribute is a list of rows of SquareView objects,
+which read the planes like AnsiSquare objects.
+"""
+
+import re
+
+from AscTelnet import DEFAULT_WINDOW_SIZE
+
+ESC = '\x1b'
+
+# attribute bits
+ATTR_BOLD = 1
+ATTR_UNDERLINE = 2
+ATTR_BLINK = 4
+ATTR_REVERSE = 8
+
+BLANK_GLYPH = ord(' ')
+
+# An escape sequence that is cut off at the end of a message is kept for the next message,
+# but a longer run of junk that starts with an escape is dropped.
+MAX_PENDING_LENGTH = 64
+
+# Each token is a run of printable characters, a control sequence, a two or three byte escape sequence, or a control character.
+TOKEN_PATTERN = re.compile(
+        r'([^\x00-\x1f\x7f]+)'
+        r'|\x1b\[(\??)([0-9;]*)([\x40-\x7e])'
+        r'|\x1b[()*+](.)'
+        r'|\x1b([^\[()*+])'
+        r'|([\x00-\x1a\x1c-\x1f\x7f])', re.DOTALL)
+
+# This matches the start of an escape sequence that may be completed by the next message.
+INCOMPLETE_PATTERN = re.compile(r'\x1b(\[\??[0-9;]*|[()*+])?\Z')
+
+
+def plane_property(plane_name, doc):
+    """
+    Make a read only SquareView attribute that reads one element of a Terminal plane.
+    """
+    def fget(square):
+        return getattr(square.terminal, plane_name)[square.index]
+    return property(fget, doc=doc)
+
+def attribute_property(bit, doc):
+    """
+    Make a read only SquareView attribute that is 1 if an attribute bit of the cell is set and 0 otherwise.
+    """
+    def fget(square):
+        return int(bool(square.terminal.attributes[square.index] & bit))
+    return property(fget, doc=doc)
+
+
+class Square:
+    """
+    A cell that is not on the screen, like a copy of a cell or a guess at one.
+    It has the attributes of an AnsiSquare.
+    """
+    def __init__(self, char=' ', foreground=0, background=0, bold=0, underline=0, blink=0, rev=0):
+        self.char = char
+        self.foreground = foreground
+        self.background = background
+        self.bold = bold
+        self.underline = underline
+        self.blink = blink
+        self.rev = rev
+
+    def get_attributes(self):
+        attributes = 0
+        if self.bold:
+            attributes |= ATTR_BOLD
+        if self.underline:
+            attributes |= ATTR_UNDERLINE
+        if self.blink:
+            attributes |= ATTR_BLINK
+        if self.rev:
+            attributes |= ATTR_REVERSE
+        return attributes
+
+    def get_key(self):
+        return (self.char, self.foreground, self.background, self.get_attributes())
+
+    def copy(self):
+        return Square(self.char, self.foreground, self.background, self.bold, self.underline, self.blink, self.rev)
+
+    def __eq__(self, other):
+        return hasattr(other, 'get_key') and self.get_key() == other.get_key()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.get_key())
+
+    def __str__(self):
+        return self.char
+
+
+class SquareView(object):
+    """
+    This is a view of one cell of a Terminal with the attributes of an AnsiSquare.
+    The view follows the cell as the screen changes, so use copy() to remember what the cell looked like.
+    """
+    __slots__ = ('terminal', 'index')
+
+    def __init__(self, terminal, index):
+        self.terminal = terminal
+        self.index = index
+
+    def get_char(self):
+        return chr(self.terminal.glyphs[self.index])
+    char = property(get_char, doc='what character is shown in the cell?')
+
+    foreground = plane_property('foregrounds', 'what is the foreground color code, or 0 for the default?')
+    background = plane_property('backgrounds', 'what is the background color code, or 0 for the default?')
+    bold = attribute_property(ATTR_BOLD, 'is the cell bold?')
+    underline = attribute_property(ATTR_UNDERLINE, 'is the cell underlined?')
+    blink = attribute_property(ATTR_BLINK, 'does the cell blink?')
+    rev = attribute_property(ATTR_REVERSE, 'is the cell in reverse video?')
+
+    def get_key(self):
+        terminal = self.terminal
+        index = self.index
+        return (chr(terminal.glyphs[index]), terminal.foregrounds[index], terminal.backgrounds[index], terminal.attributes[index])
+
+    def copy(self):
+        foreground, background, attributes = self.foreground, self.background, self.terminal.attributes[self.index]
+        return Square(self.char, foreground, background,
+                int(bool(attributes & ATTR_BOLD)), int(bool(attributes & ATTR_UNDERLINE)),
+                int(bool(attributes & ATTR_BLINK)), int(bool(attributes & ATTR_REVERSE)))
+
+    def __eq__(self, other):
+        return hasattr(other, 'get_key') and self.get_key() == other.get_key()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.get_key())
+
+    def __str__(self):
+        return self.char
+
+
+class Terminal:
+    """
+    This is a telnet listener that emulates the terminal and passes itself to its own listeners.
+    The damage attribute is the set of the indices of the cells changed by the latest message.
+    """
+    def __init__(self, window_size=DEFAULT_WINDOW_SIZE):
+        """
+        @param window_size: the (width, height) of the screen, which should be the size reported to the server
+        """
+        self.ncols, self.nrows = window_size
+        n = self.nrows * self.ncols
+        self.glyphs = bytearray([BLANK_GLYPH]) * n
+        self.foregrounds = bytearray(n)
+        self.backgrounds = bytearray(n)
+        self.attributes = bytearray(n)
+        self.lines = [[SquareView(self, row * self.ncols + col) for col in range(self.ncols)] for row in range(self.nrows)]
+        self.damage = set()
+        self.listeners = []
+        self.row = 0
+        self.col = 0
+        # a character written in the last column wraps the next character to the next line
+        self.wrap_pending = False
+        self.foreground = 0
+        self.background = 0
+        self.attribute = 0
+        self.saved_state = (0, 0, 0, 0, 0)
+        # the first and last rows that scroll
+        self.scroll_top = 0
+        self.scroll_bottom = self.nrows - 1
+        # the start of an escape sequence that was cut off at the end of the last message
+        self.pending = ''
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def get_location(self):
+        return (self.row, self.col)
+
+    def get_damaged_locations(self):
+        """
+        @return: the sorted (row, col) locations of the cells changed by the latest message
+        """
+        ncols = self.ncols
+        return [divmod(index, ncols) for index in sorted(self.damage)]
+
+    def to_ascii_strings(self):
+        ncols = self.ncols
+        glyphs = self.glyphs
+        return [str(glyphs[start:start + ncols]) for start in range(0, len(glyphs), ncols)]
+
+    def to_ansi_string(self):
+        """
+        @return: a string that redraws the screen and puts the cursor back
+        """
+        arr = [ESC + '[0m' + ESC + '[H' + ESC + '[2J']
+        state = (0, 0, 0)
+        for row in range(self.nrows):
+            arr.append(ESC + '[%d;1H' % (row + 1))
+            for index in range(row * self.ncols, (row + 1) * self.ncols):
+                cell_state = (self.foregrounds[index], self.backgrounds[index], self.attributes[index])
+                if cell_state != state:
+                    arr.append(self.get_sgr_string(*cell_state))
+                    state = cell_state
+                arr.append(chr(self.glyphs[index]))
+        arr.append(ESC + '[0m' + ESC + '[%d;%dH' % (self.row + 1, self.col + 1))
+        return ''.join(arr)
+
+    def get_sgr_string(self, foreground, background, attributes):
+        codes = ['0']
+        for bit, code in ((ATTR_BOLD, '1'), (ATTR_UNDERLINE, '4'), (ATTR_BLINK, '5'), (ATTR_REVERSE, '7')):
+            if attributes & bit:
+                codes.append(code)
+        if foreground:
+            codes.append(str(foreground))
+        if background:
+            codes.append(str(background))
+        return ESC + '[' + ';'.join(codes) + 'm'
+
+    def process_incoming(self, msg):
+        """
+        Update the screen and tell the listeners.
+        @param msg: the bytes received from the server
+        """
+        self.damage = set()
+        self.parse(msg)
+        for listener in self.listeners:
+            listener.process_incoming(self)
+
+    def parse(self, msg):
+        if self.pending:
+            msg = self.pending + msg
+            self.pending = ''
+        pos = 0
+        end = len(msg)
+        match = TOKEN_PATTERN.match
+        while pos < end:
+            m = match(msg, pos)
+            if m is None:
+                tail = msg[pos:]
+                if len(tail) < MAX_PENDING_LENGTH and INCOMPLETE_PATTERN.match(tail):
+                    self.pending = tail
+                    return
+                # skip the escape character of a sequence that is not understood
+                pos += 1
+                continue
+            text, private, params, final, charset, escape, control = m.groups()
+            if text is not None:
+                self.write_text(text)
+            elif final is not None:
+                self.process_csi(private, params, final)
+            elif escape is not None:
+                self.process_escape(escape)
+            elif control is not None:
+                self.process_control(control)
+            # charset designations are ignored
+            pos = m.end()
+
+    def set_cells(self, start, glyphs, foregrounds, backgrounds, attributes):
+        """
+        Overwrite a run of cells and add the cells that changed to the damage set.
+        Each argument after the start is a bytearray of the same length.
+        """
+        end = start + len(glyphs)
+        old_glyphs = self.glyphs
+        old_foregrounds = self.foregrounds
+        old_backgrounds = self.backgrounds
+        old_attributes = self.attributes
+        if (old_glyphs[start:end] == glyphs and old_foregrounds[start:end] == foregrounds
+                and old_backgrounds[start:end] == backgrounds and old_attributes[start:end] == attributes):
+            return
+        damage = self.damage
+        for offset in range(len(glyphs)):
+            index = start + offset
+            if (old_glyphs[index] != glyphs[offset] or old_foregrounds[index] != foregrounds[offset]
+                    or old_backgrounds[index] != backgrounds[offset] or old_attributes[index] != attributes[offset]):
+                damage.add(index)
+        old_glyphs[start:end] = glyphs
+        old_foregrounds[start:end] = foregrounds
+        old_backgrounds[start:end] = backgrounds
+        old_attributes[start:end] = attributes
+
+    def erase(self, start, end):
+        """
+        Blank the cells with indices in [start, end).
+        """
+        n = end - start
+        if n > 0:
+            self.set_cells(start, bytearray([BLANK_GLYPH]) * n, bytearray(n), bytearray(n), bytearray(n))
+
+    def copy_cells(self, source, target, n):
+        """
+        Copy n cells starting at the source index to the cells starting at the target index.
+        """
+        if n > 0:
+            self.set_cells(target, self.glyphs[source:source + n], self.foregrounds[source:source + n],
+                    self.backgrounds[source:source + n], self.attributes[source:source + n])
+
+    def scroll_up(self, top, bottom, count):
+        """
+        Move rows top + count through bottom up by count rows and blank the rows at the bottom.
+        """
+        count = min(count, bottom - top + 1)
+        ncols = self.ncols
+        self.copy_cells((top + count) * ncols, top * ncols, (bottom - top + 1 - count) * ncols)
+        self.erase((bottom + 1 - count) * ncols, (bottom + 1) * ncols)
+
+    def scroll_down(self, top, bottom, count):
+        """
+        Move rows top through bottom - count down by count rows and blank the rows at the top.
+        """
+        count = min(count, bottom - top + 1)
+        ncols = self.ncols
+        # copy from the bottom up so that the rows are not overwritten before they are moved
+        for row in range(bottom, top + count - 1, -1):
+            self.copy_cells((row - count) * ncols, row * ncols, ncols)
+        self.erase(top * ncols, (top + count) * ncols)
+
+    def line_feed(self):
+        if self.row == self.scroll_bottom:
+            self.scroll_up(self.scroll_top, self.scroll_bottom, 1)
+        elif self.row < self.nrows - 1:
+            self.row += 1
+
+    def reverse_line_feed(self):
+        if self.row == self.scroll_top:
+            self.scroll_down(self.scroll_top, self.scroll_bottom, 1)
+        elif self.row > 0:
+            self.row -= 1
+
+    def move_cursor(self, row, col):
+        self.row = max(0, min(row, self.nrows - 1))
+        self.col = max(0, min(col, self.ncols - 1))
+        self.wrap_pending = False
+
+    def put_cell(self, index, glyph):
+        """
+        Write one glyph with the current colors and attributes, adding the cell to the damage set if it changed.
+        """
+        if (self.glyphs[index] != glyph or self.foregrounds[index] != self.foreground
+                or self.backgrounds[index] != self.background or self.attributes[index] != self.attribute):
+            self.damage.add(index)
+            self.glyphs[index] = glyph
+            self.foregrounds[index] = self.foreground
+            self.backgrounds[index] = self.background
+            self.attributes[index] = self.attribute
+
+    def write_text(self, text):
+        ncols = self.ncols
+        if len(text) == 1 and not self.wrap_pending:
+            # most runs are single characters drawn after a cursor movement
+            self.put_cell(self.row * ncols + self.col, ord(text))
+            if self.col == ncols - 1:
+                self.wrap_pending = True
+            else:
+                self.col += 1
+            return
+        text = bytearray(text)
+        pos = 0
+        while pos < len(text):
+            if self.wrap_pending:
+                self.wrap_pending = False
+                self.col = 0
+                self.line_feed()
+            n = min(len(text) - pos, ncols - self.col)
+            start = self.row * ncols + self.col
+            self.set_cells(start, text[pos:pos + n], bytearray([self.foreground]) * n,
+                    bytearray([self.background]) * n, bytearray([self.attribute]) * n)
+            pos += n
+            if self.col + n == ncols:
+                self.col = ncols - 1
+                self.wrap_pending = True
+            else:
+                self.col += n
+
+    def process_control(self, control):
+        if control == '\r':
+            self.col = 0
+            self.wrap_pending = False
+        elif control in '\n\x0b\x0c':
+            self.line_feed()
+            self.wrap_pending = False
+        elif control == '\x08':
+            self.move_cursor(self.row, self.col - 1)
+        elif control == '\t':
+            self.move_cursor(self.row, (self.col // 8 + 1) * 8)
+        # the bell and the character set shifts are ignored
+
+    def process_escape(self, escape):
+        if escape == '7':
+            self.saved_state = (self.row, self.col, self.foreground, self.background, self.attribute)
+        elif escape == '8':
+            row, col, self.foreground, self.background, self.attribute = self.saved_state
+            self.move_cursor(row, col)
+        elif escape == 'D':
+            self.line_feed()
+        elif escape == 'E':
+            self.line_feed()
+            self.move_cursor(self.row, 0)
+        elif escape == 'M':
+            self.reverse_line_feed()
+        elif escape == 'c':
+            self.reset()
+        # keypad modes and the rest are ignored
+
+    def reset(self):
+        self.erase(0, len(self.glyphs))
+        self.move_cursor(0, 0)
+        self.foreground = self.background = self.attribute = 0
+        self.scroll_top = 0
+        self.scroll_bottom = self.nrows - 1
+
+    def process_csi(self, private, params, final):
+        """
+        @param private: '?' for a private mode sequence, or ''
+        @param params: the parameter string
+        @param final: the final character that names the sequence
+        """
+        if private:
+            # private modes like the cursor visibility do not change the screen
+            return
+        if final == 'm':
+            self.process_sgr(params)
+            return
+        args = [int(arg) if arg else 0 for arg in params.split(';')] if params else []
+        first = args[0] if args else 0
+        count = max(first, 1)
+        ncols = self.ncols
+        if final in 'Hf':
+            row = args[0] if args else 0
+            col = args[1] if len(args) > 1 else 0
+            self.move_cursor(max(row, 1) - 1, max(col, 1) - 1)
+        elif final == 'A':
+            self.move_cursor(self.row - count, self.col)
+        elif final in 'Be':
+            self.move_cursor(self.row + count, self.col)
+        elif final in 'Ca':
+            self.move_cursor(self.row, self.col + count)
+        elif final == 'D':
+            self.move_cursor(self.row, self.col - count)
+        elif final in 'G`':
+            self.move_cursor(self.row, count - 1)
+        elif final == 'd':
+            self.move_cursor(count - 1, self.col)
+        elif final == 'J':
+            cursor = self.row * ncols + self.col
+            if first == 0:
+                self.erase(cursor, len(self.glyphs))
+            elif first == 1:
+                self.erase(0, cursor + 1)
+            elif first == 2:
+                self.erase(0, len(self.glyphs))
+        elif final == 'K':
+            line_start = self.row * ncols
+            cursor = line_start + self.col
+            if first == 0:
+                self.erase(cursor, line_start + ncols)
+            elif first == 1:
+                self.erase(line_start, cursor + 1)
+            elif first == 2:
+                self.erase(line_start, line_start + ncols)
+        elif final == 'X':
+            cursor = self.row * ncols + self.col
+            self.erase(cursor, cursor + min(count, ncols - self.col))
+        elif final == 'P':
+            # delete characters, moving the rest of the line left
+            cursor = self.row * ncols + self.col
+            line_end = self.row * ncols + ncols
+            count = min(count, ncols - self.col)
+            self.copy_cells(cursor + count, cursor, line_end - cursor - count)
+            self.erase(line_end - count, line_end)
+        elif final == '@':
+            # insert blanks, moving the rest of the line right
+            cursor = self.row * ncols + self.col
+            line_end = self.row * ncols + ncols
+            count = min(count, ncols - self.col)
+            self.copy_cells(cursor, cursor + count, line_end - cursor - count)
+            self.erase(cursor, cursor + count)
+        elif final == 'L':
+            if self.scroll_top <= self.row <= self.scroll_bottom:
+                self.scroll_down(self.row, self.scroll_bottom, count)
+        elif final == 'M':
+            if self.scroll_top <= self.row <= self.scroll_bottom:
+                self.scroll_up(self.row, self.scroll_bottom, count)
+        elif final == 'S':
+            self.scroll_up(self.scroll_top, self.scroll_bottom, count)
+        elif final == 'T':
+            self.scroll_down(self.scroll_top, self.scroll_bottom, count)
+        elif final == 'r':
+            top = args[0] if args else 0
+            bottom = args[1] if len(args) > 1 else 0
+            top = max(top, 1) - 1
+            bottom = (bottom or self.nrows) - 1
+            if top < bottom < self.nrows:
+                self.scroll_top = top
+                self.scroll_bottom = bottom
+                self.move_cursor(0, 0)
+        # modes, reports and the rest are ignored
+
+    def process_sgr(self, params):
+        args = [int(arg) if arg else 0 for arg in params.split(';')] if params else [0]
+        i = 0
+        while i < len(args):
+            code = args[i]
+            if code == 0:
+                self.foreground = self.background = self.attribute = 0
+            elif code == 1:
+                self.attribute |= ATTR_BOLD
+            elif code == 4:
+                self.attribute |= ATTR_UNDERLINE
+            elif code == 5:
+                self.attribute |= ATTR_BLINK
+            elif code == 7:
+                self.attribute |= ATTR_REVERSE
+            elif code == 22:
+                self.attribute &= ~ATTR_BOLD
+            elif code == 24:
+                self.attribute &= ~ATTR_UNDERLINE
+            elif code == 25:
+                self.attribute &= ~ATTR_BLINK
+            elif code == 27:
+                self.attribute &= ~ATTR_REVERSE
+            elif 30 <= code <= 37 or 90 <= code <= 97:
+                self.foreground = code
+            elif code == 39:
+                self.foreground = 0
+            elif 40 <= code <= 47 or 100 <= code <= 107:
+                self.background = code
+            elif code == 49:
+                self.background = 0
+            elif code in (38, 48):
+                # skip the arguments of an extended color, which is not kept
+                if i + 1 < len(args) and args[i + 1] == 5:
+                    i += 2
+                elif i + 1 < len(args) and args[i + 1] == 2:
+                    i += 4
+            i += 1
@@ -100,6 +100,36 @@ def get_bounding_coordinates(locations):
     col_max = max(col for row, col in locations)
     return (row_min, col_min, row_max, col_max)
 
+def shift_mask(mask, delta):
+    """
+    @return: a mask with bit i + delta set for each bit i set in the given mask
+    """
+    if delta >= 0:
+        return mask << delta
+    return mask >> -delta
+
+def gen_mask_indices(mask):
+    """
+    Yield the index of each bit set in the mask in increasing order.
+    """
+    bits = bin(mask)[:1:-1]
+    index = bits.find('1')
+    while index >= 0:
+        yield index
+        index = bits.find('1', index + 1)
+
+def get_mask_size(mask):
+    """
+    @return: the number of bits set in the mask
+    """
+    return bin(mask).count('1')
+
+def get_lowest_mask_index(mask):
+    """
+    @return: the index of the lowest bit set in a nonzero mask
+    """
+    return (mask & -mask).bit_length() - 1
+
 def distL1(loca, locb):
     return abs(loca[0] - locb[0]) + abs(loca[1] - locb[1])
 
@@ -6,7 +6,8 @@ and farm some puddings
 
 
 from optparse import OptionParser
-from cosby_log import cosby_log
+from cosby_log import cosby_log, coslog
+from AscLog import get_level
 import profile
 import socket
 import select
@@ -21,6 +22,7 @@ from AscTelnet import STATE_WANT_TO_SEND_DATA
 from AscTelnet import STATE_WAITING_FOR_DATA
 from AscTelnet import STATE_WANT_TO_SEND_PING
 from AscTelnet import STATE_WAITING_FOR_DATA_AND_PONG
+from AscReactor import set_nodelay, send_buffers
 from pprint import pprint, pformat
 
 class DebugStop(Exception):
@@ -57,7 +59,7 @@ class Cosby():
             slave.add_bot_command(msg)
 
 
-def main(username, password):
+def main(username, password, server="nethack.alt.org", port=23):
     """
     # farm puddings
     """
@@ -65,7 +67,8 @@ def main(username, password):
         cosby_log('init')
         # create the socket layer
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.connect(("nethack.alt.org", 23))
+        sock.connect((server, port))
+        set_nodelay(sock)
         # create the telnet layer
         telnet = Telnet()
         telnet.set_custom_action(get_screenshot)
@@ -87,10 +90,10 @@ def main(username, password):
                 if sock in haserr:
                     break
                 if sock in canwrite:
-                    data = telnet.get_pending_output()
-                    cosby_log("data", data)
-                    assert data
-                    nsent = sock.send(data)
+                    buffers = telnet.get_pending_buffers()
+                    cosby_log("data", buffers)
+                    assert buffers
+                    nsent = send_buffers(sock, buffers)
                     assert nsent
                     telnet.notify_bytes_sent(nsent)
                 else:
@@ -124,13 +127,21 @@ if __name__ == '__main__':
     parser.add_option("-p", "--password", dest="password",
                       help="password", metavar="PASSWORD")
     parser.add_option("-s", "--server", dest="server",
-                      help="password", metavar="PASSWORD", default="nethack.alt.org")
+                      help="the telnet server to connect to", metavar="SERVER", default="nethack.alt.org")
+    parser.add_option("--port", dest="port", type="int",
+                      help="the port of the telnet server", metavar="PORT", default=23)
+    parser.add_option("--log-level", dest="log_level", default="info",
+                      help="the lowest level of cosby.log records to write: debug, info, warning or error", metavar="LEVEL")
+    parser.add_option("--binary-log", dest="binary_log", action="store_true", default=False,
+                      help="write binary cosby.log records to be read with AscLog")
     (options, args) = parser.parse_args()
 #    parser.add_option("-q", "--quiet",
 #                      action="store_false", dest="verbose", default=True,
 #                      help="don't print status messages to stdout")
     
     (options, args) = parser.parse_args()
-    main(options.username, options.password)
+    coslog.set_level(get_level(options.log_level))
+    coslog.set_binary(options.binary_log)
+    main(options.username, options.password, options.server, options.port)
 
 
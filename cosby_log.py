@@ -5,13 +5,12 @@ and farm some puddings
 """
 
 
-from optparse import OptionParser
-from pprint import pformat
-import time
+from AscLog import get_logger, PrettyValue, DEBUG
 
 
-coslog = open('cosby.log', 'a')
-def cosby_log(msg, var=None):
-    logline = time.asctime() + ": " + msg + ": " + pformat(var)
-    print >> coslog, logline
-
+coslog = get_logger('cosby.log')
+def cosby_log(msg, var=None, level=DEBUG):
+    """
+    The message and value are only formatted if the record is written.
+    """
+    coslog.log(level, '%s: %s', msg, PrettyValue(var))
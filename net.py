@@ -3,6 +3,7 @@ Connect to nethack.alt.org
 and play some nethack.
 """
 
+from optparse import OptionParser
 import profile
 import socket
 import select
@@ -16,13 +17,13 @@ from AscTelnet import STATE_WANT_TO_SEND_DATA
 from AscTelnet import STATE_WAITING_FOR_DATA
 from AscTelnet import STATE_WANT_TO_SEND_PING
 from AscTelnet import STATE_WAITING_FOR_DATA_AND_PONG
+from AscTelnet import DEFAULT_WINDOW_SIZE
 
-from AscAnsi import Ansi, AnsiSquare
+from AscTerminal import Terminal
 
 from AscSelect import ObjectPicker
 
 from AscUtil import ascii_to_meta
-from AscUtil import get_bounding_coordinates
 
 from AscInventory import AscInventory
 from AscInventory import gen_things_that_are_here, get_pick_up_what, gen_floor_items, item_selection_helper
@@ -30,6 +31,10 @@ from AscInventory import gen_things_that_are_here, get_pick_up_what, gen_floor_i
 from AscLore import AscLore, IdGenerator
 
 import AscSokoban
+from AscReplay import Recorder, RecordingSocket
+from AscReactor import Reactor, Session, set_nodelay, send_buffers
+from AscLog import get_level, get_channel, get_sink
+from cosby_log import coslog
 
 # Some important constants are imported here:
 # HM_*
@@ -48,10 +53,12 @@ from AscStatus import *
 
 
 class CidBot:
+    username = 'Cosbytest'
+    password = 'puddnhead'
     def get_username(self):
-        return 'Cosbytest'
+        return self.username
     def get_password(self):
-        return 'puddnhead'
+        return self.password
     def get_role(self):
         return 'Plunderer'
 
@@ -60,12 +67,16 @@ class GatherBot(CidBot):
     """
     This ball of mud constantly needs refactoring.
     """
-    def __init__(self):
+    def __init__(self, username=None, password=None):
+        if username:
+            self.username = username
+        if password:
+            self.password = password
         self.id_generator = IdGenerator()
         self.dungeon = Dungeon()
-        self.log = open('gatherer.log', 'a')
+        self.log = get_channel('gatherer')
         print >> self.log, '__init__'
-        self.message_log = open('messages.log', 'a')
+        self.message_log = get_channel('messages')
         self.levelmap = None
         self.lore = AscLore()
         self.inventory = AscInventory(self.lore)
@@ -709,35 +720,20 @@ class GatherBot(CidBot):
         For detection purposes any ascii '-' or '|' is a wall.
         The match must be bidirectional.
         """
-        # Define wall ascii symbols for the purpose of sokoban level detection.
-        sokoban_wall_characters = ('-', '|')
         # Get the set of wall locations on the observed ansi map.
         raw_wall_locations = set()
         for loc in self.levelmap.level:
             row, col = loc
             ansi_square = ansi.lines[row][col]
-            if ansi_square.char in sokoban_wall_characters:
+            if ansi_square.char in AscSokoban.SOKOBAN_WALL_CHARACTERS:
                 raw_wall_locations.add(loc)
         # If no walls were observed then the level was not detected.
         # TODO what about engulfing?
         if not raw_wall_locations:
             print >> self.log, 'no matching sokoban level was found (no walls were seen)'
             return None
-        # Get the bounding wall rectangle of the observed ansi map on the screen.
-        row_min, col_min, row_max, col_max = get_bounding_coordinates(raw_wall_locations)
-        # Spacially translate wall locations to the upper left.
-        translated_wall_locations = set()
-        for loc in raw_wall_locations:
-            row, col = loc
-            translated_location = (row - row_min, col - col_min)
-            translated_wall_locations.add(translated_location)
         # See if the wall pattern matches that of a hard coded Sokoban level.
-        matching_level_names = []
-        for level_string, level_name in AscSokoban.all_level_strings_and_names:
-            level = AscSokoban.sokoban_string_to_map(level_string)
-            sokoban_wall_locations = set(loc for loc, c in level.items() if c in sokoban_wall_characters)
-            if sokoban_wall_locations == translated_wall_locations:
-                matching_level_names.append(level_name)
+        matching_level_names = AscSokoban.get_catalogue().get_matching_level_names(raw_wall_locations)
         # If we got no matches or more than one match then fail.
         if not matching_level_names:
             print >> self.log, 'no matching sokoban level was found'
@@ -756,6 +752,14 @@ class GatherBot(CidBot):
         # Was the dlvl change degenerate?
         if old_dlvl is None:
             print >> self.log, 'descending to the starting location'
+            # A restored game can start in the middle of a sokoban level.
+            sokoban_name = self.detect_sokoban_level(new_ansi)
+            if sokoban_name:
+                print >> self.log, 'resuming a sokoban level'
+                self.levelmap.level_dlvl = new_dlvl
+                self.levelmap.level_branch = LEVEL_BRANCH_SOKOBAN
+                self.levelmap.level_special = LEVEL_SPECIAL_UNKNOWN
+                self.levelmap.init_sokoban(new_ansi, sokoban_name)
             return
         # Decide if the level change was a descent or an ascent.
         if old_dlvl < new_dlvl:
@@ -768,7 +772,8 @@ class GatherBot(CidBot):
         old_player_region = self.levelmap.get_player_region()
         self.levelmap.regions = [r for r in self.levelmap.regions if r is not old_player_region]
         # Remove links from the old level that include the player region.
-        self.levelmap.region_links = [link for link in self.levelmap.region_links if old_player_region not in link.region_pair]
+        self.levelmap.region_links.remove_region(old_player_region)
+        self.dungeon.region_graph.notify_region_links(self.levelmap)
         # Can we find a linking region from the old level?
         self.linking_region = None
         if self.expecting_level_change:
@@ -949,6 +954,7 @@ class GatherBot(CidBot):
         if self.linking_region:
             region.target_region = self.linking_region
             self.linking_region.target_region = region
+            self.dungeon.region_graph.notify_stair_link(region)
             print >> self.log, 'created region:', str(region)
             print >> self.log, 'linking with region:', str(self.linking_region)
         else:
@@ -1332,6 +1338,7 @@ class GatherBot(CidBot):
                 print >> self.log, 'linking existing regions'
                 self.linking_region.target_region = square_region
                 square_region.target_region = self.linking_region
+                self.dungeon.region_graph.notify_stair_link(square_region)
                 self.linking_region = None
             else:
                 if not self.status.blind:
@@ -1850,6 +1857,8 @@ class GatherBot(CidBot):
                 # log the stuck state
                 print >> self.log, 'requesting to use the semi-colon to see why we are stuck'
                 print >> self.log, 'target square: %s  target square state: %d' % (str(next_location), self.levelmap.level[next_location].hard)
+                # write out the recent records that led up to this
+                self.log.dump('the bot seems stuck')
                 # log a stuck screenshot
                 f = open('stuck-screenshot.ansi', 'wb')
                 f.write(ansi.to_ansi_string())
@@ -1881,7 +1890,8 @@ class Nethack:
         # 3 dead or quit
         self.login_state = 0
         self.bot = None
-        self.log = open('nethack.log', 'wt')
+        self.log = get_channel('nethack')
+        self.ndeaths = 0
         self.slaves = []
 
     def set_bot(self, bot):
@@ -1896,7 +1906,6 @@ class Nethack:
 
     def give_order(self, msg):
         print >> self.log, msg
-        self.log.flush()
         for slave in self.slaves:
             slave.add_bot_command(msg)
 
@@ -1942,6 +1951,8 @@ class Nethack:
             return 'q'
         # notice the death message
         if 'You die..' in bloated_string:
+            if self.login_state != 3:
+                self.ndeaths += 1
             self.login_state = 3
             print >> self.log, 'we have apparently died'
             self.log.flush()
@@ -1976,29 +1987,100 @@ def get_screenshot():
     f = open('screenshot.txt', 'wt')
     print >> f, ansi.to_ansi_string()
 
-def main():
+def create_all_layers(username=None, password=None, pipelined=False, window_size=DEFAULT_WINDOW_SIZE):
+    """
+    Stack the ansi, nethack and bot layers on a new telnet layer.
+    @param username: the account name, or None for the default account
+    @param password: the account password, or None for the default account
+    @param pipelined: True to ping right after each command instead of in lock step
+    @param window_size: the (width, height) of the window to report to the server
+    @return: (telnet, ansi, nethack, bot)
+    """
+    # create the telnet layer
+    telnet = Telnet(pipelined, window_size=window_size)
+    # create the ansi terminal layer
+    ansi = Terminal(window_size)
+    telnet.add_listener(ansi)
+    # create the nethack layer
+    nethack = Nethack()
+    nethack.add_slave(telnet)
+    ansi.add_listener(nethack)
+    # create the bot layer
+    bot = GatherBot(username, password)
+    nethack.set_bot(bot)
+    return telnet, ansi, nethack, bot
+
+def create_layers(username=None, password=None, pipelined=False, window_size=DEFAULT_WINDOW_SIZE):
+    """
+    This is like create_all_layers but only the outer layers are returned.
+    @return: (telnet, bot)
+    """
+    telnet, ansi, nethack, bot = create_all_layers(username, password, pipelined, window_size)
+    return telnet, bot
+
+def read_accounts(filename, server="nethack.alt.org", port=23):
+    """
+    Each line of the file has a username, a password, and optionally a server with an optional port.
+    @param filename: the name of the file
+    @param server: the server of the accounts that do not name one
+    @param port: the port of the accounts that do not name one
+    @return: a list of (username, password, server, port) tuples
+    """
+    accounts = []
+    for line in open(filename):
+        words = line.split()
+        if not words or words[0].startswith('#'):
+            continue
+        username, password = words[:2]
+        account_server, account_port = server, port
+        if len(words) > 2:
+            account_server = words[2]
+            if ':' in account_server:
+                account_server, account_port = account_server.split(':')
+                account_port = int(account_port)
+        accounts.append((username, password, account_server, account_port))
+    return accounts
+
+def main_many(accounts, pipelined=False, window_size=DEFAULT_WINDOW_SIZE):
+    """
+    # play nethack repeatedly on many accounts at once in a single select loop
+    @param accounts: a list of (username, password, server, port) tuples
+    @param pipelined: True to ping right after each command instead of in lock step
+    @param window_size: the (width, height) of the window to report to the server
+    """
+    syslog = get_channel('sys')
+    print >> syslog, 'init', len(accounts), 'sessions'
+    reactor = Reactor()
+    for username, password, server, port in accounts:
+        make_layers = lambda username=username, password=password: create_layers(username, password, pipelined, window_size)
+        reactor.add_session(Session((server, port), make_layers, username, syslog))
+    reactor.run()
+
+def main(record_filename=None, server="nethack.alt.org", port=23, pipelined=False, window_size=DEFAULT_WINDOW_SIZE):
     """
     # play nethack repeatedly
+    @param record_filename: if given, each session is recorded for AscReplay to a file with this name and a session number
+    @param server: the telnet server, which may be an AscServer stand-in
+    @param port: the port of the telnet server
+    @param pipelined: True to ping right after each command instead of in lock step
+    @param window_size: the (width, height) of the window to report to the server
     """
+    nsessions = 0
     while True:
-        syslog = open('sys.log', 'a')
+        syslog = get_channel('sys')
         print >> syslog, 'init'
         # create the socket layer
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.connect(("nethack.alt.org", 23))
-        # create the telnet layer
-        telnet = Telnet()
+        s.connect((server, port))
+        set_nodelay(s)
+        recorder = None
+        if record_filename:
+            recorder = Recorder('%s.%d' % (record_filename, nsessions), pipelined=pipelined, window_size=window_size)
+            random.seed(recorder.seed)
+            s = RecordingSocket(s, recorder)
+        nsessions += 1
+        telnet, bot = create_layers(pipelined=pipelined, window_size=window_size)
         telnet.set_custom_action(get_screenshot)
-        # create the ansi terminal layer
-        ansi = Ansi()
-        telnet.add_listener(ansi)
-        # create the nethack layer
-        nethack = Nethack()
-        nethack.add_slave(telnet)
-        ansi.add_listener(nethack)
-        # create the bot layer
-        bot = GatherBot()
-        nethack.set_bot(bot)
         # alternate sending and receiving data until the connection breaks
         while True:
             errors = [s]
@@ -2010,9 +2092,9 @@ def main():
                 if s in haserr:
                     break
                 if s in canwrite:
-                    data = telnet.get_pending_output()
-                    assert data
-                    nsent = s.send(data)
+                    buffers = telnet.get_pending_buffers()
+                    assert buffers
+                    nsent = send_buffers(s, buffers)
                     assert nsent
                     telnet.notify_bytes_sent(nsent)
                 else:
@@ -2036,12 +2118,44 @@ def main():
                 else:
                     print >> syslog, time.asctime()
                     print >> syslog, '\t', 'timout in network state', telnet.network_state
+        if telnet.get_smoothed_rtt() is not None:
+            print >> syslog, 'round trip time: %.3f seconds' % telnet.get_smoothed_rtt()
+        if recorder:
+            recorder.close()
         if not bot.loops_forever():
             print >> syslog, 'the bot does not want to loop forever'
             break
 
 if __name__ == '__main__':
     #profile.run('main()')
-    main()
+    parser = OptionParser()
+    parser.add_option("-r", "--record", dest="record_filename",
+                      help="record each session for replay", metavar="FILENAME")
+    parser.add_option("-s", "--server", dest="server", default="nethack.alt.org",
+                      help="the telnet server to connect to", metavar="SERVER")
+    parser.add_option("--port", dest="port", type="int", default=23,
+                      help="the port of the telnet server", metavar="PORT")
+    parser.add_option("-a", "--accounts", dest="accounts_filename",
+                      help="play every account in this file at once", metavar="FILENAME")
+    parser.add_option("--pipelined", dest="pipelined", action="store_true", default=False,
+                      help="ping right after each command instead of waiting for the screen to start")
+    parser.add_option("--window-size", dest="window_size", default="%dx%d" % DEFAULT_WINDOW_SIZE,
+                      help="the window size to report to the server", metavar="WIDTHxHEIGHT")
+    parser.add_option("--log-level", dest="log_level", default="info",
+                      help="the lowest level of cosby.log records to write: debug, info, warning or error", metavar="LEVEL")
+    parser.add_option("--binary-log", dest="binary_log", action="store_true", default=False,
+                      help="write binary cosby.log records to be read with AscLog")
+    parser.add_option("--module-log-levels", dest="module_log_levels", default="",
+                      help="levels of the bot.log records to write, such as info,dungeon=debug,nethack=warning", metavar="LEVELS")
+    (options, args) = parser.parse_args()
+    coslog.set_level(get_level(options.log_level))
+    coslog.set_binary(options.binary_log)
+    get_sink().set_levels(options.module_log_levels)
+    window_size = tuple(int(x) for x in options.window_size.split('x'))
+    if options.accounts_filename:
+        accounts = read_accounts(options.accounts_filename, options.server, options.port)
+        main_many(accounts, options.pipelined, window_size)
+    else:
+        main(options.record_filename, options.server, options.port, options.pipelined, window_size)
 
 
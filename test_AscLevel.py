@@ -0,0 +1,126 @@
+"""
+Check the cached and repaired distance fields of the level map against a plain breadth first search.
+Run with python -m unittest test_AscLevel.
+"""
+
+import unittest
+import random
+from collections import deque
+
+import AscLevel
+from AscLevelConstants import *
+
+# The level map refers to wall type constants that this tree does not define.
+for name, value in (('WALL_TYPE_PLAIN', 0), ('WALL_TYPE_CAVERN', 1)):
+    if not hasattr(AscLevel, name):
+        setattr(AscLevel, name, value)
+
+HARD_CHOICES = [HM_FLOOR] * 6 + [HM_WALL] * 2 + [HM_OPEN, HM_UNKNOWN]
+
+
+def create_random_level_map(rng, distance_cache_size):
+    """
+    @param rng: a random number generator
+    @param distance_cache_size: the number of distance fields to cache
+    @return: a level map with a random hardmap
+    """
+    level_map = AscLevel.LevelMap(AscLevel.Dungeon(distance_cache_size=distance_cache_size))
+    grid = level_map.level
+    for index in range(len(grid.hard)):
+        grid.hard[index] = rng.choice(HARD_CHOICES)
+    level_map.cache_passable_neighbor_locations()
+    return level_map
+
+def change_random_squares(rng, level_map):
+    """
+    Change the hardmap and boulders of a few random squares and update the passability.
+    """
+    grid = level_map.level
+    for i in range(rng.randint(1, 12)):
+        index = rng.randrange(len(grid.hard))
+        grid.hard[index] = rng.choice(HARD_CHOICES)
+        if rng.random() < 0.2:
+            grid.boulder[index] = 1 - grid.boulder[index]
+    level_map.cache_passable_neighbor_locations()
+
+def get_reference_evaluations(level_map, interesting_locations, taboo_locations):
+    """
+    @return: the distance from an interesting location to each reachable location, found by the simplest search
+    """
+    grid = level_map.level
+    loc_to_dist = {}
+    queue = deque()
+    for loc in interesting_locations:
+        if loc not in taboo_locations:
+            loc_to_dist[loc] = 0
+            queue.append(loc)
+    while queue:
+        loc = queue.popleft()
+        for nloc in grid[loc].passable_neighbor_locations:
+            if nloc not in taboo_locations and nloc not in loc_to_dist:
+                loc_to_dist[nloc] = loc_to_dist[loc] + 1
+                queue.append(nloc)
+    return loc_to_dist
+
+
+class TestLocationEvaluations(unittest.TestCase):
+
+    def test_repair_matches_full_search(self):
+        rng = random.Random(1)
+        for trial in range(40):
+            level_map = create_random_level_map(rng, 8)
+            grid = level_map.level
+            locations = list(grid.locations)
+            interesting_locations = frozenset(rng.sample(locations, 3))
+            scary_locations = frozenset(rng.sample(locations, 40))
+            loc_to_dist = level_map.compute_location_evaluations(interesting_locations, scary_locations)
+            for step in range(6):
+                generation = grid.passable_generation
+                change_random_squares(rng, level_map)
+                changed_locations = grid.get_passable_changes(generation)
+                level_map.repair_location_evaluations(loc_to_dist, interesting_locations, scary_locations, changed_locations)
+                expected = get_reference_evaluations(level_map, interesting_locations, scary_locations)
+                self.assertEqual(loc_to_dist, expected, 'trial %d step %d' % (trial, step))
+
+    def test_cached_fields_match_full_search(self):
+        rng = random.Random(2)
+        for trial in range(20):
+            level_map = create_random_level_map(rng, 2)
+            locations = list(level_map.level.locations)
+            queries = []
+            for i in range(3):
+                queries.append((frozenset(rng.sample(locations, 3)), frozenset(rng.sample(locations, 40))))
+            for step in range(8):
+                change_random_squares(rng, level_map)
+                # more queries than cache entries, so fields are evicted and recomputed as well as repaired
+                for interesting_locations, scary_locations in rng.sample(queries, 2):
+                    loc_to_dist = level_map.get_location_evaluations(interesting_locations, scary_locations)
+                    expected = get_reference_evaluations(level_map, interesting_locations, scary_locations)
+                    self.assertEqual(loc_to_dist, expected, 'trial %d step %d' % (trial, step))
+            self.assertTrue(level_map.distance_cache_repairs)
+
+    def test_nested_fields_match_full_search(self):
+        rng = random.Random(3)
+        for trial in range(40):
+            level_map = create_random_level_map(rng, rng.choice([0, 4]))
+            locations = list(level_map.level.locations)
+            untouchable_locations = set(rng.sample(locations, rng.randrange(0, 300)))
+            scary_locations = untouchable_locations | set(rng.sample(locations, rng.randrange(0, 300)))
+            # some of the interesting locations are taboo for the stricter searches
+            interesting_locations = set(rng.sample(locations, rng.randrange(1, 5))) | set(rng.sample(sorted(scary_locations), 2))
+            taboo_sets = (scary_locations, untouchable_locations, set())[:rng.choice([2, 3])]
+            expected = [get_reference_evaluations(level_map, interesting_locations, taboo_set) for taboo_set in taboo_sets]
+            loc_to_dists = level_map.compute_nested_location_evaluations(interesting_locations, taboo_sets)
+            self.assertEqual(loc_to_dists, expected, 'trial %d' % trial)
+            # the second call finds the fields in the cache, and a change makes them repaired
+            for step in range(2):
+                loc_to_dists = level_map.get_nested_location_evaluations(interesting_locations, taboo_sets)
+                self.assertEqual(loc_to_dists, expected, 'trial %d step %d' % (trial, step))
+            change_random_squares(rng, level_map)
+            expected = [get_reference_evaluations(level_map, interesting_locations, taboo_set) for taboo_set in taboo_sets]
+            loc_to_dists = level_map.get_nested_location_evaluations(interesting_locations, taboo_sets)
+            self.assertEqual(loc_to_dists, expected, 'trial %d after a change' % trial)
+
+
+if __name__ == '__main__':
+    unittest.main()